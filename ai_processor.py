@@ -1,15 +1,202 @@
 import os
 import json
-import requests
+import math
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
+from text_preparation import chunk_text, clean_text, count_tokens, prepare_ai_text
+from metrics import instrument, record_error
+from upstream_governor import governor
+import deadline
 
+# LLM 輸出必須包含的欄位（ocr_text、caption 由輸入直接帶入，不需模型回傳）
+REQUIRED_FIELDS = [
+    "summary",
+    "title",
+    "important_time",
+    "important_location",
+    "address",
+]
+
+# 小模型輸出時必須有實際內容的欄位，缺少則升級到大模型重跑
+NON_EMPTY_FIELDS = ["summary", "title"]
+
+# 長篇內容分段擷取（map 階段）使用的提示詞
+CHUNK_EXTRACT_PROMPT = """你會收到一篇長篇文章或逐字稿的其中一段，請只根據這一段內容擷取重點，並以 JSON 格式回傳：
+
+1. summary：這一段的重點摘要（80字以內，繁體中文）
+2. locations：這一段明確提及的地點、景點、餐廳、店家或地址名稱列表，沒有則回傳空陣列
+3. times：這一段明確提及的時間資訊列表，例如營業時間、活動日期、有效期限，沒有則回傳空陣列
+
+請嚴格按照以下 JSON 格式回傳：
+{
+    "summary": "這一段的重點摘要",
+    "locations": ["地點A", "地點B"],
+    "times": ["週一至週五 09:00-18:00"]
+}"""
 
 class AIProcessor:
     def __init__(self, api_key=None):
-        self.client = OpenAI(api_key=api_key or os.getenv("OPENAI_API_KEY"))
+        # 重試與限速由 upstream governor 統一處理，關閉 SDK 內建的重試
+        self.client = OpenAI(
+            api_key=api_key or os.getenv("OPENAI_API_KEY"), max_retries=0
+        )
         self.google_maps_api_key = os.getenv("GOOGLE_MAPS_API_KEY", "")
 
+        # 模型路由設定：短輸入走小模型，長輸入或小模型輸出不完整時走大模型
+        self.small_model = os.getenv("AI_SMALL_MODEL", "gpt-4o-mini")
+        self.large_model = os.getenv("AI_LARGE_MODEL", "gpt-4o")
+        self.routing_small_max_tokens = int(
+            os.getenv("AI_ROUTING_SMALL_MAX_TOKENS", "600")
+        )
+        # 系統忙碌（佇列深或上游延遲高）時，放寬小模型可處理的輸入長度
+        self.routing_pressure_max_tokens = int(
+            os.getenv("AI_ROUTING_PRESSURE_MAX_TOKENS", "2000")
+        )
+        self.routing_max_inflight = int(os.getenv("AI_ROUTING_MAX_INFLIGHT", "0"))
+        self.routing_latency_threshold = float(
+            os.getenv("AI_ROUTING_LATENCY_THRESHOLD", "0")
+        )
+
+        # 輸入文字的 token 預算：扣除原始連結後，依比例分配給文字內容與字幕
+        self.input_token_budget = int(os.getenv("AI_INPUT_TOKEN_BUDGET", "3000"))
+        self.input_ocr_share = float(os.getenv("AI_INPUT_OCR_SHARE", "0.6"))
+        self.input_metadata_max_tokens = int(
+            os.getenv("AI_INPUT_METADATA_MAX_TOKENS", "100")
+        )
+
+        # 長篇內容模式：超過門檻時分段並行擷取重點，再彙整成最終分析
+        self.long_input_threshold = int(
+            os.getenv("AI_LONG_INPUT_THRESHOLD_TOKENS", "6000")
+        )
+        self.long_input_chunk_tokens = int(
+            os.getenv("AI_LONG_INPUT_CHUNK_TOKENS", "2000")
+        )
+        self.long_input_max_chunks = int(os.getenv("AI_LONG_INPUT_MAX_CHUNKS", "8"))
+        self.long_input_map_model = os.getenv(
+            "AI_LONG_INPUT_MAP_MODEL", self.small_model
+        )
+        self._map_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("AI_LONG_INPUT_MAX_WORKERS", "8")),
+            thread_name_prefix="ai-map",
+        )
+
+        self._inflight = 0
+        self._model_latency = {}  # model -> 指數移動平均延遲（秒）
+        self._routing_lock = threading.Lock()
+
+    def _route_model(self, input_tokens: int) -> Tuple[str, str]:
+        """依輸入 token 數與目前負載選擇模型，回傳 (模型名稱, 原因)"""
+        with self._routing_lock:
+            inflight = self._inflight
+            large_latency = self._model_latency.get(self.large_model, 0.0)
+
+        if input_tokens <= self.routing_small_max_tokens:
+            return self.small_model, f"input_tokens<={self.routing_small_max_tokens}"
+
+        under_pressure = None
+        if self.routing_max_inflight and inflight >= self.routing_max_inflight:
+            under_pressure = f"inflight={inflight}"
+        elif (
+            self.routing_latency_threshold
+            and large_latency >= self.routing_latency_threshold
+        ):
+            under_pressure = f"{self.large_model}_latency={large_latency:.1f}s"
+
+        if under_pressure and input_tokens <= self.routing_pressure_max_tokens:
+            return self.small_model, f"pressure({under_pressure})"
+
+        return self.large_model, f"input_tokens>{self.routing_small_max_tokens}"
+
+    @instrument("llm", upstream="openai")
+    def _chat_json(self, model: str, system_prompt: str, user_content: str) -> str:
+        """呼叫 Chat Completions 並回傳 JSON 字串，同時記錄延遲與並行數"""
+        with self._routing_lock:
+            self._inflight += 1
+        started = time.monotonic()
+        try:
+            response = governor.call(
+                "openai_chat",
+                self.client.chat.completions.create,
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_content},
+                ],
+                max_tokens=4096,
+                temperature=0.3,
+                response_format={"type": "json_object"},
+                timeout=deadline.timeout(60, "llm"),
+            )
+            return response.choices[0].message.content
+        finally:
+            elapsed = time.monotonic() - started
+            with self._routing_lock:
+                self._inflight -= 1
+                previous = self._model_latency.get(model)
+                self._model_latency[model] = (
+                    elapsed if previous is None else previous * 0.8 + elapsed * 0.2
+                )
+
+    @staticmethod
+    def _missing_fields(result: Dict) -> List[str]:
+        """檢查 AI 輸出缺少或為空的必要欄位"""
+        missing = [field for field in REQUIRED_FIELDS if field not in result]
+        missing += [
+            field
+            for field in NON_EMPTY_FIELDS
+            if field in result and not str(result.get(field) or "").strip()
+        ]
+        return missing
+
+    def _routed_completion(self, system_prompt: str, user_content: str) -> Tuple[Dict, Dict]:
+        """依路由結果呼叫模型；小模型輸出不完整時升級到大模型
+
+        Returns:
+            tuple: (解析後的 JSON 結果, 路由紀錄)
+        """
+        # 系統提示詞長度固定，只以使用者內容的 token 數作為路由依據
+        input_tokens = count_tokens(user_content)
+        model, reason = self._route_model(input_tokens)
+        routing = {
+            "initial_model": model,
+            "model": model,
+            "reason": reason,
+            "input_tokens": input_tokens,
+            "escalated": False,
+        }
+        started = time.monotonic()
+
+        response_content = self._chat_json(model, system_prompt, user_content)
+        print(f"AI回應內容 ({model}): {response_content[:200]}...")  # 調試用
+
+        try:
+            result = json.loads(response_content)
+            missing = self._missing_fields(result)
+        except json.JSONDecodeError:
+            if model == self.large_model:
+                raise
+            result, missing = None, ["invalid_json"]
+
+        if missing and model != self.large_model:
+            print(f"⚠️ {model} 輸出缺少欄位 {missing}，升級至 {self.large_model} 重新分析")
+            routing["escalated"] = True
+            routing["escalation_reason"] = missing
+            model = self.large_model
+            response_content = self._chat_json(model, system_prompt, user_content)
+            print(f"AI回應內容 ({model}): {response_content[:200]}...")  # 調試用
+            result = json.loads(response_content)
+
+        routing["model"] = model
+        routing["missing_fields"] = self._missing_fields(result)
+        routing["latency_ms"] = round((time.monotonic() - started) * 1000)
+        print(f"🧭 模型路由: {routing}")
+        return result, routing
+
+    @instrument("maps", upstream="google_maps")
     def _search_address_with_google_maps(self, location_name: str) -> Dict:
         """
         透過 Google Maps Places API (New) 的 text search，將地點名稱轉換為詳細資訊。
@@ -27,7 +214,14 @@ class AIProcessor:
 
         try:
             print(f"正在透過 Google Maps API 查詢地點詳細資訊: {location_name}")
-            response = requests.post(url, headers=headers, json=payload, timeout=10)
+            response = governor.request(
+                "google_maps",
+                "POST",
+                url,
+                headers=headers,
+                json=payload,
+                timeout=deadline.timeout(10, "maps"),
+            )
             if response.status_code == 200:
                 data = response.json()
                 places = data.get("places", [])
@@ -48,30 +242,159 @@ class AIProcessor:
                 else:
                     print(f"⚠️ 找不到該地點的資訊: {location_name}")
             else:
+                record_error("google_maps")
                 print(
                     f"⚠️ Google Maps API 查詢失敗: {response.status_code} - {response.text}"
                 )
+        except deadline.RequestCancelled:
+            # 用戶端已斷線：不再查詢其餘地點（逾時則照常視為查詢失敗）
+            raise
         except Exception as e:
+            record_error("google_maps")
             print(f"⚠️ 查詢 Google Maps API 時發生錯誤: {e}")
 
         return {}
 
-    def process_video_text(self, input_data: Dict) -> Dict:
-        """使用LLM處理文字資訊"""
+    def _extract_chunk(self, index: int, chunk: str) -> Optional[Dict]:
+        """map 階段：擷取單一區塊的摘要、地點與時間，失敗時回傳 None"""
+        try:
+            content = self._chat_json(
+                self.long_input_map_model, CHUNK_EXTRACT_PROMPT, chunk
+            )
+            data = json.loads(content)
+            return {
+                "summary": str(data.get("summary") or "").strip(),
+                "locations": [str(x).strip() for x in data.get("locations") or [] if str(x).strip()],
+                "times": [str(x).strip() for x in data.get("times") or [] if str(x).strip()],
+            }
+        except Exception as e:
+            print(f"⚠️ 第 {index + 1} 段重點擷取失敗: {e}")
+            return None
+
+    def _map_long_input(self, text: str, total_tokens: int) -> Tuple[str, Dict]:
+        """將長篇內容分段並行擷取重點，回傳彙整後的文字與統計資訊
+
+        區塊數超過上限時放大每段的 token 數，確保全文都被涵蓋；
+        各段並行呼叫模型，整體耗時接近單次呼叫。
+        """
+        chunk_tokens = max(
+            self.long_input_chunk_tokens,
+            math.ceil(total_tokens / max(self.long_input_max_chunks, 1)),
+        )
+        chunks = chunk_text(text, chunk_tokens)
+        # 依句子邊界切分會略為超出上限，放大區塊重切直到符合
+        while len(chunks) > self.long_input_max_chunks > 0:
+            chunk_tokens = math.ceil(chunk_tokens * 1.2)
+            chunks = chunk_text(text, chunk_tokens)
+        print(f"📚 長篇內容模式: {total_tokens} tokens，切成 {len(chunks)} 段並行擷取")
+
+        started = time.monotonic()
+        # 各段在執行緒池中執行，複製目前的 context 讓平台標籤等狀態跟著傳過去
+        contexts = [contextvars.copy_context() for _ in chunks]
+        extracted = list(
+            self._map_executor.map(
+                lambda context, index, chunk: context.run(self._extract_chunk, index, chunk),
+                contexts,
+                range(len(chunks)),
+                chunks,
+            )
+        )
+        map_latency_ms = round((time.monotonic() - started) * 1000)
+
+        notes = []
+        locations = []
+        times = []
+        for index, item in enumerate(extracted):
+            if not item:
+                continue
+            notes.append(f"[第{index + 1}段] {item['summary']}")
+            # 保留出現順序並去除重複
+            locations += [loc for loc in item["locations"] if loc not in locations]
+            times += [t for t in item["times"] if t not in times]
+
+        if not notes:
+            raise Exception("所有段落重點擷取皆失敗")
+
+        merged = "\n".join(notes)
+        if locations:
+            merged += f"\n提及地點：{' / '.join(locations)}"
+        if times:
+            merged += f"\n提及時間：{'；'.join(times)}"
+
+        stats = {
+            "total_tokens": total_tokens,
+            "chunks": len(chunks),
+            "failed_chunks": sum(1 for item in extracted if not item),
+            "map_model": self.long_input_map_model,
+            "map_latency_ms": map_latency_ms,
+        }
+        return merged, stats
+
+    def lookup_places(self, locations: List[str], lookup: bool = True) -> Dict:
+        """查詢各地點的詳細資訊，回傳要合併到分析結果的地址與地點欄位
+
+        lookup=False 時不呼叫 Google Maps，地址暫以地點名稱代替（延後補充模式）。
+        """
+        addresses = []
+        all_details = []
+
+        # 地點查詢為選用階段：Google Maps 斷路器開啟或請求剩餘時間不足時，
+        # 其餘地點略過查詢並保留原始地點名稱
+        maps_enabled = lookup
+        for loc in locations:
+            if maps_enabled and not governor.available("google_maps"):
+                deadline.skip("maps", "Google Maps 暫時停用（斷路器開啟）")
+                maps_enabled = False
+            elif maps_enabled and not deadline.allows("maps"):
+                maps_enabled = False
+            if not maps_enabled:
+                addresses.append(loc)
+                all_details.append({"address": loc})
+                continue
+            details = self._search_address_with_google_maps(loc)
+            if details and details.get("address"):
+                # 找到詳細資訊
+                addresses.append(details["address"])
+                all_details.append(details)
+            else:
+                # 找不到詳細資訊則保留原始查詢字串
+                addresses.append(loc)
+                all_details.append({"address": loc})
+
+        fields = {"address": addresses, "all_location_details": all_details}
+
+        # 將第一個地點的詳細資訊拉到頂層以便相容舊有的單一地點顯示邏輯
+        if all_details:
+            d = all_details[0]
+            fields["rating"] = d.get("rating")
+            fields["priceLevel"] = d.get("priceLevel")
+            fields["priceRange"] = d.get("priceRange")
+            fields["regularOpeningHours"] = d.get("regularOpeningHours")
+            fields["location"] = d.get("location")
+            fields["websiteUri"] = d.get("websiteUri")
+            fields["nationalPhoneNumber"] = d.get("nationalPhoneNumber")
+            fields["paymentOptions"] = d.get("paymentOptions")
+        return fields
+
+    @instrument("analyze")
+    def process_video_text(self, input_data: Dict, enrich_places: bool = True) -> Dict:
+        """使用LLM處理文字資訊
+
+        enrich_places=False 時不在請求中查詢 Google Maps，有待查詢的地點時
+        結果帶 enrichment="pending"，由呼叫端以 lookup_places 在背景補充
+        """
         original_path = input_data.get("original_path", "")
         ocr_text = input_data.get("ocr_text", "")
         caption = input_data.get("caption", "")
 
         # 準備系統提示詞
-        system_prompt = """請對提供的短影音文字內容進行六項分析，並以 JSON 格式回傳：
-
-1. ocr_text：保留原有的文字內容
-2. caption：保留原有的字幕內容
-3. summary：基於文字內容和字幕，生成一個簡潔有力的重點摘要（50字以內）
-4. title：生成一個吸引人的標題（20字以內），要能準確反映內容主題，適合作為影片或圖片的標題
-5. important_time：從文字中提取任何明確提及的重要時間資訊，例如營業時間、活動日期、有效期限等。如果沒有，則回傳空字串。
-6. important_location：從文字中提取任何明確提及的重要地點資訊，例如景點名稱、餐廳名稱、品牌名等。如果有多個地點，請用「/」隔開（例如：A咖啡廳 / B咖啡廳 / C咖啡廳）。如果沒有，則回傳空字串。
-7. address：請判斷提取出來的 `important_location` 是否本身就是一個「完整的詳細地址」（例如：台北市信義區市府路45號）。
+        system_prompt = """請對提供的短影音文字內容進行五項分析，並以 JSON 格式回傳：
+
+1. summary：基於文字內容和字幕，生成一個簡潔有力的重點摘要（50字以內）
+2. title：生成一個吸引人的標題（20字以內），要能準確反映內容主題，適合作為影片或圖片的標題
+3. important_time：從文字中提取任何明確提及的重要時間資訊，例如營業時間、活動日期、有效期限等。如果沒有，則回傳空字串。
+4. important_location：從文字中提取任何明確提及的重要地點資訊，例如景點名稱、餐廳名稱、品牌名等。如果有多個地點，請用「/」隔開（例如：A咖啡廳 / B咖啡廳 / C咖啡廳）。如果沒有，則回傳空字串。
+5. address：請判斷提取出來的 `important_location` 是否本身就是一個「完整的詳細地址」（例如：台北市信義區市府路45號）。
    - 如果是完整地址，請將該相同內容填入此欄位。
    - 如果不是完整地址（只是地點名稱，例如：台北101、台中洲際棒球場）或者沒有提取出任何地點，請填入「空字串」。
 
@@ -92,8 +415,6 @@ class AIProcessor:
 
 請嚴格按照以下 JSON 格式回傳：
 {
-    "ocr_text": "原始的文字內容，保持原始格式",
-    "caption": "原始的字幕內容",
     "summary": "整合摘要，例如：星巴克咖啡店內用餐區，顧客使用筆電工作",
     "title": "吸引人的標題，例如：星巴克咖啡店工作日常",
     "important_time": "例如：週一至週五 09:00-18:00，如果沒有則回傳空字串",
@@ -103,57 +424,52 @@ class AIProcessor:
 }"""
 
         try:
-            # 更徹底的文字清理，移除所有可能導致JSON錯誤的字符
-            import re
-
-            def clean_text(text):
-                if not text:
-                    return ""
-                # 移除特殊字符和控制字符
-                text = re.sub(
-                    r"[^\w\s\u4e00-\u9fff\u3400-\u4dbf\u3040-\u309f\u30a0-\u30ff.,!?()【】「」：；。，！？（）]",
-                    " ",
-                    text,
-                )
-                # 移除多餘空格
-                text = re.sub(r"\s+", " ", text)
-                return text.strip()
-
-            clean_ocr_text = clean_text(ocr_text)[:800]  # 限制長度避免超出token限制
-            clean_caption = clean_text(caption)[:400]
-
-            # 呼叫LLM進行處理
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {
-                        "role": "user",
-                        "content": f"文字內容：{clean_ocr_text}\n\n字幕內容：{clean_caption}\n\n原始連結：{original_path}",
-                    },
-                ],
-                max_tokens=4096,
-                temperature=0.3,
-                response_format={"type": "json_object"},
+            # 在 token 預算內準備輸入：清理特殊字符，超出預算時保留含時間、地址、專有名詞的句子
+            prepared = prepare_ai_text(
+                ocr_text,
+                caption,
+                original_path,
+                token_budget=self.input_token_budget,
+                ocr_share=self.input_ocr_share,
+                metadata_max_tokens=self.input_metadata_max_tokens,
+            )
+            clean_ocr_text = prepared["ocr_text"]
+            clean_caption = (
+                "（同文字內容）" if prepared["caption_same_as_ocr"] else prepared["caption"]
+            )
+            print(
+                f"📝 輸入 token: {prepared['tokens']}，是否裁切: {prepared['truncated']}"
             )
 
-            response_content = response.choices[0].message.content
-            print(f"AI回應內容: {response_content[:200]}...")  # 調試用
+            # 超過長篇門檻時改以分段擷取的重點作為分析輸入，避免裁切後遺漏地點與時間
+            long_input = None
+            if prepared["truncated"]:
+                full_text = (
+                    ocr_text
+                    if prepared["caption_same_as_ocr"]
+                    else f"{ocr_text}\n{caption}"
+                )
+                total_tokens = count_tokens(clean_text(full_text))
+                if total_tokens > self.long_input_threshold:
+                    clean_ocr_text, long_input = self._map_long_input(
+                        full_text, total_tokens
+                    )
+                    clean_caption = "（同文字內容）"
 
-            result = json.loads(response_content)
+            # 呼叫LLM進行處理（依輸入長度與負載路由模型）
+            result, routing = self._routed_completion(
+                system_prompt,
+                f"文字內容：{clean_ocr_text}\n\n字幕內容：{clean_caption}\n\n原始連結：{prepared['original_path']}",
+            )
+            result["ocr_text"] = prepared["ocr_text"]
+            result["caption"] = prepared["caption"]
             result["original_path"] = original_path
+            result["model_routing"] = routing
+            if long_input:
+                result["long_input"] = long_input
 
             # 確保所有必要的欄位都存在
-            required_fields = [
-                "ocr_text",
-                "caption",
-                "summary",
-                "title",
-                "important_time",
-                "important_location",
-                "address",
-            ]
-            for field in required_fields:
+            for field in REQUIRED_FIELDS:
                 if field not in result:
                     if field in ["important_location", "address"]:
                         result[field] = []
@@ -171,40 +487,17 @@ class AIProcessor:
                     for loc in search_query.replace("｜｜｜", "/").split("/")
                     if loc.strip()
                 ]
-                
-                addresses = []
-                all_details = []
-                
-                for loc in locations:
-                    details = self._search_address_with_google_maps(loc)
-                    if details and details.get("address"):
-                        # 找到詳細資訊
-                        addresses.append(details["address"])
-                        all_details.append(details)
-                    else:
-                        # 找不到詳細資訊則保留原始查詢字串
-                        addresses.append(loc)
-                        all_details.append({"address": loc})
-
                 # 更新欄位為陣列格式 (即使只有一個也是 array)
                 result["important_location"] = locations
-                result["address"] = addresses
-                result["all_location_details"] = all_details
-
-                # 將第一個地點的詳細資訊拉到頂層以便相容舊有的單一地點顯示邏輯
-                if all_details:
-                    d = all_details[0]
-                    result["rating"] = d.get("rating")
-                    result["priceLevel"] = d.get("priceLevel")
-                    result["priceRange"] = d.get("priceRange")
-                    result["regularOpeningHours"] = d.get("regularOpeningHours")
-                    result["location"] = d.get("location")
-                    result["websiteUri"] = d.get("websiteUri")
-                    result["nationalPhoneNumber"] = d.get("nationalPhoneNumber")
-                    result["paymentOptions"] = d.get("paymentOptions")
+                result.update(self.lookup_places(locations, lookup=enrich_places))
+                # 延後補充模式：由呼叫端在背景查詢並部分更新已儲存的文檔
+                if not enrich_places and locations and self.google_maps_api_key:
+                    result["enrichment"] = "pending"
 
             return result
 
+        except deadline.DeadlineExceeded:
+            raise
         except json.JSONDecodeError as e:
             print("=" * 80)
             print("❌ JSON解析錯誤詳細資訊:")
@@ -213,8 +506,8 @@ class AIProcessor:
             print(f"錯誤字符位置: {e.pos}")
             print("完整AI回應內容:")
             print("-" * 40)
-            if "response" in locals():
-                full_response = response.choices[0].message.content
+            if e.doc:
+                full_response = e.doc
                 print(full_response)
                 print("-" * 40)
                 print(f"回應長度: {len(full_response)} 字符")
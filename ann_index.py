@@ -0,0 +1,534 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+SNAPSHOT_VERSION = 1
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def train_centroids(
+    vectors: np.ndarray, nlist: int, iterations: int = 8, sample_size: int = 20000, seed: int = 0
+) -> np.ndarray:
+    """以球面 k-means 訓練 IVF 分群中心（向量需已正規化）"""
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample_size:
+        vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for cluster in range(nlist):
+            members = vectors[assignments == cluster]
+            if len(members):
+                centroids[cluster] = members.sum(axis=0)
+            else:
+                # 空的分群重新抽樣，避免浪費
+                centroids[cluster] = vectors[rng.integers(len(vectors))]
+        centroids = _normalize_rows(centroids)
+    return centroids.astype(np.float32)
+
+
+class IVFShard:
+    """單一租戶的向量索引
+
+    資料量小於 min_ivf_size 時直接做精確搜尋（NumPy 矩陣乘法）；
+    超過後訓練 IVF 分群，只在最接近的 nprobe 個分群中計算相似度。
+    新增的向量直接指派到最近的分群，資料量成長一倍時重新訓練；
+    刪除只標記，刪除比例過高時再壓縮。
+    auto_train=False 時不在 add 中訓練，只標記 needs_training，由呼叫端在背景訓練。
+    """
+
+    def __init__(
+        self, dimension: int, min_ivf_size: int = 2000, nprobe: int = 16, auto_train: bool = True
+    ):
+        self.dimension = dimension
+        self.min_ivf_size = min_ivf_size
+        self.nprobe = nprobe
+        self.auto_train = auto_train
+        self.needs_training = False
+
+        self.ids: List[str] = []
+        self.cards: List[Dict] = []
+        self.positions: Dict[str, int] = {}
+        self.vectors = np.empty((0, dimension), dtype=np.float32)
+        self.alive = np.empty(0, dtype=bool)
+        self.size = 0
+        self.deleted = 0
+
+        self.centroids: Optional[np.ndarray] = None
+        self.assignments = np.empty(0, dtype=np.int32)
+        self.trained_size = 0
+
+    def __len__(self) -> int:
+        return self.size - self.deleted
+
+    def _grow(self, needed: int):
+        capacity = len(self.vectors)
+        if needed <= capacity:
+            return
+        new_capacity = max(needed, capacity * 2, 64)
+        vectors = np.empty((new_capacity, self.dimension), dtype=np.float32)
+        vectors[: self.size] = self.vectors[: self.size]
+        alive = np.zeros(new_capacity, dtype=bool)
+        alive[: self.size] = self.alive[: self.size]
+        assignments = np.zeros(new_capacity, dtype=np.int32)
+        assignments[: self.size] = self.assignments[: self.size]
+        self.vectors, self.alive, self.assignments = vectors, alive, assignments
+
+    def add(self, document_id: str, vector, card: Dict):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector = vector / norm
+
+        position = self.positions.get(document_id)
+        if position is None:
+            position = self.size
+            self._grow(position + 1)
+            self.ids.append(document_id)
+            self.cards.append(card)
+            self.positions[document_id] = position
+            self.size += 1
+        else:
+            self.cards[position] = card
+
+        self.vectors[position] = vector
+        self.alive[position] = True
+        if self.centroids is not None:
+            self.assignments[position] = int(np.argmax(self.centroids @ vector))
+
+        if len(self) >= self.min_ivf_size and len(self) >= 2 * self.trained_size:
+            self._request_training()
+
+    def _request_training(self):
+        if self.auto_train:
+            self.train()
+        else:
+            self.needs_training = True
+
+    def remove(self, document_id: str) -> bool:
+        position = self.positions.pop(document_id, None)
+        if position is None:
+            return False
+        self.alive[position] = False
+        self.cards[position] = None
+        self.deleted += 1
+        if self.deleted > max(self.size // 4, 64):
+            self.compact()
+        return True
+
+    def compact(self):
+        """移除已刪除的向量；保留原本的分群，再重新訓練"""
+        keep = np.flatnonzero(self.alive[: self.size])
+        self.vectors = self.vectors[keep].copy()
+        self.alive = np.ones(len(keep), dtype=bool)
+        self.assignments = self.assignments[keep].copy()
+        self.ids = [self.ids[i] for i in keep]
+        self.cards = [self.cards[i] for i in keep]
+        self.positions = {document_id: i for i, document_id in enumerate(self.ids)}
+        self.size = len(keep)
+        self.deleted = 0
+        if self.size < self.min_ivf_size:
+            self.centroids = None
+            self.trained_size = 0
+            self.needs_training = False
+        else:
+            self._request_training()
+
+    def training_sample(self, sample_size: int = 20000, seed: int = 0) -> tuple:
+        """回傳 (訓練用的向量樣本副本, 分群數)，可在鎖外以 train_centroids 訓練"""
+        live = np.flatnonzero(self.alive[: self.size])
+        nlist = int(np.clip(np.sqrt(len(live)), 16, 1024))
+        if len(live) > sample_size:
+            live = np.random.default_rng(seed).choice(live, sample_size, replace=False)
+        return self.vectors[live].copy(), nlist
+
+    def apply_centroids(self, centroids: np.ndarray):
+        """套用訓練好的分群中心並重新指派所有向量"""
+        self.centroids = centroids
+        self.assignments[: self.size] = np.argmax(
+            self.vectors[: self.size] @ self.centroids.T, axis=1
+        )
+        self.trained_size = len(self)
+        self.needs_training = False
+
+    def train(self):
+        self.apply_centroids(train_centroids(*self.training_sample()))
+
+    def search(
+        self,
+        vector,
+        k: int,
+        predicate: Optional[Callable[[Dict], bool]] = None,
+        exact: bool = False,
+    ) -> List[tuple]:
+        """回傳 [(document_id, cosine 相似度, card)]，依相似度排序"""
+        if not len(self):
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+
+        full_scan = self.centroids is None or exact
+        mask = self.alive[: self.size].copy()
+        if not full_scan:
+            probe = np.argsort(-(self.centroids @ query))[: self.nprobe]
+            mask &= np.isin(self.assignments[: self.size], probe)
+        candidates = np.flatnonzero(mask)
+        if predicate is not None:
+            candidates = np.array(
+                [i for i in candidates if predicate(self.cards[i])], dtype=np.int64
+            )
+        if not len(candidates):
+            return []
+
+        if full_scan:
+            # 直接對連續記憶體做矩陣乘法，比先複製候選向量快
+            scores = (self.vectors[: self.size] @ query)[candidates]
+        else:
+            scores = self.vectors[candidates] @ query
+        k = min(k, len(candidates))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (self.ids[candidates[i]], float(scores[i]), self.cards[candidates[i]])
+            for i in top
+        ]
+
+    def state(self) -> Dict:
+        live = np.flatnonzero(self.alive[: self.size])
+        return {
+            "ids": [self.ids[i] for i in live],
+            "cards": [self.cards[i] for i in live],
+            "vectors": self.vectors[live],
+        }
+
+
+class ANNIndexManager:
+    """依租戶（user_id）分片的記憶體內 ANN 索引
+
+    資料來源仍是向量資料庫：啟動時從快照或資料庫載入，之後隨寫入與刪除增量更新。
+    載入完成前 ready 為 False，搜尋應退回資料庫。
+    """
+
+    def __init__(
+        self,
+        dimension: int,
+        card_fields: List[str],
+        snapshot_dir: str = None,
+        min_ivf_size: int = 2000,
+        nprobe: int = 16,
+        snapshot_interval: float = 300,
+        snapshot_max_age: float = 86400,
+    ):
+        self.dimension = dimension
+        self.card_fields = card_fields
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_interval = snapshot_interval
+        self.min_ivf_size = min_ivf_size
+        self.nprobe = nprobe
+        self.snapshot_max_age = snapshot_max_age
+
+        self.shards: Dict[Optional[str], IVFShard] = {}
+        self.ready = False
+        self._lock = threading.RLock()
+        self._removed_while_loading = set()
+        self._dirty = False
+        self._stopped = threading.Event()
+        # 有分片需要（重新）訓練時喚醒背景執行緒；訓練不在寫入請求中進行
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self, store):
+        """背景載入索引，之後定期寫入快照"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(store,), name="ann-index", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+        self.save_snapshot_if_dirty()
+
+    def _run(self, store):
+        try:
+            if not store.connect():
+                raise Exception("無法連接到向量資料庫")
+            self.warm_start(store)
+        except Exception as e:
+            # 載入失敗時維持 ready=False，搜尋會退回向量資料庫
+            print(f"⚠️ ANN 索引載入失敗: {e}")
+            return
+        next_snapshot = time.monotonic() + self.snapshot_interval
+        while not self._stopped.is_set():
+            try:
+                self.train_pending()
+            except Exception as e:
+                print(f"⚠️ 訓練 ANN 索引分群失敗: {e}")
+            if time.monotonic() >= next_snapshot:
+                try:
+                    self.save_snapshot_if_dirty()
+                except Exception as e:
+                    print(f"⚠️ 寫入 ANN 索引快照失敗: {e}")
+                next_snapshot = time.monotonic() + self.snapshot_interval
+            self._wakeup.wait(max(next_snapshot - time.monotonic(), 0))
+            self._wakeup.clear()
+
+    def train_pending(self):
+        """訓練需要（重新）訓練的分片：k-means 在鎖外進行，只有套用結果時持有鎖"""
+        with self._lock:
+            pending = [
+                (user_id, shard) for user_id, shard in self.shards.items() if shard.needs_training
+            ]
+        for user_id, shard in pending:
+            with self._lock:
+                if self.shards.get(user_id) is not shard or not shard.needs_training:
+                    continue
+                sample, nlist = shard.training_sample()
+            centroids = train_centroids(sample, nlist)
+            with self._lock:
+                if self.shards.get(user_id) is shard:
+                    shard.apply_centroids(centroids)
+                    self._dirty = True
+
+    def on_documents_added(self, documents: List[Dict]):
+        self.add_documents(documents)
+
+    def on_document_removed(self, document_id: str, user_id: Optional[str] = None):
+        self.remove_document(document_id, user_id)
+
+    def _shard(self, user_id: Optional[str]) -> IVFShard:
+        shard = self.shards.get(user_id)
+        if shard is None:
+            shard = IVFShard(self.dimension, self.min_ivf_size, self.nprobe, auto_train=False)
+            self.shards[user_id] = shard
+        return shard
+
+    def add_documents(self, documents: Iterable[Dict]):
+        """新增或更新文檔（需含 $vector 與 metadata）"""
+        with self._lock:
+            for document in documents:
+                vector = document.get("$vector")
+                if vector is None or len(vector) != self.dimension:
+                    continue
+                if not self.ready and document["_id"] in self._removed_while_loading:
+                    continue
+                metadata = document.get("metadata") or {}
+                card = {field: metadata.get(field) for field in self.card_fields}
+                shard = self._shard(metadata.get("user_id"))
+                shard.add(document["_id"], vector, card)
+                self._dirty = True
+                if shard.needs_training:
+                    self._wakeup.set()
+
+    def remove_document(self, document_id: str, user_id: Optional[str] = None):
+        with self._lock:
+            if not self.ready:
+                self._removed_while_loading.add(document_id)
+            shards = [self.shards[user_id]] if user_id in self.shards else self.shards.values()
+            for shard in shards:
+                if shard.remove(document_id):
+                    self._dirty = True
+                    if shard.needs_training:
+                        self._wakeup.set()
+                    break
+
+    def search(
+        self,
+        user_id: Optional[str],
+        vector,
+        k: int,
+        predicate: Optional[Callable[[Dict], bool]] = None,
+        exact: bool = False,
+    ) -> List[tuple]:
+        with self._lock:
+            shard = self.shards.get(user_id)
+            if shard is None:
+                return []
+            return shard.search(vector, k, predicate, exact)
+
+    def hydrate(self, store):
+        """從向量資料庫完整載入文檔"""
+        started = time.monotonic()
+        batch = []
+        count = 0
+        for document in store.iter_documents(
+            {}, fields=self.card_fields, include_vector=True
+        ):
+            batch.append(document)
+            if len(batch) >= 500:
+                self.add_documents(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            self.add_documents(batch)
+            count += len(batch)
+        self._mark_ready()
+        print(
+            f"🧭 ANN 索引載入完成: {count} 筆文檔、{len(self.shards)} 個分片，"
+            f"耗時 {time.monotonic() - started:.1f}s"
+        )
+
+    def _mark_ready(self):
+        with self._lock:
+            self.ready = True
+            self._removed_while_loading.clear()
+
+    def reconcile(self, store):
+        """以資料庫為準校正載入的快照
+
+        只掃描卡片欄位（不含向量）：移除快照之後被刪除的文檔（含其他實例或服務停止期間的刪除）、
+        更新有變動的卡片欄位（例如延後補充的地點資訊），只為快照中沒有的文檔讀取向量。
+        """
+        started = time.monotonic()
+        with self._lock:
+            indexed = {
+                document_id: user_id
+                for user_id, shard in self.shards.items()
+                for document_id in shard.positions
+            }
+        seen = set()
+        missing = []
+        updated = 0
+        for document in store.iter_documents({}, fields=self.card_fields):
+            document_id = document["_id"]
+            seen.add(document_id)
+            if document_id not in indexed:
+                missing.append(document_id)
+                continue
+            metadata = document.get("metadata") or {}
+            card = {field: metadata.get(field) for field in self.card_fields}
+            with self._lock:
+                shard = self.shards.get(indexed[document_id])
+                position = shard.positions.get(document_id) if shard else None
+                if position is not None and shard.cards[position] != card:
+                    shard.cards[position] = card
+                    self._dirty = True
+                    updated += 1
+
+        removed = [document_id for document_id in indexed if document_id not in seen]
+        for document_id in removed:
+            self.remove_document(document_id, indexed[document_id])
+
+        # Data API 的 $in 最多接受 100 個值
+        for start in range(0, len(missing), 100):
+            self.add_documents(
+                store.iter_documents(
+                    {"_id": {"$in": missing[start : start + 100]}},
+                    fields=self.card_fields,
+                    include_vector=True,
+                )
+            )
+        self._mark_ready()
+        print(
+            f"🧭 ANN 索引快照校正完成: 新增 {len(missing)}、刪除 {len(removed)}、"
+            f"更新 {updated} 筆，耗時 {time.monotonic() - started:.1f}s"
+        )
+
+    def warm_start(self, store):
+        """先載入磁碟快照，再與資料庫校正（新增、刪除、更新）；快照過舊時完整載入"""
+        snapshot_time = self.load_snapshot()
+        if snapshot_time and time.time() - snapshot_time <= self.snapshot_max_age:
+            self.reconcile(store)
+        else:
+            with self._lock:
+                self.shards = {}
+            self.hydrate(store)
+        self.save_snapshot()
+
+    def _shard_path(self, user_id: Optional[str]) -> str:
+        key = hashlib.sha1(json.dumps(user_id).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.snapshot_dir, f"shard_{key}")
+
+    def save_snapshot(self):
+        """將所有分片寫入磁碟（先寫暫存檔再改名，避免寫到一半的快照）"""
+        if not self.snapshot_dir or not self.ready:
+            return
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        with self._lock:
+            states = {user_id: shard.state() for user_id, shard in self.shards.items()}
+            self._dirty = False
+        manifest = {"version": SNAPSHOT_VERSION, "created_at": time.time(), "shards": []}
+        for user_id, state in states.items():
+            path = self._shard_path(user_id)
+            np.save(path + ".tmp.npy", state["vectors"])
+            os.replace(path + ".tmp.npy", path + ".npy")
+            with open(path + ".tmp.json", "w", encoding="utf-8") as f:
+                json.dump({"ids": state["ids"], "cards": state["cards"]}, f, ensure_ascii=False)
+            os.replace(path + ".tmp.json", path + ".json")
+            manifest["shards"].append({"user_id": user_id, "path": os.path.basename(path)})
+        manifest_path = os.path.join(self.snapshot_dir, "manifest.json")
+        with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(manifest_path + ".tmp", manifest_path)
+        print(f"💾 ANN 索引快照已寫入: {len(states)} 個分片")
+
+    def save_snapshot_if_dirty(self):
+        if self._dirty:
+            self.save_snapshot()
+
+    def load_snapshot(self) -> Optional[float]:
+        """載入磁碟快照，回傳快照建立時間；沒有可用快照時回傳 None"""
+        if not self.snapshot_dir:
+            return None
+        manifest_path = os.path.join(self.snapshot_dir, "manifest.json")
+        try:
+            with open(manifest_path, encoding="utf-8") as f:
+                manifest = json.load(f)
+            if manifest.get("version") != SNAPSHOT_VERSION:
+                return None
+            shards = {}
+            for entry in manifest["shards"]:
+                path = os.path.join(self.snapshot_dir, entry["path"])
+                vectors = np.load(path + ".npy")
+                if vectors.shape[1:] != (self.dimension,):
+                    return None
+                with open(path + ".json", encoding="utf-8") as f:
+                    data = json.load(f)
+                shard = IVFShard(self.dimension, self.min_ivf_size, self.nprobe, auto_train=False)
+                for document_id, card, vector in zip(data["ids"], data["cards"], vectors):
+                    shard.add(document_id, vector, card)
+                shards[entry["user_id"]] = shard
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"⚠️ 載入 ANN 索引快照失敗，改為完整載入: {e}")
+            return None
+
+        with self._lock:
+            # 載入快照期間被刪除的文檔
+            for shard in shards.values():
+                for document_id in self._removed_while_loading:
+                    shard.remove(document_id)
+            self.shards = shards
+        print(f"💾 已載入 ANN 索引快照: {len(shards)} 個分片")
+        return manifest["created_at"]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            sizes = [len(shard) for shard in self.shards.values()]
+            return {
+                "ready": self.ready,
+                "shards": len(sizes),
+                "documents": sum(sizes),
+                "largest_shard": max(sizes) if sizes else 0,
+                "ivf_shards": sum(
+                    1 for shard in self.shards.values() if shard.centroids is not None
+                ),
+            }
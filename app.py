@@ -1,9 +1,25 @@
-from fastapi import FastAPI, HTTPException, Form, UploadFile, File
+from fastapi import (
+    BackgroundTasks,
+    FastAPI,
+    HTTPException,
+    Form,
+    UploadFile,
+    File,
+    Header,
+    Query,
+    Request,
+)
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
 import os
 import io
-from typing import Optional
+import re
+import asyncio
+import orjson
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Optional, Tuple
 from PIL import Image
 
 from youtube_module import process_youtube_video
@@ -14,14 +30,32 @@ from threads_module import process_threads_article
 from medium_module import process_medium_article
 from ai_processor import AIProcessor
 from astra_db_handler import AstraDBHandler
+from exporter import ARROW_FORMATS, iter_arrow, iter_ndjson, pyarrow_available
+from idempotency import IdempotencyConflict, IdempotencyStore, request_fingerprint
+from metrics import current_platform, metrics_payload
+from scheduler import Scheduler, lane_for
+from tracing import create_profiler, current_trace, start_trace
+from upstream_governor import governor
+from workspace import workspace
+import deadline
+import progress
 from dotenv import load_dotenv
 
 load_dotenv()
 
+
+class ORJSONResponse(JSONResponse):
+    """以 orjson 序列化的 JSON 回應，比標準 json 編碼器快"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
 app = FastAPI(
     title="短影音分析API",
     description="智能處理YouTube Shorts、TikTok、Instagram Reels、Threads文章與Medium文章的內容分析，支援自動平台檢測",
     version="2.2.0",
+    default_response_class=ORJSONResponse,
 )
 
 # CORS設定
@@ -33,12 +67,61 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 較大的回應（例如 Medium 全文）以 gzip 壓縮
+app.add_middleware(
+    GZipMiddleware, minimum_size=int(os.getenv("RESPONSE_GZIP_MIN_SIZE", "1024"))
+)
+
+# 客戶端提供的 request id 只接受安全字元（會用於 profile 檔名）
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,128}$")
+
+# 慢請求 profiler（設定 TRACE_PROFILE_THRESHOLD_MS 時啟用）
+profiler = create_profiler()
+
+# Idempotency-Key 只接受安全字元，例如 UUID
+IDEMPOTENCY_KEY_PATTERN = re.compile(r"^[A-Za-z0-9._:-]{1,255}$")
+
+# 重試的處理請求：執行中時等待同一個處理，完成後在保留期限內直接回傳結果
+idempotency_store = IdempotencyStore(
+    max_keys=int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000")),
+    ttl=float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400")),
+)
+
+# 處理流程的排程器：文字、圖片與影片分通道排隊，同一通道內各 user_id 輪流處理
+scheduler = Scheduler.from_env()
+
+# 處理期間檢查用戶端是否斷線的間隔（秒）
+DISCONNECT_POLL_SECONDS = float(os.getenv("PROCESS_DISCONNECT_POLL_SECONDS", "0.5"))
+
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """為每個請求建立追蹤：沿用或產生 X-Request-ID，回應附上各階段的 Server-Timing"""
+    request_id = request.headers.get("x-request-id")
+    if not request_id or not REQUEST_ID_PATTERN.match(request_id):
+        request_id = None
+    trace = start_trace(request_id)
+    if profiler:
+        profiler.begin()
+    try:
+        response = await call_next(request)
+    finally:
+        if profiler:
+            profiler.end(trace)
+    response.headers["X-Request-ID"] = trace.request_id
+    response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+
 # 初始化AI處理器
 ai_processor = AIProcessor()
 
 # 初始化AstraDB處理器
 db_handler = AstraDBHandler()
 
+# 暫存工作目錄的背景清理（過期與超過容量上限的檔案）
+workspace.start()
+
 
 def detect_video_platform(url: str) -> str:
     """
@@ -95,57 +178,244 @@ def detect_video_platform(url: str) -> str:
     return "unknown"
 
 
+# db_storage 預設只回傳的 metadata 欄位（ocr_text、caption 等已在 analysis 中）
+DB_RESPONSE_FIELDS = [
+    "document_id",
+    "user_id",
+    "title",
+    "summary",
+    "content_type",
+    "source_type",
+    "filename",
+    "original_path",
+    "upload_time",
+]
+
+
+def shape_db_result(db_result: Optional[Dict], verbose: bool = False) -> Optional[Dict]:
+    """精簡資料庫寫入結果：預設不回傳 $vector 與完整文檔，verbose 時原樣回傳"""
+    if not db_result or verbose:
+        return db_result
+
+    shaped = {
+        key: value for key, value in db_result.items() if key != "storage_result"
+    }
+    document = (db_result.get("storage_result") or {}).get("database_document")
+    if document:
+        metadata = document.get("metadata") or {}
+        shaped["metadata"] = {
+            field: metadata[field] for field in DB_RESPONSE_FIELDS if field in metadata
+        }
+    return shaped
+
+
+def parse_iso_to_epoch_ms(value: Optional[str]) -> Optional[int]:
+    """將 ISO 8601 時間字串轉為 epoch 毫秒；未帶時區時視為伺服器本地時間"""
+    if not value:
+        return None
+    return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+
+def enrich_places_in_background(document_id: str, locations: list):
+    """背景查詢地點詳細資訊，完成後部分更新已儲存的文檔
+
+    在回應送出後執行，使用獨立的期限（ENRICHMENT_DEADLINE_SECONDS）。
+    """
+    deadline.start(float(os.getenv("ENRICHMENT_DEADLINE_SECONDS", "60")))
+    try:
+        fields = ai_processor.lookup_places(locations)
+        # 斷路器開啟或期限不足而略過部分地點時標示為 partial
+        fields["enrichment"] = "partial" if deadline.report() else "done"
+    except Exception as e:
+        print(f"⚠️ 背景補充地點資訊失敗 {document_id}: {e}")
+        fields = {"enrichment": "failed"}
+    try:
+        if not db_handler.update_document_metadata(document_id, fields):
+            print(f"⚠️ 補充地點資訊時找不到文檔（可能已刪除）: {document_id}")
+    except Exception as e:
+        print(f"⚠️ 更新文檔地點資訊失敗 {document_id}: {e}")
+
+
+def schedule_enrichment(
+    background_tasks: BackgroundTasks, ai_result: Dict, db_result: Optional[Dict]
+) -> Optional[Dict]:
+    """延後補充模式：文檔已儲存時排入背景查詢，回傳查詢進度的資訊；
+    未成功儲存時改為直接查詢，回應內容與一般模式相同"""
+    if ai_result.get("enrichment") != "pending":
+        return None
+    locations = ai_result.get("important_location") or []
+    if not db_result or not db_result.get("success"):
+        ai_result.pop("enrichment")
+        ai_result.update(ai_processor.lookup_places(locations))
+        return None
+
+    document_id = db_result["document_id"]
+    background_tasks.add_task(enrich_places_in_background, document_id, locations)
+    return {"status": "pending", "poll": f"/api/enrichment/{document_id}"}
+
+
 # 注意：Vercel部署時不支援靜態檔案掛載，僅供本地開發使用
 # app.mount("/static", StaticFiles(directory="frontend"), name="static")
 
 
-@app.post("/api/process")
-async def process_media(
-    url: Optional[str] = Form(None),
-    store_in_db: bool = Form(True),
-    file: Optional[UploadFile] = File(None),
-    user_id: Optional[str] = Form(None),
-):
-    """處理短影音連結、Threads 文章或圖片上傳 - 自動檢測類型"""
-    print(
-        f"API接收到的參數: url='{url}', file={file.filename if file else None}, store_in_db={store_in_db}, user_id='{user_id}'"
+def start_process_deadline(deadline_seconds: Optional[float]):
+    """設定處理期限：deadline_seconds 只能縮短 PROCESS_DEADLINE_SECONDS"""
+    max_deadline = float(os.getenv("PROCESS_DEADLINE_SECONDS", "120"))
+    deadline.start(
+        min(deadline_seconds, max_deadline) if deadline_seconds else max_deadline
     )
 
+
+def resolve_defer_enrichment(defer_enrichment: Optional[bool], store_in_db: bool) -> bool:
+    if defer_enrichment is None:
+        defer_enrichment = (
+            os.getenv("PROCESS_DEFER_ENRICHMENT", "false").lower() == "true"
+        )
+    # 只有會儲存的請求能在背景補充，否則地點資訊無處可寫
+    return defer_enrichment and store_in_db
+
+
+async def run_idempotent(
+    idempotency_key: Optional[str],
+    user_id: Optional[str],
+    fingerprint: str,
+    factory: Callable[[], Awaitable[Dict]],
+) -> Tuple[Dict, bool]:
+    """有 Idempotency-Key 時重用執行中或已完成的處理，回傳 (回應, 是否為重用的結果)"""
+    if not idempotency_key:
+        return await factory(), False
+    if not IDEMPOTENCY_KEY_PATTERN.match(idempotency_key):
+        raise HTTPException(status_code=400, detail="Idempotency-Key 格式錯誤")
+    # key 依使用者區分，不同使用者剛好使用相同的 key 不會互相影響
+    try:
+        return await idempotency_store.run(
+            f"{user_id or ''}:{idempotency_key}", fingerprint, factory
+        )
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+async def store_shielded(ai_result: Dict, source_type: str, user_id: Optional[str]) -> Dict:
+    """寫入資料庫；已開始的寫入不受用戶端斷線影響，完成後照常回傳
+
+    分析已付費完成，寫入中途放棄只會留下不一致的狀態；取消會在寫入完成後被吸收，
+    處理結果仍會保留給帶相同 Idempotency-Key 的重試。
+    """
+    store = asyncio.ensure_future(
+        asyncio.to_thread(
+            deadline.shielded, db_handler.store_video_data, ai_result, source_type, user_id
+        )
+    )
+    try:
+        return await asyncio.shield(store)
+    except asyncio.CancelledError:
+        print("🔌 用戶端已斷線，等待資料庫寫入完成")
+        return await store
+
+
+async def cancel_on_disconnect(request: Request, awaitable: Awaitable):
+    """執行處理並定期檢查用戶端是否斷線；斷線時取消處理，不再開始新的下載、轉錄或付費呼叫"""
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                print("🔌 用戶端已斷線，取消處理")
+                task.cancel()
+                try:
+                    return await task
+                except asyncio.CancelledError:
+                    raise HTTPException(status_code=499, detail="用戶端已斷線，處理已取消")
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+async def run_process(
+    background_tasks: BackgroundTasks,
+    url: Optional[str],
+    image_bytes: Optional[bytes],
+    filename: Optional[str],
+    content_type: Optional[str],
+    store_in_db: bool,
+    user_id: Optional[str],
+    verbose: bool,
+    timings: bool,
+    defer_enrichment: bool,
+) -> Dict:
+    """/api/process 與 /api/process/stream 共用的處理流程
+
+    同步的處理階段以 asyncio.to_thread 執行（context 會一併複製，期限與追蹤照常生效），
+    不阻塞事件迴圈；各階段完成時送出進度事件，串流端點據此輸出 SSE。
+    平台處理、AI 分析與寫入在排程器分配的名額內執行，排隊時間計入請求期限。
+    """
+    trace = current_trace.get()
+
     # 判斷處理類型：有檔案就是圖片，有URL就是影片
-    if file:
+    if image_bytes is not None:
         # 圖片處理邏輯
         print("檢測到圖片上傳，啟動圖片處理流程")
+        # 每個請求在各自的 context 中執行，設定的平台標籤不會影響其他請求
+        current_platform.set("image")
+        progress.emit("platform", {"source": "image"})
 
         # 檢查檔案類型
-        if not file.content_type or not file.content_type.startswith("image/"):
+        if not content_type or not content_type.startswith("image/"):
             raise HTTPException(status_code=400, detail="請上傳有效的圖片檔案")
 
         try:
-            # 讀取圖片
-            image_bytes = await file.read()
-            image = Image.open(io.BytesIO(image_bytes))
-
-            # 處理圖片 - 使用圖片模組
-            result = process_image_upload(
-                image, file.filename, f"uploaded_image_{file.filename}"
-            )
-
-            # AI處理
-            ai_result = ai_processor.process_video_text(result["ai_input"])
+            async with scheduler.slot("image", user_id):
+                # 讀取圖片
+                image = Image.open(io.BytesIO(image_bytes))
 
-            # 存儲到AstraDB (如果設置了store_in_db)
-            db_result = None
-            if store_in_db:
-                db_result = db_handler.store_video_data(ai_result, "image", user_id)
-
-            return {
-                "success": True,
-                "source": "image",
-                "raw_data": result["raw_output"],
-                "analysis": ai_result,
-                "db_storage": db_result,
-            }
+                # 處理圖片 - 使用圖片模組
+                result = await asyncio.to_thread(
+                    process_image_upload, image, filename, f"uploaded_image_{filename}"
+                )
+                progress.emit(
+                    "transcript",
+                    {
+                        "ocr_text": result["ai_input"].get("ocr_text", ""),
+                        "caption": result["ai_input"].get("caption", ""),
+                    },
+                )
 
+                # AI處理；分析完成後即使接近期限仍會寫入，避免浪費已完成的分析
+                deadline.check("analyze")
+                ai_result = await asyncio.to_thread(
+                    ai_processor.process_video_text,
+                    result["ai_input"],
+                    enrich_places=not defer_enrichment,
+                )
+                progress.emit("analysis", ai_result)
+
+                # 存儲到AstraDB (如果設置了store_in_db)
+                db_result = None
+                if store_in_db:
+                    db_result = await store_shielded(ai_result, "image", user_id)
+                    progress.emit("stored", shape_db_result(db_result, verbose))
+                enrichment = schedule_enrichment(background_tasks, ai_result, db_result)
+
+                response = {
+                    "success": True,
+                    "source": "image",
+                    "raw_data": result["raw_output"],
+                    "analysis": ai_result,
+                    "db_storage": shape_db_result(db_result, verbose),
+                    "skipped_stages": deadline.report(),
+                }
+                if enrichment:
+                    response["enrichment"] = enrichment
+                if timings and trace:
+                    response["timings"] = trace.timings()
+                return response
+
+        except deadline.RequestCancelled:
+            raise HTTPException(status_code=499, detail="用戶端已斷線，處理已取消")
+        except deadline.DeadlineExceeded as e:
+            raise HTTPException(status_code=504, detail=f"處理圖片逾時: {str(e)}")
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"處理圖片時發生錯誤: {str(e)}")
 
@@ -159,53 +429,83 @@ async def process_media(
         # 自動檢測平台
         detected_source = detect_video_platform(url)
         print(f"自動檢測到的平台: {detected_source}")
+        current_platform.set(detected_source)
 
         if detected_source == "unknown":
             raise HTTPException(
                 status_code=400,
                 detail="無法識別的連結格式，請確認連結是否為YouTube Shorts、TikTok、Instagram Reels、Threads 或 Medium",
             )
+        progress.emit("platform", {"source": detected_source})
 
         try:
-            if detected_source == "youtube":
-                result = process_youtube_video(url)
-            elif detected_source == "tiktok":
-                result = await process_tiktok_video(url)
-            elif detected_source == "instagram":
-                result = await process_instagram_reel(url)
-            elif detected_source == "threads":
-                # 處理Threads文章
-                result = await process_threads_article(url)
-            elif detected_source == "medium":
-                # 處理Medium文章
-                result = await process_medium_article(url)
-            else:
-                raise HTTPException(
-                    status_code=400, detail=f"不支援的平台: {detected_source}"
+            async with scheduler.slot(lane_for(detected_source), user_id):
+                if detected_source == "youtube":
+                    result = await asyncio.to_thread(process_youtube_video, url)
+                elif detected_source == "tiktok":
+                    result = await process_tiktok_video(url)
+                elif detected_source == "instagram":
+                    result = await process_instagram_reel(url)
+                elif detected_source == "threads":
+                    # 處理Threads文章
+                    result = await process_threads_article(url)
+                elif detected_source == "medium":
+                    # 處理Medium文章
+                    result = await process_medium_article(url)
+                else:
+                    raise HTTPException(
+                        status_code=400, detail=f"不支援的平台: {detected_source}"
+                    )
+                progress.emit(
+                    "transcript",
+                    {
+                        "ocr_text": result["ai_input"].get("ocr_text", ""),
+                        "caption": result["ai_input"].get("caption", ""),
+                    },
                 )
 
-            # AI處理
-            ai_result = ai_processor.process_video_text(result["ai_input"])
-
-            # 存儲到AstraDB (如果設置了store_in_db)
-            db_result = None
-            if store_in_db:
-                # Threads 和 Medium 視為 article 類型
-                store_type = (
-                    "article"
-                    if detected_source in ["threads", "medium"]
-                    else detected_source
+                # AI處理；分析完成後即使接近期限仍會寫入，避免浪費已完成的分析
+                deadline.check("analyze")
+                ai_result = await asyncio.to_thread(
+                    ai_processor.process_video_text,
+                    result["ai_input"],
+                    enrich_places=not defer_enrichment,
                 )
-                db_result = db_handler.store_video_data(ai_result, store_type, user_id)
-
-            return {
-                "success": True,
-                "source": detected_source,
-                "raw_data": result["raw_output"],
-                "analysis": ai_result,
-                "db_storage": db_result,
-            }
-
+                progress.emit("analysis", ai_result)
+
+                # 存儲到AstraDB (如果設置了store_in_db)
+                db_result = None
+                if store_in_db:
+                    # Threads 和 Medium 視為 article 類型
+                    store_type = (
+                        "article"
+                        if detected_source in ["threads", "medium"]
+                        else detected_source
+                    )
+                    db_result = await store_shielded(ai_result, store_type, user_id)
+                    progress.emit("stored", shape_db_result(db_result, verbose))
+                enrichment = schedule_enrichment(background_tasks, ai_result, db_result)
+
+                response = {
+                    "success": True,
+                    "source": detected_source,
+                    "raw_data": result["raw_output"],
+                    "analysis": ai_result,
+                    "db_storage": shape_db_result(db_result, verbose),
+                    "skipped_stages": deadline.report(),
+                }
+                if enrichment:
+                    response["enrichment"] = enrichment
+                if timings and trace:
+                    response["timings"] = trace.timings()
+                return response
+
+        except deadline.RequestCancelled:
+            raise HTTPException(status_code=499, detail="用戶端已斷線，處理已取消")
+        except deadline.DeadlineExceeded as e:
+            raise HTTPException(status_code=504, detail=f"處理逾時: {str(e)}")
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"處理影片時發生錯誤: {str(e)}")
 
@@ -213,6 +513,296 @@ async def process_media(
         raise HTTPException(status_code=400, detail="請提供影片連結或上傳圖片檔案")
 
 
+@app.post("/api/process")
+async def process_media(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    url: Optional[str] = Form(None),
+    store_in_db: bool = Form(True),
+    file: Optional[UploadFile] = File(None),
+    user_id: Optional[str] = Form(None),
+    verbose: bool = Form(False),
+    timings: bool = Form(False),
+    deadline_seconds: Optional[float] = Form(None, gt=0),
+    defer_enrichment: Optional[bool] = Form(None),
+    idempotency_key: Optional[str] = Header(None),
+):
+    """處理短影音連結、Threads 文章或圖片上傳 - 自動檢測類型
+
+    verbose=true 時 db_storage 會包含完整的資料庫文檔（含 $vector）；
+    timings=true 時回應附上 timings 區塊，列出各階段的開始時間、耗時與結果；
+    deadline_seconds 可縮短處理期限（不超過 PROCESS_DEADLINE_SECONDS），
+    剩餘時間不足時略過選用階段並列於 skipped_stages；
+    defer_enrichment=true（預設值為 PROCESS_DEFER_ENRICHMENT）時 Google Maps 地點查詢
+    改在回應後於背景執行並部分更新已儲存的文檔，進度可由 enrichment.poll 查詢；
+    帶 Idempotency-Key 標頭時，相同 key 的重試會等待原本的處理或直接回傳其結果
+    （回應標頭 Idempotent-Replayed: true），不會重新處理或重複寫入；
+    用戶端在處理完成前斷線時取消處理（已開始的資料庫寫入仍會完成）
+    """
+    trace = current_trace.get()
+    start_process_deadline(deadline_seconds)
+    defer_enrichment = resolve_defer_enrichment(defer_enrichment, store_in_db)
+    print(
+        f"API接收到的參數 [{trace.request_id if trace else '-'}]: url='{url}', file={file.filename if file else None}, store_in_db={store_in_db}, user_id='{user_id}', verbose={verbose}"
+    )
+
+    image_bytes = await file.read() if file else None
+    response, replayed = await cancel_on_disconnect(
+        request,
+        run_idempotent(
+            idempotency_key,
+            user_id,
+            request_fingerprint(url, image_bytes, store_in_db, verbose, timings),
+            lambda: deadline.cancellable(
+                run_process(
+                    background_tasks,
+                    url,
+                    image_bytes,
+                    file.filename if file else None,
+                    file.content_type if file else None,
+                    store_in_db,
+                    user_id,
+                    verbose,
+                    timings,
+                    defer_enrichment,
+                )
+            ),
+        ),
+    )
+    if replayed:
+        return ORJSONResponse(response, headers={"Idempotent-Replayed": "true"})
+    return response
+
+
+@app.post("/api/process/stream")
+async def process_media_stream(
+    url: Optional[str] = Form(None),
+    store_in_db: bool = Form(True),
+    file: Optional[UploadFile] = File(None),
+    user_id: Optional[str] = Form(None),
+    verbose: bool = Form(False),
+    timings: bool = Form(False),
+    deadline_seconds: Optional[float] = Form(None, gt=0),
+    defer_enrichment: Optional[bool] = Form(None),
+    idempotency_key: Optional[str] = Header(None),
+):
+    """與 /api/process 相同的處理流程，以 Server-Sent Events 回報進度
+
+    依序送出 platform、metadata（平台 API 提供的標題、說明等，有才送）、transcript、
+    analysis、stored（store_in_db=true 時）事件，最後以 done（內容與 /api/process 的回應相同）
+    或 error（status_code、detail）結束。帶 Idempotency-Key 且重用既有處理時，
+    先送出 replayed 事件，接著只有 done 或 error。用戶端中途斷線時取消處理。
+    """
+    trace = current_trace.get()
+    start_process_deadline(deadline_seconds)
+    defer_enrichment = resolve_defer_enrichment(defer_enrichment, store_in_db)
+    print(
+        f"API接收到的參數（串流） [{trace.request_id if trace else '-'}]: url='{url}', file={file.filename if file else None}, store_in_db={store_in_db}, user_id='{user_id}'"
+    )
+    # 上傳檔案在回應開始串流前就會關閉，先讀出內容
+    image_bytes = await file.read() if file else None
+    background_tasks = BackgroundTasks()
+    stream = progress.ProgressStream()
+
+    async def run():
+        stream.listen()
+        try:
+            response, replayed = await run_idempotent(
+                idempotency_key,
+                user_id,
+                request_fingerprint(url, image_bytes, store_in_db, verbose, timings),
+                lambda: deadline.cancellable(
+                    run_process(
+                        background_tasks,
+                        url,
+                        image_bytes,
+                        file.filename if file else None,
+                        file.content_type if file else None,
+                        store_in_db,
+                        user_id,
+                        verbose,
+                        timings,
+                        defer_enrichment,
+                    )
+                ),
+            )
+            if replayed:
+                stream.emit("replayed", {"idempotency_key": idempotency_key})
+            stream.emit("done", response)
+        except HTTPException as e:
+            stream.emit("error", {"status_code": e.status_code, "detail": e.detail})
+        except Exception as e:
+            stream.emit("error", {"status_code": 500, "detail": f"處理時發生錯誤: {str(e)}"})
+        finally:
+            stream.close()
+
+    # 處理流程在獨立的 task 中執行（繼承目前 context 的期限與追蹤），事件產生即送出
+    stream.start(run())
+    return StreamingResponse(
+        stream.events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=background_tasks,
+    )
+
+
+@app.get("/api/enrichment/{document_id}")
+async def enrichment_status(document_id: str, user_id: Optional[str] = Query(None)):
+    """查詢延後補充的地點資訊進度（pending / done / partial / failed）與目前的地點欄位"""
+    try:
+        fields = await asyncio.to_thread(db_handler.get_enrichment, document_id)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    if not fields or fields.pop("user_id") != user_id:
+        raise HTTPException(status_code=404, detail=f"未找到文檔: {document_id}")
+    return {"document_id": document_id, "status": fields.pop("enrichment"), **fields}
+
+
+@app.get("/api/search")
+async def search_memories(
+    q: str = Query(..., min_length=1),
+    user_id: str = Query(...),
+    limit: int = Query(10, ge=1, le=50),
+    cursor: Optional[str] = Query(None),
+    content_type: Optional[str] = Query(None),
+    source_type: Optional[str] = Query(None),
+    uploaded_after: Optional[str] = Query(None),
+    uploaded_before: Optional[str] = Query(None),
+    mode: str = Query("vector", pattern="^(vector|hybrid)$"),
+):
+    """以語意搜尋使用者已儲存的內容，透過 next_cursor 取得下一頁
+
+    content_type、source_type 與上傳時間範圍（ISO 8601）會下推到資料庫查詢；
+    mode=hybrid 時另外以關鍵字索引比對店名、菜名等專有名詞並合併排序
+    """
+    try:
+        after_ms = parse_iso_to_epoch_ms(uploaded_after)
+        before_ms = parse_iso_to_epoch_ms(uploaded_before)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="上傳時間格式錯誤，請使用 ISO 8601")
+
+    # 向量化與資料庫查詢是阻塞呼叫，在執行緒中執行，不阻塞事件迴圈（例如進行中的 SSE 串流）
+    result = await asyncio.to_thread(
+        db_handler.search_similar_videos,
+        q.strip(),
+        limit=limit,
+        user_id=user_id,
+        cursor=cursor,
+        content_type=content_type,
+        source_type=source_type,
+        uploaded_after=after_ms,
+        uploaded_before=before_ms,
+        mode=mode,
+    )
+    if not result.get("success"):
+        status_code = 400 if "游標" in result.get("error", "") else 500
+        raise HTTPException(status_code=status_code, detail=result.get("error"))
+    return result
+
+
+@app.get("/api/nearby")
+async def nearby_places(
+    user_id: str = Query(...),
+    lat: Optional[float] = Query(None, ge=-90, le=90),
+    lng: Optional[float] = Query(None, ge=-180, le=180),
+    radius_m: float = Query(1000, gt=0, le=50000),
+    min_lat: Optional[float] = Query(None, ge=-90, le=90),
+    min_lng: Optional[float] = Query(None, ge=-180, le=180),
+    max_lat: Optional[float] = Query(None, ge=-90, le=90),
+    max_lng: Optional[float] = Query(None, ge=-180, le=180),
+    limit: int = Query(20, ge=1, le=200),
+):
+    """查詢使用者已儲存的地點，依距離由近到遠排序
+
+    提供 min_lat/min_lng/max_lat/max_lng 時以矩形範圍查詢（lat/lng 可選，作為距離基準點），
+    否則以 lat/lng 為圓心、radius_m 為半徑查詢
+    """
+    bbox_params = (min_lat, min_lng, max_lat, max_lng)
+    if any(value is not None for value in bbox_params):
+        if any(value is None for value in bbox_params):
+            raise HTTPException(
+                status_code=400, detail="矩形查詢需同時提供 min_lat、min_lng、max_lat、max_lng"
+            )
+        if min_lat > max_lat:
+            raise HTTPException(status_code=400, detail="min_lat 不可大於 max_lat")
+        bbox = bbox_params
+    elif lat is None or lng is None:
+        raise HTTPException(status_code=400, detail="請提供 lat、lng 或矩形範圍")
+    else:
+        bbox = None
+
+    result = await asyncio.to_thread(
+        db_handler.search_nearby,
+        user_id,
+        latitude=lat,
+        longitude=lng,
+        radius_m=radius_m,
+        bbox=bbox,
+        limit=limit,
+    )
+    if not result.get("success"):
+        raise HTTPException(status_code=503, detail=result.get("error"))
+    return result
+
+
+@app.get("/api/export")
+async def export_memories(
+    user_id: str = Query(...),
+    format: str = Query("ndjson", pattern="^(ndjson|parquet|arrow)$"),
+    include_vector: bool = Query(False),
+):
+    """串流匯出使用者的所有內容（NDJSON，或需 pyarrow 的 Parquet / Arrow）"""
+    if format in ARROW_FORMATS and not pyarrow_available():
+        raise HTTPException(status_code=501, detail=f"伺服器未安裝 pyarrow，無法匯出 {format}")
+    if not await asyncio.to_thread(db_handler.initialize_connection):
+        raise HTTPException(status_code=503, detail="無法連接到AstraDB")
+
+    documents = db_handler.export_documents(user_id, include_vector=include_vector)
+    if format in ARROW_FORMATS:
+        content = iter_arrow(documents, format, include_vector=include_vector)
+        media_type = ARROW_FORMATS[format]
+    else:
+        content = iter_ndjson(documents)
+        media_type = "application/x-ndjson"
+
+    extension = "ndjson" if format == "ndjson" else format
+    return StreamingResponse(
+        content,
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="memories-{user_id}.{extension}"'
+        },
+    )
+
+
+@app.post("/api/bulk-delete")
+async def bulk_delete_memories(
+    user_id: str = Form(...),
+    ids: Optional[str] = Form(None),
+):
+    """批次刪除使用者的所有內容，或其中指定的 ids（以逗號分隔）
+
+    以 NDJSON 逐行回報進度，最後一行為 {"done": true, ...} 或 {"error": ...}
+    """
+    id_list = None
+    if ids is not None:
+        id_list = [item.strip() for item in ids.split(",") if item.strip()]
+        if not id_list:
+            raise HTTPException(status_code=400, detail="ids 不可為空")
+
+    return StreamingResponse(
+        iter_ndjson(db_handler.bulk_delete(user_id, id_list)),
+        media_type="application/x-ndjson",
+    )
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 指標：各階段耗時、外部服務錯誤、執行中數量與傳輸量"""
+    payload, content_type = metrics_payload()
+    return Response(content=payload, media_type=content_type)
+
+
 @app.get("/")
 async def root():
     """API根端點"""
@@ -221,6 +811,10 @@ async def root():
         "version": "2.2.0",
         "docs": "/docs",
         "health": "/api/health",
+        "search": "/api/search",
+        "nearby": "/api/nearby",
+        "export": "/api/export",
+        "metrics": "/metrics",
     }
 
 
@@ -228,15 +822,60 @@ async def root():
 async def health_check():
     """健康檢查端點"""
     # 檢查AstraDB連接
-    db_status = "connected" if db_handler.initialize_connection() else "disconnected"
+    db_status = (
+        "connected"
+        if await asyncio.to_thread(db_handler.initialize_connection)
+        else "disconnected"
+    )
 
-    return {
+    health = {
         "status": "healthy",
         "service": "shorts-analysis-api",
         "astra_db": db_status,
+        "vector_store": db_handler.store.name,
         "has_openai_key": bool(os.getenv("OPENAI_API_KEY")),
     }
 
+    # write-behind 模式下回報積壓數量與寫入延遲
+    write_behind_stats = db_handler.write_behind_stats()
+    if write_behind_stats is not None:
+        health["write_behind"] = write_behind_stats
+
+    lexical_index_stats = db_handler.lexical_index_stats()
+    if lexical_index_stats is not None:
+        health["lexical_index"] = lexical_index_stats
+
+    geo_index_stats = db_handler.geo_index_stats()
+    if geo_index_stats is not None:
+        health["geo_index"] = geo_index_stats
+
+    ann_index_stats = db_handler.ann_index_stats()
+    if ann_index_stats is not None:
+        health["ann_index"] = ann_index_stats
+
+    if profiler:
+        health["profiler"] = profiler.stats()
+
+    health["idempotency"] = idempotency_store.stats()
+
+    # 各處理通道的排隊數量、並行數與排隊等待時間
+    health["scheduler"] = scheduler.stats()
+
+    # 暫存工作目錄的位置（tmpfs 或磁碟）與使用量
+    health["workspace"] = await asyncio.to_thread(workspace.stats)
+
+    # 各外部服務的斷路器狀態與自適應並行上限（只列出已呼叫過的服務）
+    health["upstreams"] = governor.stats()
+
+    return health
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """關閉前寫入 ANN 索引快照並停止背景工作"""
+    db_handler.close()
+    workspace.stop()
+
 
 # Cloud Run不需要Mangum處理器，直接運行FastAPI
 
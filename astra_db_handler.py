@@ -1,9 +1,115 @@
 import os
 import uuid
+import base64
+import hashlib
+import json
+import threading
 from datetime import datetime
-from typing import Dict
-from astrapy import DataAPIClient
+from itertools import islice
+from typing import Dict, Iterator, List, Optional
 from langchain_openai import OpenAIEmbeddings
+from ann_index import ANNIndexManager
+from geo_index import GeoIndex, radius_to_bbox
+from lexical_index import LexicalIndex, fuse_and_rerank
+from ttl_cache import TTLCache
+from metrics import stage
+from upstream_governor import governor
+import numpy as np
+from vector_store import (
+    create_vector_store,
+    decode_vector,
+    encode_vector,
+    truncate_embedding,
+)
+from write_behind import WriteBehindLog
+
+# 搜尋結果卡片需要的 metadata 欄位，搜尋時只投影這些欄位
+SEARCH_CARD_FIELDS = [
+    "document_id",
+    "user_id",
+    "title",
+    "summary",
+    "important_time",
+    "important_location",
+    "address",
+    "rating",
+    "location",
+    "original_path",
+    "upload_time",
+    "content_type",
+    "source_type",
+    "filename",
+]
+
+# 記憶體內索引（ANN、關鍵字）快取的欄位：搜尋卡片欄位加上過濾用的上傳時間
+ANN_CARD_FIELDS = SEARCH_CARD_FIELDS + ["upload_timestamp"]
+
+# 延後補充地點資訊時查詢進度需要的 metadata 欄位
+ENRICHMENT_FIELDS = [
+    "user_id",
+    "enrichment",
+    "address",
+    "all_location_details",
+    "rating",
+    "priceLevel",
+    "priceRange",
+    "regularOpeningHours",
+    "location",
+    "websiteUri",
+    "nationalPhoneNumber",
+    "paymentOptions",
+]
+
+
+def build_metadata_filter(
+    user_id: str = None,
+    content_type: str = None,
+    source_type: str = None,
+    uploaded_after: int = None,
+    uploaded_before: int = None,
+) -> Dict:
+    """組合下推到資料庫查詢的 metadata 過濾條件
+
+    Args:
+        uploaded_after / uploaded_before: 上傳時間範圍（epoch 毫秒，含起點不含終點）
+    """
+    conditions = {}
+    if user_id:
+        conditions["metadata.user_id"] = user_id
+    if content_type:
+        conditions["metadata.content_type"] = content_type
+    if source_type:
+        conditions["metadata.source_type"] = source_type
+    time_range = {}
+    if uploaded_after is not None:
+        time_range["$gte"] = uploaded_after
+    if uploaded_before is not None:
+        time_range["$lt"] = uploaded_before
+    if time_range:
+        conditions["metadata.upload_timestamp"] = time_range
+    return conditions
+
+
+def build_combined_text(analysis_result: Dict, source_type: str) -> str:
+    """組合用於向量化的文本（寫入時與重新向量化遷移時共用）"""
+    # 準備向量化文本
+    ocr_text = analysis_result.get("ocr_text", "")
+    caption = analysis_result.get("caption", "")
+    summary = analysis_result.get("summary", "")
+    title = analysis_result.get("title", "")
+
+    combined_text = f"標題：{title}\n摘要：{summary}\n"
+
+    if ocr_text.strip():
+        combined_text += f"文字內容：{ocr_text}\n"
+
+    if caption.strip():
+        if source_type == "image":
+            combined_text += f"圖片描述：{caption}"
+        else:
+            combined_text += f"字幕內容：{caption}"
+
+    return combined_text
 
 
 class AstraDBHandler:
@@ -21,57 +127,398 @@ class AstraDBHandler:
             "ASTRA_DB_COLLECTION_NAME", "image_vectors"
         )
 
-        # 初始化OpenAI嵌入模型
+        # 初始化OpenAI嵌入模型（一律取得完整維度，精簡模式再自行截斷）
+        self.full_dimensions = 1536
         self.embeddings = OpenAIEmbeddings(
             openai_api_key=os.getenv("OPENAI_API_KEY"),
             model="text-embedding-3-small",
-            dimensions=1536,
+            dimensions=self.full_dimensions,
+            # 重試與限速由 upstream governor 統一處理
+            max_retries=0,
+        )
+
+        # 精簡向量模式：EMBEDDING_DIMENSIONS 小於 1536 時，索引向量只保留前段維度並重新正規化
+        self.embedding_dimensions = int(
+            os.getenv("EMBEDDING_DIMENSIONS", str(self.full_dimensions))
         )
+        if not 1 <= self.embedding_dimensions <= self.full_dimensions:
+            raise ValueError(
+                f"EMBEDDING_DIMENSIONS 必須介於 1 到 {self.full_dimensions} 之間"
+            )
+        # 精簡模式下可另存完整向量（metadata.full_vector，不建索引），搜尋時重新排序前幾名候選
+        self.keep_full_vector = (
+            self.embedding_dimensions < self.full_dimensions
+            and os.getenv("EMBEDDING_KEEP_FULL_VECTOR", "false").lower() == "true"
+        )
+        self.rerank_candidates = int(os.getenv("EMBEDDING_RERANK_CANDIDATES", "100"))
+
+        # 向量資料庫後端（VECTOR_STORE_BACKEND=astra|local），預設為 AstraDB
+        self.store = create_vector_store(
+            api_endpoint=self.api_endpoint,
+            token=self.token,
+            collection_name=self.collection_name,
+            dimension=self.embedding_dimensions,
+        )
+
+        # 搜尋快取：查詢向量快取與依使用者失效的結果快取
+        self.query_embedding_cache = TTLCache(
+            maxsize=int(os.getenv("SEARCH_EMBEDDING_CACHE_SIZE", "1024")),
+            ttl=float(os.getenv("SEARCH_EMBEDDING_CACHE_TTL", "86400")),
+        )
+        self.search_result_cache = TTLCache(
+            maxsize=int(os.getenv("SEARCH_RESULT_CACHE_SIZE", "512")),
+            ttl=float(os.getenv("SEARCH_RESULT_CACHE_TTL", "300")),
+        )
+        # 每次向量搜尋取回的候選數，分頁在這個範圍內進行
+        self.search_window = int(os.getenv("SEARCH_WINDOW_SIZE", "50"))
+        # 使用者資料版本號：寫入或刪除時遞增，舊版本的快取結果自然失效
+        self._user_generations = {}
+        self._generation_lock = threading.Lock()
+
+        # write-behind 模式：先寫入本機持久化日誌，背景批次 insert_many 到 AstraDB
+        self.write_behind = None
+        if os.getenv("ASTRA_WRITE_BEHIND", "false").lower() == "true":
+            self.write_behind = WriteBehindLog(
+                path=os.getenv(
+                    "ASTRA_WRITE_BEHIND_PATH", "data/astra_write_behind.db"
+                ),
+                flush_fn=self._flush_documents,
+                batch_size=int(os.getenv("ASTRA_WRITE_BEHIND_BATCH_SIZE", "20")),
+                flush_interval=float(
+                    os.getenv("ASTRA_WRITE_BEHIND_FLUSH_INTERVAL", "1.0")
+                ),
+                max_retries=int(os.getenv("ASTRA_WRITE_BEHIND_MAX_RETRIES", "10")),
+            )
+            self.write_behind.start()
+        # 部分更新、刪除與 write-behind 寫入互斥，避免更新或刪除落在
+        # 「已從日誌讀出、尚未寫入資料庫」的文檔上而遺失（刪除的文檔被寫回）
+        self._update_lock = threading.Lock()
+
+        # 索引監聽器：文檔寫入資料庫或刪除後通知（例如記憶體內 ANN 索引）
+        self._index_listeners = []
+
+        # 記憶體內 ANN 索引：依使用者分片，背景從向量資料庫載入，資料庫仍是唯一真實來源
+        self.ann_index = None
+        if os.getenv("ANN_INDEX_ENABLED", "false").lower() == "true":
+            self.ann_index = ANNIndexManager(
+                dimension=self.embedding_dimensions,
+                card_fields=ANN_CARD_FIELDS,
+                snapshot_dir=os.getenv("ANN_SNAPSHOT_DIR", "data/ann_index"),
+                min_ivf_size=int(os.getenv("ANN_IVF_MIN_SIZE", "2000")),
+                nprobe=int(os.getenv("ANN_NPROBE", "16")),
+                snapshot_interval=float(os.getenv("ANN_SNAPSHOT_INTERVAL", "300")),
+                snapshot_max_age=float(os.getenv("ANN_SNAPSHOT_MAX_AGE", "86400")),
+            )
+            self.add_index_listener(self.ann_index)
+            self.ann_index.start(self.store)
+
+        # 關鍵字索引：hybrid 搜尋模式與向量搜尋結果合併
+        self.lexical_index = None
+        if os.getenv("LEXICAL_INDEX_ENABLED", "false").lower() == "true":
+            self.lexical_index = LexicalIndex(card_fields=ANN_CARD_FIELDS)
+            self.add_index_listener(self.lexical_index)
+            self.lexical_index.start(self.store)
 
-        # 初始化AstraDB客戶端
-        self.client = None
-        self.database = None
-        self.collection = None
+        # 地理索引：每個具經緯度的地點一筆，供 /api/nearby 查詢
+        self.geo_index = None
+        if os.getenv("GEO_INDEX_ENABLED", "false").lower() == "true":
+            self.geo_index = GeoIndex()
+            self.add_index_listener(self.geo_index)
+            self.geo_index.start(self.store)
 
     def initialize_connection(self):
-        """初始化與AstraDB的連接"""
-        try:
-            # 連線前的必要參數檢查
-            if not self.api_endpoint:
-                print("初始化AstraDB連接失敗: 缺少 ASTRA_DB_API_ENDPOINT")
-                return False
-            if not self.token:
-                print(
-                    "初始化AstraDB連接失敗: 缺少 ASTRA_DB_APPLICATION_TOKEN 或 ASTRA_DB_TOKEN"
+        """初始化與向量資料庫的連接"""
+        return self.store.connect()
+
+    def add_index_listener(self, listener):
+        """註冊索引監聽器
+
+        listener 需提供 on_documents_added(documents) 與
+        on_document_removed(document_id, user_id)；寫入的文檔含 $vector 與完整 metadata。
+        """
+        self._index_listeners.append(listener)
+
+    def _notify_documents_added(self, documents: List[Dict]):
+        for listener in self._index_listeners:
+            try:
+                listener.on_documents_added(documents)
+            except Exception as e:
+                print(f"⚠️ 更新索引時發生錯誤: {e}")
+
+    def _notify_document_removed(self, document_id: str, user_id: Optional[str]):
+        for listener in self._index_listeners:
+            try:
+                listener.on_document_removed(document_id, user_id)
+            except Exception as e:
+                print(f"⚠️ 更新索引時發生錯誤: {e}")
+
+    def close(self):
+        """停止背景工作（write-behind flusher、ANN 索引快照）"""
+        if self.write_behind:
+            self.write_behind.stop()
+        if self.ann_index:
+            self.ann_index.stop()
+
+    def _build_document(
+        self,
+        analysis_result: Dict,
+        source_type: str,
+        user_id: str,
+        document_id: str,
+        combined_text: str,
+        embedding=None,
+    ) -> Dict:
+        """依來源類型組成要存入AstraDB的文檔；embedding 為 None 時不含 $vector"""
+        ocr_text = analysis_result.get("ocr_text", "")
+        caption = analysis_result.get("caption", "")
+        summary = analysis_result.get("summary", "")
+        title = analysis_result.get("title", "")
+        uploaded_at = datetime.now()
+
+        # 根據類型準備不同的metadata結構
+        if source_type == "image":
+            # 圖片專用欄位結構
+            filename = analysis_result.get(
+                "filename", f"image_{document_id[:8]}.jpg"
+            )
+            document = {
+                "_id": document_id,
+                "$vector": embedding,
+                "text": combined_text,
+                "metadata": {
+                    "document_id": document_id,
+                    "user_id": user_id,
+                    "filename": filename,
+                    "title": title,
+                    "ocr_text": ocr_text,
+                    "caption": caption,
+                    "summary": summary,
+                    "important_time": analysis_result.get("important_time", ""),
+                    "important_location": analysis_result.get(
+                        "important_location", ""
+                    ),
+                    "address": analysis_result.get("address", ""),
+                    "rating": analysis_result.get("rating"),
+                    "priceLevel": analysis_result.get("priceLevel"),
+                    "priceRange": analysis_result.get("priceRange"),
+                    "regularOpeningHours": analysis_result.get("regularOpeningHours"),
+                    "location": analysis_result.get("location"),
+                    "websiteUri": analysis_result.get("websiteUri"),
+                    "nationalPhoneNumber": analysis_result.get("nationalPhoneNumber"),
+                    "paymentOptions": analysis_result.get("paymentOptions"),
+                    "all_location_details": analysis_result.get("all_location_details"),
+                    "original_path": analysis_result.get("original_path", ""),
+                    "upload_time": uploaded_at.isoformat(),
+                    "upload_timestamp": int(uploaded_at.timestamp() * 1000),
+                    "content_type": "image",
+                },
+            }
+        elif source_type in ["youtube", "tiktok", "instagram"]:
+            # 影片專用欄位結構
+            document = {
+                "_id": document_id,
+                "$vector": embedding,
+                "text": combined_text,
+                "metadata": {
+                    "document_id": document_id,
+                    "user_id": user_id,
+                    "title": title,
+                    "ocr_text": ocr_text,
+                    "caption": caption,
+                    "summary": summary,
+                    "important_time": analysis_result.get("important_time", ""),
+                    "important_location": analysis_result.get(
+                        "important_location", ""
+                    ),
+                    "address": analysis_result.get("address", ""),
+                    "rating": analysis_result.get("rating"),
+                    "priceLevel": analysis_result.get("priceLevel"),
+                    "priceRange": analysis_result.get("priceRange"),
+                    "regularOpeningHours": analysis_result.get("regularOpeningHours"),
+                    "location": analysis_result.get("location"),
+                    "websiteUri": analysis_result.get("websiteUri"),
+                    "nationalPhoneNumber": analysis_result.get("nationalPhoneNumber"),
+                    "paymentOptions": analysis_result.get("paymentOptions"),
+                    "all_location_details": analysis_result.get("all_location_details"),
+                    "original_path": analysis_result.get("original_path", ""),
+                    "source_type": source_type,  # "youtube", "tiktok", "instagram"
+                    "upload_time": uploaded_at.isoformat(),
+                    "upload_timestamp": int(uploaded_at.timestamp() * 1000),
+                    "content_type": "short_video",
+                },
+            }
+        else:
+            # 文章（threads、medium）欄位結構
+            document = {
+                "_id": document_id,
+                "$vector": embedding,
+                "text": combined_text,
+                "metadata": {
+                    "document_id": document_id,
+                    "user_id": user_id,
+                    "title": title,
+                    "ocr_text": ocr_text,
+                    "caption": caption,
+                    "summary": summary,
+                    "important_time": analysis_result.get("important_time", ""),
+                    "important_location": analysis_result.get(
+                        "important_location", ""
+                    ),
+                    "address": analysis_result.get("address", ""),
+                    "rating": analysis_result.get("rating"),
+                    "priceLevel": analysis_result.get("priceLevel"),
+                    "priceRange": analysis_result.get("priceRange"),
+                    "regularOpeningHours": analysis_result.get("regularOpeningHours"),
+                    "location": analysis_result.get("location"),
+                    "websiteUri": analysis_result.get("websiteUri"),
+                    "nationalPhoneNumber": analysis_result.get("nationalPhoneNumber"),
+                    "paymentOptions": analysis_result.get("paymentOptions"),
+                    "all_location_details": analysis_result.get("all_location_details"),
+                    "original_path": analysis_result.get("original_path", ""),
+                    "source_type": source_type,  # threads/article
+                    "upload_time": uploaded_at.isoformat(),
+                    "upload_timestamp": int(uploaded_at.timestamp() * 1000),
+                    "content_type": "article",
+                },
+            }
+
+
+        # 延後補充地點資訊時記錄進度（pending → done / partial / failed）
+        if analysis_result.get("enrichment"):
+            document["metadata"]["enrichment"] = analysis_result["enrichment"]
+
+        if embedding is None:
+            document.pop("$vector")
+        return document
+
+    def _flush_documents(self, documents: List[Dict]) -> Dict[str, str]:
+        """write-behind 背景寫入：批次生成向量後以 insert_many 寫入
+
+        Returns:
+            寫入失敗的 {document_id: 錯誤訊息}
+        """
+        if not self.initialize_connection():
+            raise Exception("無法連接到AstraDB")
+
+        # 重試時部分文檔可能已寫入成功，先排除已存在的文檔
+        existing = self.store.existing_ids(doc["_id"] for doc in documents)
+        documents = [doc for doc in documents if doc["_id"] not in existing]
+        if not documents:
+            return {}
+
+        missing_vector = [doc for doc in documents if "$vector" not in doc]
+        if missing_vector:
+            with stage("embedding", upstream="openai"):
+                vectors = governor.call(
+                    "openai_embeddings",
+                    self.embeddings.embed_documents,
+                    [doc["text"] for doc in missing_vector],
                 )
-                return False
-            print("正在初始化AstraDB連接...")
-
-            # 創建客戶端
-            self.client = DataAPIClient(self.token)
-            self.database = self.client.get_database(self.api_endpoint)
-
-            # 檢查集合是否存在
-            collections = self.database.list_collections()
-            collection_names = [col.name for col in collections]
-
-            # 如果集合不存在，則創建
-            if self.collection_name not in collection_names:
-                print(f"創建新集合: {self.collection_name}")
-                self.collection = self.database.create_collection(
-                    name=self.collection_name,
-                    definition={"vector": {"dimension": 1536, "metric": "cosine"}},
+            for doc, vector in zip(missing_vector, vectors):
+                self._set_vectors(doc, vector)
+
+        with self._update_lock:
+            # 讀出後已從日誌刪除的文檔不再寫入；讀出後才套用到日誌的部分更新
+            # （例如延後補充的地點資訊）一併寫入
+            remaining = []
+            for doc in documents:
+                current = self.write_behind.get(doc["_id"])
+                if current is None:
+                    print(f"🗑️ 文檔在寫入前已刪除，略過: {doc['_id']}")
+                    continue
+                doc["metadata"].update(current.get("metadata") or {})
+                remaining.append(doc)
+            documents = remaining
+            if not documents:
+                return {}
+            with stage("store", upstream=self.store.name):
+                failures = self.store.insert_many(documents)
+        self._notify_documents_added(
+            [doc for doc in documents if doc["_id"] not in failures]
+        )
+
+        for user_id in {
+            doc["metadata"].get("user_id")
+            for doc in documents
+            if doc["_id"] not in failures
+        }:
+            self._invalidate_user_cache(user_id)
+        return failures
+
+    def _index_vector(self, embedding: List[float]) -> List[float]:
+        """完整嵌入轉為索引向量（精簡模式下截斷並重新正規化）"""
+        if self.embedding_dimensions >= self.full_dimensions:
+            return embedding
+        return truncate_embedding(embedding, self.embedding_dimensions)
+
+    def _set_vectors(self, document: Dict, embedding: List[float]):
+        """寫入索引向量，需要時另存完整向量供重新排序"""
+        document["$vector"] = self._index_vector(embedding)
+        if self.keep_full_vector:
+            document["metadata"]["full_vector"] = encode_vector(embedding)
+
+    def _rerank_full_precision(
+        self, query_embedding: List[float], docs: List[Dict]
+    ) -> List[Dict]:
+        """以完整向量重新計算候選的相似度並排序；沒有完整向量的舊文檔沿用原相似度"""
+        full_vectors = {
+            doc["_id"]: doc.get("metadata", {}).get("full_vector") for doc in docs
+        }
+        missing = [document_id for document_id, data in full_vectors.items() if not data]
+        if missing:
+            # ANN 索引只保存精簡向量，完整向量需要一次批次查詢
+            for doc in self.store.find_by_ids(missing, fields=["full_vector"]):
+                full_vectors[doc["_id"]] = (doc.get("metadata") or {}).get("full_vector")
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        reranked = []
+        for doc in docs:
+            data = full_vectors.get(doc["_id"])
+            if data:
+                vector = decode_vector(data)
+                cosine = float(vector @ query / (np.linalg.norm(vector) or 1.0))
+                doc = {**doc, "$similarity": (cosine + 1) / 2}
+            reranked.append(doc)
+        reranked.sort(key=lambda doc: -(doc.get("$similarity") or 0))
+        return reranked
+
+    def _user_generation(self, user_id: Optional[str]) -> int:
+        with self._generation_lock:
+            return self._user_generations.get(user_id, 0)
+
+    def _invalidate_user_cache(self, user_id: Optional[str]):
+        """使該使用者的搜尋結果快取失效"""
+        with self._generation_lock:
+            self._user_generations[user_id] = self._user_generations.get(user_id, 0) + 1
+
+    def _embed_query_cached(self, query: str) -> List[float]:
+        """生成查詢向量，相同查詢重複使用快取"""
+        key = " ".join(query.split()).lower()
+        embedding = self.query_embedding_cache.get(key)
+        if embedding is None:
+            with stage("query_embedding", upstream="openai"):
+                embedding = governor.call(
+                    "openai_embeddings", self.embeddings.embed_query, query
                 )
-            else:
-                print(f"使用現有集合: {self.collection_name}")
-                self.collection = self.database.get_collection(self.collection_name)
+            self.query_embedding_cache.set(key, embedding)
+        return embedding
 
-            print("AstraDB連接初始化完成")
-            return True
+    def write_behind_stats(self) -> Optional[Dict]:
+        """write-behind 積壓數量與寫入延遲；未啟用時回傳 None"""
+        return self.write_behind.stats() if self.write_behind else None
 
-        except Exception as e:
-            print(f"初始化AstraDB連接失敗: {str(e)}")
-            return False
+    def ann_index_stats(self) -> Optional[Dict]:
+        """ANN 索引載入狀態與大小；未啟用時回傳 None"""
+        return self.ann_index.stats() if self.ann_index else None
+
+    def lexical_index_stats(self) -> Optional[Dict]:
+        """關鍵字索引載入狀態與大小；未啟用時回傳 None"""
+        return self.lexical_index.stats() if self.lexical_index else None
+
+    def geo_index_stats(self) -> Optional[Dict]:
+        """地理索引載入狀態與地點數；未啟用時回傳 None"""
+        return self.geo_index.stats() if self.geo_index else None
 
     def store_video_data(
         self, analysis_result: Dict, source_type: str, user_id: str = None
@@ -86,143 +533,52 @@ class AstraDBHandler:
                 - threads/article: 文章類（threads、medium）
             user_id: 使用者 ID（可選）
         """
-        if not self.collection:
-            success = self.initialize_connection()
-            if not success:
-                return {"success": False, "error": "無法連接到AstraDB"}
-
         try:
-            # 準備向量化文本
-            ocr_text = analysis_result.get("ocr_text", "")
-            caption = analysis_result.get("caption", "")
-            summary = analysis_result.get("summary", "")
-            title = analysis_result.get("title", "")
-
-            combined_text = f"標題：{title}\n摘要：{summary}\n"
+            combined_text = build_combined_text(analysis_result, source_type)
+            document_id = str(uuid.uuid4())
 
-            if ocr_text.strip():
-                combined_text += f"文字內容：{ocr_text}\n"
+            # write-behind 模式：文檔寫入本機日誌後立即返回，向量化與寫入由背景批次處理
+            if self.write_behind:
+                document = self._build_document(
+                    analysis_result, source_type, user_id, document_id, combined_text
+                )
+                self.write_behind.enqueue(document)
+                print(f"文檔已寫入 write-behind 日誌，文檔ID: {document_id}")
+                return {
+                    "success": True,
+                    "document_id": document_id,
+                    "queued": True,
+                    "storage_result": {
+                        "database_document": document,
+                        "inserted_id": document_id,
+                    },
+                }
 
-            if caption.strip():
-                if source_type == "image":
-                    combined_text += f"圖片描述：{caption}"
-                else:
-                    combined_text += f"字幕內容：{caption}"
+            if not self.initialize_connection():
+                return {"success": False, "error": "無法連接到AstraDB"}
 
             # 生成向量
             print("正在生成向量...")
-            embedding = self.embeddings.embed_query(combined_text)
-
-            # 準備文檔
-            document_id = str(uuid.uuid4())
-
-            # 根據類型準備不同的metadata結構
-            if source_type == "image":
-                # 圖片專用欄位結構
-                filename = analysis_result.get(
-                    "filename", f"image_{document_id[:8]}.jpg"
+            with stage("embedding", upstream="openai"):
+                embedding = governor.call(
+                    "openai_embeddings", self.embeddings.embed_query, combined_text
                 )
-                document = {
-                    "_id": document_id,
-                    "$vector": embedding,
-                    "text": combined_text,
-                    "metadata": {
-                        "document_id": document_id,
-                        "user_id": user_id,
-                        "filename": filename,
-                        "title": title,
-                        "ocr_text": ocr_text,
-                        "caption": caption,
-                        "summary": summary,
-                        "important_time": analysis_result.get("important_time", ""),
-                        "important_location": analysis_result.get(
-                            "important_location", ""
-                        ),
-                        "address": analysis_result.get("address", ""),
-                        "rating": analysis_result.get("rating"),
-                        "priceLevel": analysis_result.get("priceLevel"),
-                        "priceRange": analysis_result.get("priceRange"),
-                        "regularOpeningHours": analysis_result.get("regularOpeningHours"),
-                        "location": analysis_result.get("location"),
-                        "websiteUri": analysis_result.get("websiteUri"),
-                        "nationalPhoneNumber": analysis_result.get("nationalPhoneNumber"),
-                        "paymentOptions": analysis_result.get("paymentOptions"),
-                        "all_location_details": analysis_result.get("all_location_details"),
-                        "original_path": analysis_result.get("original_path", ""),
-                        "upload_time": datetime.now().isoformat(),
-                        "content_type": "image",
-                    },
-                }
-            elif source_type in ["youtube", "tiktok", "instagram"]:
-                # 影片專用欄位結構
-                document = {
-                    "_id": document_id,
-                    "$vector": embedding,
-                    "text": combined_text,
-                    "metadata": {
-                        "document_id": document_id,
-                        "user_id": user_id,
-                        "title": title,
-                        "ocr_text": ocr_text,
-                        "caption": caption,
-                        "summary": summary,
-                        "important_time": analysis_result.get("important_time", ""),
-                        "important_location": analysis_result.get(
-                            "important_location", ""
-                        ),
-                        "address": analysis_result.get("address", ""),
-                        "rating": analysis_result.get("rating"),
-                        "priceLevel": analysis_result.get("priceLevel"),
-                        "priceRange": analysis_result.get("priceRange"),
-                        "regularOpeningHours": analysis_result.get("regularOpeningHours"),
-                        "location": analysis_result.get("location"),
-                        "websiteUri": analysis_result.get("websiteUri"),
-                        "nationalPhoneNumber": analysis_result.get("nationalPhoneNumber"),
-                        "paymentOptions": analysis_result.get("paymentOptions"),
-                        "all_location_details": analysis_result.get("all_location_details"),
-                        "original_path": analysis_result.get("original_path", ""),
-                        "source_type": source_type,  # "youtube", "tiktok", "instagram"
-                        "upload_time": datetime.now().isoformat(),
-                        "content_type": "short_video",
-                    },
-                }
-            else:
-                # 文章（threads、medium）欄位結構
-                document = {
-                    "_id": document_id,
-                    "$vector": embedding,
-                    "text": combined_text,
-                    "metadata": {
-                        "document_id": document_id,
-                        "user_id": user_id,
-                        "title": title,
-                        "ocr_text": ocr_text,
-                        "caption": caption,
-                        "summary": summary,
-                        "important_time": analysis_result.get("important_time", ""),
-                        "important_location": analysis_result.get(
-                            "important_location", ""
-                        ),
-                        "address": analysis_result.get("address", ""),
-                        "rating": analysis_result.get("rating"),
-                        "priceLevel": analysis_result.get("priceLevel"),
-                        "priceRange": analysis_result.get("priceRange"),
-                        "regularOpeningHours": analysis_result.get("regularOpeningHours"),
-                        "location": analysis_result.get("location"),
-                        "websiteUri": analysis_result.get("websiteUri"),
-                        "nationalPhoneNumber": analysis_result.get("nationalPhoneNumber"),
-                        "paymentOptions": analysis_result.get("paymentOptions"),
-                        "all_location_details": analysis_result.get("all_location_details"),
-                        "original_path": analysis_result.get("original_path", ""),
-                        "source_type": source_type,  # threads/article
-                        "upload_time": datetime.now().isoformat(),
-                        "content_type": "article",
-                    },
-                }
+
+            document = self._build_document(
+                analysis_result,
+                source_type,
+                user_id,
+                document_id,
+                combined_text,
+            )
+            self._set_vectors(document, embedding)
 
             # 存儲到AstraDB
             print("正在存儲到AstraDB...")
-            self.collection.insert_one(document)
+            with stage("store", upstream=self.store.name):
+                self.store.insert_one(document)
+            self._notify_documents_added([document])
+            self._invalidate_user_cache(user_id)
 
             print(f"視頻數據存儲完成，文檔ID: {document_id}")
 
@@ -240,82 +596,474 @@ class AstraDBHandler:
             print(f"存儲視頻數據時發生錯誤: {str(e)}")
             return {"success": False, "error": str(e)}
 
-    def search_similar_videos(self, query: str, limit: int = 5) -> Dict:
-        """根據文本查詢相似視頻"""
-        if not self.collection:
-            success = self.initialize_connection()
-            if not success:
-                return {"success": False, "error": "無法連接到AstraDB"}
+    def update_document_metadata(self, document_id: str, fields: Dict) -> bool:
+        """部分更新文檔的 metadata 欄位（不重新向量化），回傳是否找到文檔
+
+        尚在 write-behind 日誌中的文檔直接更新日誌，已寫入的文檔以 update_one 更新，
+        並重新載入到記憶體索引、使該使用者的搜尋快取失效。
+        """
+        with self._update_lock:
+            queued = bool(
+                self.write_behind and self.write_behind.update_pending(document_id, fields)
+            )
+            updated = 0
+            if self.initialize_connection():
+                with stage("store", upstream=self.store.name):
+                    updated = self.store.update_one(document_id, fields)
+
+        if updated:
+            # 索引需要 $vector 與完整 metadata，重新讀取更新後的文檔
+            documents = list(
+                self.store.iter_documents({"_id": document_id}, include_vector=True)
+            )
+            self._notify_documents_added(documents)
+            for document in documents:
+                self._invalidate_user_cache((document.get("metadata") or {}).get("user_id"))
+        return queued or updated > 0
+
+    def get_enrichment(self, document_id: str) -> Optional[Dict]:
+        """取得文檔的地點補充進度與欄位；找不到文檔時回傳 None"""
+        if self.write_behind:
+            pending = self.write_behind.get(document_id)
+            if pending:
+                metadata = pending.get("metadata") or {}
+                return {field: metadata.get(field) for field in ENRICHMENT_FIELDS}
+
+        if not self.initialize_connection():
+            raise Exception("無法連接到AstraDB")
+        document = self.store.find_one(document_id, fields=ENRICHMENT_FIELDS)
+        if not document:
+            return None
+        metadata = document.get("metadata") or {}
+        return {field: metadata.get(field) for field in ENRICHMENT_FIELDS}
+
+    @staticmethod
+    def _search_fingerprint(query: str, mode: str, search_filter: Dict) -> str:
+        """游標綁定的查詢內容：查詢文字、實際使用的模式與過濾條件"""
+        payload = json.dumps([query, mode, search_filter], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:12]
+
+    @staticmethod
+    def _rank_key(result: Dict) -> tuple:
+        """結果的排序鍵：分數（hybrid 為融合分數，否則為相似度）由高到低，同分依 document_id"""
+        score = result.get("score", result.get("similarity"))
+        return (-(score if score is not None else -1.0), result.get("document_id") or "")
+
+    @staticmethod
+    def _encode_cursor(fingerprint: str, key: tuple) -> str:
+        payload = {"q": fingerprint, "s": -key[0], "d": key[1]}
+        return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
 
+    @staticmethod
+    def _decode_cursor(cursor: str, fingerprint: str) -> tuple:
+        """解析分頁游標，回傳上一頁最後一筆的排序鍵"""
         try:
-            # 生成查詢向量
-            query_embedding = self.embeddings.embed_query(query)
+            payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            key = (-float(payload["s"]), str(payload["d"]))
+        except Exception:
+            raise ValueError("無效的分頁游標")
+        if payload.get("q") != fingerprint:
+            raise ValueError("分頁游標與查詢不符")
+        return key
 
-            # 執行向量搜索
-            results = self.collection.vector_find(
-                vector=query_embedding, limit=limit, fields=["metadata"]
+    def search_similar_videos(
+        self,
+        query: str,
+        limit: int = 5,
+        user_id: str = None,
+        cursor: str = None,
+        content_type: str = None,
+        source_type: str = None,
+        uploaded_after: int = None,
+        uploaded_before: int = None,
+        mode: str = "vector",
+    ) -> Dict:
+        """根據文本查詢相似視頻
+
+        Args:
+            query: 查詢文字
+            limit: 每頁筆數
+            user_id: 只搜尋該使用者的資料（可選）
+            cursor: 上一頁回傳的 next_cursor（可選）
+            content_type / source_type: 內容類型與來源過濾（可選）
+            uploaded_after / uploaded_before: 上傳時間範圍，epoch 毫秒（可選）
+            mode: "vector" 只用向量搜尋；"hybrid" 再合併關鍵字索引的結果
+                （關鍵字索引未就緒時退回 vector）
+        """
+        search_filter = build_metadata_filter(
+            user_id, content_type, source_type, uploaded_after, uploaded_before
+        )
+        if mode == "hybrid" and not (
+            user_id and self.lexical_index and self.lexical_index.ready
+        ):
+            mode = "vector"
+
+        fingerprint = self._search_fingerprint(query, mode, search_filter)
+        try:
+            after = self._decode_cursor(cursor, fingerprint) if cursor else None
+        except ValueError as e:
+            return {"success": False, "error": str(e)}
+
+        cache_key = (
+            user_id,
+            self._user_generation(user_id),
+            query,
+            json.dumps(search_filter, sort_keys=True),
+            mode,
+        )
+        results = self.search_result_cache.get(cache_key)
+
+        if results is None:
+            use_ann = bool(user_id and self.ann_index and self.ann_index.ready)
+            if not use_ann and not self.initialize_connection():
+                return {"success": False, "error": "無法連接到AstraDB"}
+
+            predicate = self._card_predicate(
+                content_type, source_type, uploaded_after, uploaded_before
             )
+            try:
+                # 生成查詢向量（相同查詢使用快取）
+                query_embedding = self._embed_query_cached(query)
+                index_query = self._index_vector(query_embedding)
+                # 保留完整向量時先多取候選，再以完整向量重新排序
+                candidates = (
+                    max(self.search_window, self.rerank_candidates)
+                    if self.keep_full_vector
+                    else self.search_window
+                )
 
-            # 處理結果 - 根據content_type返回不同的欄位
-            formatted_results = []
-            for doc in results:
-                metadata = doc.get("metadata", {})
-                content_type = metadata.get("content_type", "short_video")
-
-                result_item = {
-                    "document_id": metadata.get("document_id"),
-                    "user_id": metadata.get("user_id"),
-                    "title": metadata.get("title"),
-                    "summary": metadata.get("summary"),
-                    "important_time": metadata.get("important_time"),
-                    "important_location": metadata.get("important_location"),
-                    "address": metadata.get("address"),
-                    "rating": metadata.get("rating"),
-                    "priceLevel": metadata.get("priceLevel"),
-                    "priceRange": metadata.get("priceRange"),
-                    "regularOpeningHours": metadata.get("regularOpeningHours"),
-                    "location": metadata.get("location"),
-                    "websiteUri": metadata.get("websiteUri"),
-                    "nationalPhoneNumber": metadata.get("nationalPhoneNumber"),
-                    "paymentOptions": metadata.get("paymentOptions"),
-                    "all_location_details": metadata.get("all_location_details"),
-                    "original_path": metadata.get("original_path"),
-                    "upload_time": metadata.get("upload_time"),
-                    "content_type": content_type,
-                }
+                if use_ann:
+                    # 記憶體內 ANN 索引：卡片 metadata 已快取在分片中，不需查詢資料庫
+                    docs = self._search_ann_index(
+                        index_query, user_id, predicate, candidates
+                    )
+                else:
+                    # 執行向量搜索：過濾條件下推到資料庫，只取回結果卡片需要的欄位
+                    docs = self.store.search(
+                        index_query,
+                        search_filter,
+                        limit=candidates,
+                        fields=SEARCH_CARD_FIELDS
+                        + (["full_vector"] if self.keep_full_vector else []),
+                    )
+
+                if self.keep_full_vector:
+                    docs = self._rerank_full_precision(query_embedding, docs)[
+                        : self.search_window
+                    ]
+
+                results = [
+                    self._result_card(doc.get("metadata", {}), doc.get("$similarity"))
+                    for doc in docs
+                ]
+                if mode == "hybrid":
+                    results = self._fuse_lexical_results(
+                        query, user_id, docs, results, predicate
+                    )
+                # 固定的全序讓游標可以用上一頁最後一筆的（分數, document_id）接續，
+                # 快取過期或重新計算時不會因位移而跳過或重複
+                results.sort(key=self._rank_key)
+
+                self.search_result_cache.set(cache_key, results)
+
+            except Exception as e:
+                print(f"搜索視頻時發生錯誤: {str(e)}")
+                return {"success": False, "error": str(e)}
+
+        if after is not None:
+            results = [result for result in results if self._rank_key(result) > after]
+        page = results[:limit]
+        return {
+            "success": True,
+            "mode": mode,
+            "results": page,
+            "count": len(page),
+            "next_cursor": (
+                self._encode_cursor(fingerprint, self._rank_key(page[-1])) if len(results) > limit else None
+            ),
+        }
+
+    @staticmethod
+    def _result_card(metadata: Dict, similarity: Optional[float]) -> Dict:
+        """搜尋結果卡片 - 根據content_type返回不同的欄位"""
+        content_type = metadata.get("content_type", "short_video")
+
+        result_item = {
+            field: metadata.get(field)
+            for field in SEARCH_CARD_FIELDS
+            if field not in ("filename", "source_type")
+        }
+        result_item["content_type"] = content_type
+        result_item["similarity"] = similarity
+
+        # 根據內容類型添加特定欄位
+        if content_type == "image":
+            result_item["filename"] = metadata.get("filename")
+        else:
+            result_item["source_type"] = metadata.get("source_type")
+        return result_item
+
+    @staticmethod
+    def _card_predicate(
+        content_type: str = None,
+        source_type: str = None,
+        uploaded_after: int = None,
+        uploaded_before: int = None,
+    ):
+        """將過濾條件轉成記憶體內索引用的 card 判斷函式；沒有條件時回傳 None"""
+        if not (
+            content_type
+            or source_type
+            or uploaded_after is not None
+            or uploaded_before is not None
+        ):
+            return None
+
+        def matches(card: Dict) -> bool:
+            if content_type and card.get("content_type") != content_type:
+                return False
+            if source_type and card.get("source_type") != source_type:
+                return False
+            timestamp = card.get("upload_timestamp")
+            if uploaded_after is not None and (timestamp is None or timestamp < uploaded_after):
+                return False
+            if uploaded_before is not None and (timestamp is None or timestamp >= uploaded_before):
+                return False
+            return True
+
+        return matches
+
+    def _search_ann_index(
+        self, query_embedding: List[float], user_id: str, predicate=None, limit: int = None
+    ) -> List[Dict]:
+        """在記憶體內 ANN 索引中搜尋，回傳與 store.search 相同格式的文檔"""
+        hits = self.ann_index.search(
+            user_id, query_embedding, limit or self.search_window, predicate=predicate
+        )
+        # 與 AstraDB 的 cosine $similarity 相同的尺度：(cos + 1) / 2
+        return [
+            {"_id": document_id, "metadata": card, "$similarity": (score + 1) / 2}
+            for document_id, score, card in hits
+        ]
+
+    def _fuse_lexical_results(
+        self,
+        query: str,
+        user_id: str,
+        docs: List[Dict],
+        vector_results: List[Dict],
+        predicate=None,
+    ) -> List[Dict]:
+        """以 RRF 合併向量與關鍵字搜尋結果，並依完整詞組命中重新排序"""
+        hits = self.lexical_index.search(
+            user_id, query, self.search_window, predicate=predicate
+        )
+
+        vector_ids = [doc["_id"] for doc in docs]
+        lexical_ids = [document_id for document_id, _, _ in hits]
+        cards = {doc["_id"]: doc.get("metadata", {}) for doc in docs}
+        by_id = dict(zip(vector_ids, vector_results))
+        for document_id, _, card in hits:
+            cards.setdefault(document_id, card)
+            # 只有關鍵字命中的結果沒有向量相似度
+            by_id.setdefault(document_id, self._result_card(card, None))
 
-                # 根據內容類型添加特定欄位
-                if content_type == "image":
-                    result_item["filename"] = metadata.get("filename")
+        results = []
+        for document_id, score in fuse_and_rerank(
+            query, vector_ids, lexical_ids, cards
+        )[: self.search_window]:
+            result_item = dict(by_id[document_id])
+            result_item["score"] = round(score, 6)
+            results.append(result_item)
+        return results
+
+    def search_nearby(
+        self,
+        user_id: str,
+        latitude: float = None,
+        longitude: float = None,
+        radius_m: float = None,
+        bbox: tuple = None,
+        limit: int = 20,
+    ) -> Dict:
+        """查詢使用者已儲存、位於半徑或矩形範圍內的地點，依距離排序
+
+        Args:
+            latitude / longitude: 圓心（半徑查詢）或距離基準點（矩形查詢，可選）
+            radius_m: 半徑（公尺）
+            bbox: (min_lat, min_lng, max_lat, max_lng)，min_lng > max_lng 表示跨越換日線
+        """
+        if not self.geo_index:
+            return {"success": False, "error": "地理索引未啟用"}
+        if not self.geo_index.ready:
+            return {"success": False, "error": "地理索引載入中，請稍後再試"}
+
+        if bbox is None:
+            bbox = radius_to_bbox(latitude, longitude, radius_m)
+            origin = (latitude, longitude)
+        else:
+            radius_m = None
+            if latitude is not None and longitude is not None:
+                origin = (latitude, longitude)
+            else:
+                min_lat, min_lng, max_lat, max_lng = bbox
+                center_lng = (min_lng + max_lng) / 2
+                if min_lng > max_lng:
+                    center_lng = (center_lng + 360.0) % 360.0 - 180.0
+                origin = ((min_lat + max_lat) / 2, center_lng)
+
+        results = self.geo_index.search(user_id, bbox, origin, radius_m, limit)
+        return {"success": True, "results": results, "count": len(results)}
+
+    def export_documents(
+        self, user_id: str, include_vector: bool = False
+    ) -> Iterator[Dict]:
+        """逐頁串流使用者的所有文檔，記憶體用量與資料量無關
+
+        尚未寫入資料庫的 write-behind 文檔也會匯出（不含向量）。
+        """
+        if not self.initialize_connection():
+            raise Exception("無法連接到AstraDB")
+
+        pending_ids = set()
+        if self.write_behind:
+            for document in self.write_behind.pending_for_user(user_id):
+                pending_ids.add(document["_id"])
+                yield self._export_document(document, include_vector)
+
+        for document in self.store.iter_documents(
+            build_metadata_filter(user_id), include_vector=include_vector
+        ):
+            # 匯出期間剛好被背景寫入的文檔已經匯出過
+            if document["_id"] not in pending_ids:
+                yield self._export_document(document, include_vector)
+
+    @staticmethod
+    def _export_document(document: Dict, include_vector: bool) -> Dict:
+        if include_vector:
+            return document
+        metadata = {
+            key: value
+            for key, value in (document.get("metadata") or {}).items()
+            if key != "full_vector"
+        }
+        return {
+            **{key: value for key, value in document.items() if key != "$vector"},
+            "metadata": metadata,
+        }
+
+    def bulk_delete(
+        self, user_id: str, ids: List[str] = None, page_size: int = 100
+    ) -> Iterator[Dict]:
+        """批次刪除使用者的所有文檔（或其中指定的 ids），每刪除一批回報一次進度
+
+        每批先取得符合條件的文檔 ID，再以 delete_many 一次刪除，並通知索引與快取失效。
+        """
+        # Data API 的 $in 最多接受 100 個值
+        page_size = max(1, min(page_size, 100))
+        deleted = 0
+        queued_removed = 0
+
+        if self.write_behind:
+            # 與 write-behind 寫入互斥：寫入中的文檔會先完成寫入，再由下方的資料庫刪除處理
+            with self._update_lock:
+                if ids is None:
+                    removed = self.write_behind.remove_for_user(user_id)
                 else:
-                    result_item["source_type"] = metadata.get("source_type")
+                    removed = []
+                    for document_id in ids:
+                        pending = self.write_behind.get(document_id)
+                        if pending and pending["metadata"].get("user_id") == user_id:
+                            if self.write_behind.remove(document_id):
+                                removed.append(document_id)
+            queued_removed = len(removed)
+            if removed:
+                yield {"deleted": deleted, "queued_removed": queued_removed}
 
-                formatted_results.append(result_item)
+        if not self.initialize_connection():
+            yield {"error": "無法連接到AstraDB", "deleted": deleted}
+            return
 
-            return {
-                "success": True,
-                "results": formatted_results,
-                "count": len(formatted_results),
-            }
+        user_filter = build_metadata_filter(user_id)
+        if ids is None:
+            # 每次重新查詢第一頁：已刪除的文檔不會再出現，不需維護游標
+            pages = iter(
+                lambda: [
+                    doc["_id"]
+                    for doc in islice(
+                        self.store.iter_documents(
+                            user_filter, fields=["user_id"], page_size=page_size
+                        ),
+                        page_size,
+                    )
+                ],
+                [],
+            )
+        else:
+            pages = (
+                [
+                    doc["_id"]
+                    for doc in self.store.iter_documents(
+                        {**user_filter, "_id": {"$in": ids[start : start + page_size]}},
+                        fields=["user_id"],
+                    )
+                ]
+                for start in range(0, len(ids), page_size)
+            )
 
+        try:
+            for page in pages:
+                if not page:
+                    continue
+                count = self.store.delete_many({"_id": {"$in": page}})
+                if count == 0 and ids is None:
+                    # 避免同一頁反覆出現造成無窮迴圈
+                    raise Exception("刪除未生效，停止批次刪除")
+                deleted += count
+                for document_id in page:
+                    self._notify_document_removed(document_id, user_id)
+                self._invalidate_user_cache(user_id)
+                yield {"deleted": deleted, "queued_removed": queued_removed}
         except Exception as e:
-            print(f"搜索視頻時發生錯誤: {str(e)}")
-            return {"success": False, "error": str(e)}
+            print(f"批次刪除時發生錯誤: {str(e)}")
+            self._invalidate_user_cache(user_id)
+            yield {"error": str(e), "deleted": deleted}
+            return
+
+        print(f"使用者 {user_id} 已批次刪除 {deleted} 筆文檔")
+        yield {"done": True, "deleted": deleted, "queued_removed": queued_removed}
 
     def delete_record(self, document_id: str) -> Dict:
         """刪除指定ID的記錄"""
-        if not self.collection:
-            success = self.initialize_connection()
-            if not success:
-                return {"success": False, "error": "無法連接到AstraDB"}
+        # 尚未寫入資料庫的文檔直接從 write-behind 日誌移除
+        with self._update_lock:
+            queued = bool(self.write_behind and self.write_behind.remove(document_id))
+        if queued:
+            print(f"文檔已從 write-behind 日誌移除: {document_id}")
+
+        if not self.initialize_connection():
+            if queued:
+                return {"success": True, "message": f"文檔已成功刪除: {document_id}"}
+            return {"success": False, "error": "無法連接到AstraDB"}
 
         try:
+            # 取得文檔所屬使用者，以便刪除後讓其搜尋快取失效；
+            # 日誌中的文檔可能在移除前剛被背景寫入資料庫，同樣需要刪除
+            existing = self.store.find_one(document_id, fields=["user_id"])
+            if existing is None and queued:
+                return {"success": True, "message": f"文檔已成功刪除: {document_id}"}
+
             # 執行刪除操作
             print(f"正在刪除文檔 ID: {document_id}...")
-            result = self.collection.delete_one({"_id": document_id})
+            deleted_count = self.store.delete_one(document_id)
 
             # 檢查刪除結果
-            if result.deleted_count > 0:
+            if deleted_count > 0 or queued:
+                owner = (existing.get("metadata") or {}).get("user_id") if existing else None
+                if deleted_count > 0:
+                    self._notify_document_removed(document_id, owner)
+                if existing:
+                    self._invalidate_user_cache(owner)
                 print(f"文檔已成功刪除: {document_id}")
                 return {"success": True, "message": f"文檔已成功刪除: {document_id}"}
             else:
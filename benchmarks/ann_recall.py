@@ -0,0 +1,86 @@
+"""ANN 索引召回率與延遲測試
+
+以合成的分群向量（模擬同一使用者收藏內容的主題分布）建立 IVFShard，
+對照精確搜尋計算 recall@k，並回報查詢延遲的 p50 / p95。
+
+    python benchmarks/ann_recall.py --size 20000 --nprobe 4 8 16
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ann_index import IVFShard  # noqa: E402
+
+
+def synthetic_vectors(size: int, dimension: int, clusters: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimension)).astype(np.float32)
+    labels = rng.integers(clusters, size=size)
+    noise = rng.standard_normal((size, dimension)).astype(np.float32)
+    return centers[labels] + 0.6 * noise
+
+
+def build_shard(vectors: np.ndarray, nprobe: int) -> IVFShard:
+    shard = IVFShard(vectors.shape[1], min_ivf_size=min(2000, len(vectors)), nprobe=nprobe)
+    for index, vector in enumerate(vectors):
+        shard.add(str(index), vector, {})
+    return shard
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=20000)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 8, 16, 32])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    vectors = synthetic_vectors(args.size, args.dimension, args.clusters, args.seed)
+    queries = synthetic_vectors(args.queries, args.dimension, args.clusters, args.seed + 1)
+
+    started = time.perf_counter()
+    shard = build_shard(vectors, args.nprobe[0])
+    print(
+        f"建立索引: {args.size} 筆 × {args.dimension} 維，"
+        f"{len(shard.centroids) if shard.centroids is not None else 0} 個分群，"
+        f"耗時 {time.perf_counter() - started:.1f}s"
+    )
+
+    exact_results = []
+    latencies = []
+    for query in queries:
+        started = time.perf_counter()
+        hits = shard.search(query, args.k, exact=True)
+        latencies.append(time.perf_counter() - started)
+        exact_results.append({document_id for document_id, _, _ in hits})
+    p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+    print(f"{'exact':>10}  recall@{args.k}=1.000  p50={p50:.2f}ms  p95={p95:.2f}ms")
+
+    for nprobe in args.nprobe:
+        shard.nprobe = nprobe
+        recalls = []
+        latencies = []
+        for query, expected in zip(queries, exact_results):
+            started = time.perf_counter()
+            hits = shard.search(query, args.k)
+            latencies.append(time.perf_counter() - started)
+            found = {document_id for document_id, _, _ in hits}
+            recalls.append(len(found & expected) / len(expected))
+        p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+        print(
+            f"{f'nprobe={nprobe}':>10}  recall@{args.k}={np.mean(recalls):.3f}  "
+            f"p50={p50:.2f}ms  p95={p95:.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""精簡向量維度的召回率、延遲與儲存大小
+
+對每個維度設定，以截斷並重新正規化的向量做精確搜尋，與完整 1536 維的結果比較 recall@k；
+另外量測「精簡向量取候選 + 完整向量重新排序」的召回率。查詢集固定（以 --seed 控制）。
+
+預設使用合成向量：各維度的變異數隨索引遞減，模擬 text-embedding-3 以 Matryoshka 方式訓練、
+資訊集中在前段維度的特性。可用 --vectors 指定實際嵌入（N × 1536 的 .npy）取得更準確的數字。
+
+    python benchmarks/embedding_dimensions.py --size 20000 --dimensions 256 512 768 1536
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vector_store import encode_vector  # noqa: E402
+
+
+def synthetic_vectors(size: int, dimension: int, clusters: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    scale = 1.0 / np.sqrt(1.0 + np.arange(dimension) / 64.0)
+    centers = rng.standard_normal((clusters, dimension)) * scale
+    labels = rng.integers(clusters, size=size)
+    vectors = centers[labels] + 0.7 * rng.standard_normal((size, dimension)) * scale
+    return vectors.astype(np.float32)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def top_k(matrix: np.ndarray, query: np.ndarray, k: int) -> np.ndarray:
+    scores = matrix @ query
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vectors", default=None, help="實際嵌入向量（.npy，N × 完整維度）")
+    parser.add_argument("--size", type=int, default=20000)
+    parser.add_argument("--full-dimension", type=int, default=1536)
+    parser.add_argument("--dimensions", type=int, nargs="+", default=[128, 256, 512, 768, 1536])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--rerank-candidates", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.vectors:
+        vectors = np.load(args.vectors).astype(np.float32)
+    else:
+        vectors = synthetic_vectors(args.size, args.full_dimension, 200, args.seed)
+    full = normalize(vectors)
+
+    # 固定查詢集：抽樣文檔加上小幅擾動
+    rng = np.random.default_rng(args.seed + 1)
+    picks = rng.choice(len(full), args.queries, replace=False)
+    noise = rng.standard_normal(full[picks].shape) / np.sqrt(full.shape[1])
+    queries = normalize(full[picks] + 0.3 * noise).astype(np.float32)
+    expected = [set(top_k(full, query, args.k)) for query in queries]
+
+    full_bytes = len(encode_vector(full[0]))
+    print(f"{len(full)} 筆文檔 × {full.shape[1]} 維，{args.queries} 個查詢，recall@{args.k}")
+    print(
+        f"{'維度':>6}  {'recall':>7}  {'+rerank':>7}  {'p50':>8}  {'p95':>8}  "
+        f"{'向量大小':>10}  {'10 萬筆':>8}  {'含完整向量':>10}"
+    )
+    for dimension in args.dimensions:
+        compact = normalize(full[:, :dimension].copy())
+        recalls, rerank_recalls, latencies = [], [], []
+        for query, truth in zip(queries, expected):
+            compact_query = query[:dimension] / (np.linalg.norm(query[:dimension]) or 1.0)
+            started = time.perf_counter()
+            found = top_k(compact, compact_query, args.k)
+            latencies.append(time.perf_counter() - started)
+            recalls.append(len(truth & set(found)) / args.k)
+
+            candidates = top_k(compact, compact_query, min(args.rerank_candidates, len(compact)))
+            reranked = candidates[np.argsort(-(full[candidates] @ query))][: args.k]
+            rerank_recalls.append(len(truth & set(reranked)) / args.k)
+
+        p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+        vector_bytes = dimension * 4
+        print(
+            f"{dimension:>6}  {np.mean(recalls):>7.3f}  {np.mean(rerank_recalls):>7.3f}  "
+            f"{p50:>6.2f}ms  {p95:>6.2f}ms  {vector_bytes:>8} B  "
+            f"{vector_bytes * 100000 / 2**20:>6.0f}MB  "
+            f"{(vector_bytes + full_bytes) * 100000 / 2**20:>8.0f}MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
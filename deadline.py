@@ -0,0 +1,168 @@
+import asyncio
+import os
+import subprocess
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from tracing import record_span
+
+# 選用階段至少需要的剩餘秒數，可用 DEADLINE_MIN_BUDGET_<STAGE> 覆寫
+# whisper：有文字說明時才是選用，預算需涵蓋下載、轉錄與後續的 AI 分析
+STAGE_MIN_BUDGET = {
+    "maps": 2.0,
+    "whisper": 45.0,
+}
+
+# 請求的截止時間（time.monotonic()）；None 表示沒有期限
+current_deadline: ContextVar[Optional[float]] = ContextVar("current_deadline", default=None)
+# 因剩餘時間不足而略過的階段
+skipped_stages: ContextVar[Optional[List[Dict]]] = ContextVar("skipped_stages", default=None)
+# 請求取消旗標（用戶端斷線時設定）；以可變物件保存，已複製 context 的工作執行緒也看得到
+current_cancellation: ContextVar[Optional[threading.Event]] = ContextVar(
+    "current_cancellation", default=None
+)
+
+# 等待外部程式結束時，檢查期限與取消旗標的間隔
+_POLL_INTERVAL = 0.2
+
+
+class DeadlineExceeded(Exception):
+    """請求已超過期限，後續階段不再執行"""
+
+
+class RequestCancelled(DeadlineExceeded):
+    """用戶端已斷線，後續階段不再執行"""
+
+
+def start(seconds: Optional[float]) -> Optional[float]:
+    """在目前 context 設定請求期限（秒），並重設略過階段的紀錄與取消旗標"""
+    deadline = time.monotonic() + seconds if seconds and seconds > 0 else None
+    current_deadline.set(deadline)
+    skipped_stages.set([])
+    current_cancellation.set(threading.Event())
+    return deadline
+
+
+def cancelled() -> bool:
+    event = current_cancellation.get()
+    return event is not None and event.is_set()
+
+
+def remaining() -> Optional[float]:
+    """剩餘秒數；沒有期限時回傳 None"""
+    deadline = current_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def check(stage: str):
+    """請求已取消時拋出 RequestCancelled，期限已過時拋出 DeadlineExceeded"""
+    if cancelled():
+        raise RequestCancelled(f"{stage} 開始前請求已取消")
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(f"{stage} 開始前已超過請求期限")
+
+
+def timeout(default: float, stage: str = "request") -> float:
+    """階段的逾時秒數：不超過原本的預設值與請求剩餘時間"""
+    if cancelled():
+        raise RequestCancelled(f"{stage} 開始前請求已取消")
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded(f"{stage} 開始前已超過請求期限")
+    return min(default, left)
+
+
+def allows(stage: str, reserve: float = None) -> bool:
+    """選用階段是否還有足夠預算；不足時記錄為略過並回傳 False
+
+    reserve 為之後必要階段（向量化、寫入等）保留的秒數。
+    """
+    if cancelled():
+        return False
+    left = remaining()
+    if left is None:
+        return True
+    if reserve is None:
+        reserve = float(os.getenv("PROCESS_DEADLINE_RESERVE_SECONDS", "3"))
+    needed = float(
+        os.getenv(f"DEADLINE_MIN_BUDGET_{stage.upper()}", STAGE_MIN_BUDGET.get(stage, 0.0))
+    )
+    if left - reserve >= needed:
+        return True
+    skip(stage, f"剩餘 {max(left, 0):.1f}s，不足 {needed + reserve:.1f}s")
+    return False
+
+
+def skip(stage: str, reason: str):
+    """記錄略過的階段（同時出現在請求追蹤中）"""
+    skipped = skipped_stages.get()
+    if skipped is not None:
+        skipped.append({"stage": stage, "reason": reason})
+    record_span(stage, time.perf_counter(), 0.0, "skipped")
+    print(f"⏭️ 略過 {stage}: {reason}")
+
+
+def report() -> List[Dict]:
+    return list(skipped_stages.get() or [])
+
+
+def sleep(seconds: float, stage: str = "request"):
+    """同步等待；請求在等待期間被取消時立即拋出 RequestCancelled"""
+    event = current_cancellation.get()
+    if event is None:
+        time.sleep(seconds)
+    elif event.wait(seconds):
+        raise RequestCancelled(f"等待 {stage} 時請求已取消")
+
+
+def run_subprocess(
+    args: List[str], stage: str, default_timeout: float, check_returncode: bool = False, **kwargs
+) -> subprocess.CompletedProcess:
+    """執行外部程式（例如 ffmpeg），逾時或請求取消時終止行程
+
+    與 subprocess.run 相同回傳 CompletedProcess；kwargs 傳給 Popen（stdout、stderr、text 等）。
+    """
+    limit = time.monotonic() + timeout(default_timeout, stage)
+    with subprocess.Popen(args, **kwargs) as process:
+        while True:
+            try:
+                stdout, stderr = process.communicate(timeout=_POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                if not cancelled() and time.monotonic() < limit:
+                    continue
+                process.kill()
+                process.communicate()
+                check(stage)
+                raise subprocess.TimeoutExpired(args, default_timeout)
+    if check_returncode and process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args, stdout, stderr)
+    return subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+
+
+def shielded(func, *args, **kwargs):
+    """執行不受請求取消影響的階段（期限仍然有效），例如已開始的資料庫寫入
+
+    需在 asyncio.to_thread 等已複製 context 的環境中呼叫，才不會影響呼叫端。
+    """
+    current_cancellation.set(None)
+    return func(*args, **kwargs)
+
+
+async def cancellable(awaitable):
+    """執行 awaitable；被取消時同時設定取消旗標，讓工作執行緒中的下載、ffmpeg、
+    外部服務呼叫在下一個檢查點中止"""
+    try:
+        return await awaitable
+    except asyncio.CancelledError:
+        event = current_cancellation.get()
+        if event is not None:
+            event.set()
+        raise
@@ -0,0 +1,117 @@
+import importlib.util
+from typing import Dict, Iterable, Iterator
+
+import orjson
+
+# 欄式匯出格式與對應的 Content-Type（需安裝 pyarrow）
+ARROW_FORMATS = {
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+def pyarrow_available() -> bool:
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def iter_ndjson(documents: Iterable[Dict]) -> Iterator[bytes]:
+    """每份文檔一行 JSON"""
+    for document in documents:
+        yield orjson.dumps(document, option=orjson.OPT_NON_STR_KEYS) + b"\n"
+
+
+class _ChunkSink:
+    """供 pyarrow 寫入的檔案物件，寫入的位元組暫存後由呼叫端逐段取走"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_arrow(
+    documents: Iterable[Dict],
+    format: str,
+    include_vector: bool = False,
+    batch_size: int = 1000,
+) -> Iterator[bytes]:
+    """以 Parquet 或 Arrow IPC stream 格式逐批輸出
+
+    常用於分析的欄位攤平成獨立欄位，完整 metadata 以 JSON 字串保存在 metadata 欄位。
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = [
+        pa.field("document_id", pa.string()),
+        pa.field("user_id", pa.string()),
+        pa.field("content_type", pa.string()),
+        pa.field("source_type", pa.string()),
+        pa.field("title", pa.string()),
+        pa.field("upload_timestamp", pa.int64()),
+        pa.field("text", pa.string()),
+        pa.field("metadata", pa.string()),
+    ]
+    if include_vector:
+        columns.append(pa.field("vector", pa.list_(pa.float32())))
+    schema = pa.schema(columns)
+
+    sink = _ChunkSink()
+    output = pa.PythonFile(sink, mode="w")
+    if format == "parquet":
+        writer = pq.ParquetWriter(output, schema)
+    else:
+        writer = pa.ipc.new_stream(output, schema)
+
+    def write_batch(rows):
+        # 每批寫成一個 row group / record batch，記憶體用量只與 batch_size 有關
+        writer.write_batch(pa.RecordBatch.from_pylist(rows, schema=schema))
+
+    rows = []
+    for document in documents:
+        metadata = document.get("metadata") or {}
+        row = {
+            "document_id": document.get("_id"),
+            "user_id": metadata.get("user_id"),
+            "content_type": metadata.get("content_type"),
+            "source_type": metadata.get("source_type"),
+            "title": metadata.get("title"),
+            "upload_timestamp": metadata.get("upload_timestamp"),
+            "text": document.get("text"),
+            "metadata": orjson.dumps(metadata, option=orjson.OPT_NON_STR_KEYS).decode(),
+        }
+        if include_vector:
+            row["vector"] = document.get("$vector")
+        rows.append(row)
+        if len(rows) >= batch_size:
+            write_batch(rows)
+            rows = []
+            data = sink.take()
+            if data:
+                yield data
+
+    if rows:
+        write_batch(rows)
+    writer.close()
+    output.close()
+    yield sink.take()
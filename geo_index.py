@@ -0,0 +1,358 @@
+import heapq
+import math
+import threading
+import time
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, List, Optional, Tuple
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+# 儲存用的 geohash 精度（約 4.8m × 4.8m），查詢時以前綴範圍掃描較粗的格子
+_STORE_PRECISION = 9
+# 單次查詢最多展開的格子數，超過時改用較粗的精度
+_MAX_CELLS = 64
+_EARTH_RADIUS_M = 6371008.8
+
+# 建立地理索引需要的 metadata 欄位
+GEO_SOURCE_FIELDS = [
+    "user_id",
+    "title",
+    "content_type",
+    "source_type",
+    "original_path",
+    "important_location",
+    "address",
+    "rating",
+    "location",
+    "all_location_details",
+]
+
+
+def geohash_encode(lat: float, lng: float, precision: int = _STORE_PRECISION) -> str:
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lng_range[0] + lng_range[1]) / 2
+            if lng >= mid:
+                value = value * 2 + 1
+                lng_range[0] = mid
+            else:
+                value *= 2
+                lng_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if lat >= mid:
+                value = value * 2 + 1
+                lat_range[0] = mid
+            else:
+                value *= 2
+                lat_range[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_BASE32[value])
+            bits = value = 0
+    return "".join(chars)
+
+
+def _cell_size(precision: int) -> Tuple[float, float]:
+    """回傳該精度 geohash 格子的 (緯度高, 經度寬)，單位為度"""
+    total_bits = 5 * precision
+    lng_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+
+def haversine_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * _EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def radius_to_bbox(lat: float, lng: float, radius_m: float) -> Tuple[float, float, float, float]:
+    """以圓心與半徑計算外接矩形 (min_lat, min_lng, max_lat, max_lng)"""
+    dlat = math.degrees(radius_m / _EARTH_RADIUS_M)
+    min_lat, max_lat = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+    if min_lat <= -90.0 or max_lat >= 90.0:
+        return min_lat, -180.0, max_lat, 180.0
+    dlng = math.degrees(radius_m / (_EARTH_RADIUS_M * math.cos(math.radians(lat))))
+    if dlng >= 180.0:
+        return min_lat, -180.0, max_lat, 180.0
+    min_lng = (lng - dlng + 540.0) % 360.0 - 180.0
+    max_lng = (lng + dlng + 540.0) % 360.0 - 180.0
+    return min_lat, min_lng, max_lat, max_lng
+
+
+def covering_cells(
+    min_lat: float, min_lng: float, max_lat: float, max_lng: float
+) -> List[str]:
+    """找出覆蓋矩形範圍的 geohash 格子（格子數不超過 _MAX_CELLS）
+
+    min_lng > max_lng 表示範圍跨越換日線。
+    """
+    if min_lng > max_lng:
+        # 兩側可能得到相同或互相包含的格子（例如都退回全部掃描的 ""），
+        # 合併時只保留最短的前綴，避免同一筆地點被掃描、回傳兩次
+        merged = []
+        for cell in sorted(
+            set(covering_cells(min_lat, min_lng, max_lat, 180.0))
+            | set(covering_cells(min_lat, -180.0, max_lat, max_lng))
+        ):
+            if not merged or not cell.startswith(merged[-1]):
+                merged.append(cell)
+        return merged
+
+    for precision in range(_STORE_PRECISION, 0, -1):
+        cell_lat, cell_lng = _cell_size(precision)
+        rows = math.floor(max_lat / cell_lat) - math.floor(min_lat / cell_lat) + 1
+        cols = math.floor(max_lng / cell_lng) - math.floor(min_lng / cell_lng) + 1
+        if rows * cols <= _MAX_CELLS:
+            break
+    else:
+        # 範圍大到連單字元格子都超過上限時，直接掃描全部
+        return [""]
+
+    cells = set()
+    lat = min_lat
+    while True:
+        lng = min_lng
+        while True:
+            cells.add(geohash_encode(min(lat, max_lat), min(lng, max_lng), precision))
+            if lng >= max_lng:
+                break
+            lng += cell_lng
+        if lat >= max_lat:
+            break
+        lat += cell_lat
+    return sorted(cells)
+
+
+def _in_bbox(lat: float, lng: float, bbox: Tuple[float, float, float, float]) -> bool:
+    min_lat, min_lng, max_lat, max_lng = bbox
+    if not min_lat <= lat <= max_lat:
+        return False
+    if min_lng <= max_lng:
+        return min_lng <= lng <= max_lng
+    return lng >= min_lng or lng <= max_lng
+
+
+def extract_places(metadata: Dict) -> List[Dict]:
+    """從文檔 metadata 取出所有具經緯度的地點（多地點文檔會有多筆）"""
+    names = metadata.get("important_location") or []
+    addresses = metadata.get("address") or []
+    if isinstance(names, str):
+        names = [names]
+    if isinstance(addresses, str):
+        addresses = [addresses]
+
+    details = metadata.get("all_location_details") or []
+    if not details and metadata.get("location"):
+        details = [
+            {
+                "location": metadata.get("location"),
+                "address": addresses[0] if addresses else "",
+                "rating": metadata.get("rating"),
+            }
+        ]
+
+    places = []
+    for index, detail in enumerate(details):
+        location = (detail or {}).get("location") or {}
+        try:
+            lat = float(location["latitude"])
+            lng = float(location["longitude"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        places.append(
+            {
+                "name": names[index] if index < len(names) else "",
+                "address": detail.get("address", ""),
+                "rating": detail.get("rating"),
+                "latitude": lat,
+                "longitude": lng,
+            }
+        )
+    return places
+
+
+class _UserGeoShard:
+    """單一使用者的地點，以 geohash 排序的列表支援前綴範圍掃描"""
+
+    def __init__(self):
+        self.keys: List[Tuple[str, str, int]] = []
+        self.entries: Dict[Tuple[str, int], Dict] = {}
+        self.documents: Dict[str, List[str]] = {}
+
+    def add(self, document_id: str, card: Dict, places: List[Dict]):
+        self.remove(document_id)
+        hashes = []
+        for slot, place in enumerate(places):
+            geohash = geohash_encode(place["latitude"], place["longitude"])
+            insort(self.keys, (geohash, document_id, slot))
+            self.entries[(document_id, slot)] = {"card": card, "place": place}
+            hashes.append(geohash)
+        if hashes:
+            self.documents[document_id] = hashes
+
+    def remove(self, document_id: str) -> bool:
+        hashes = self.documents.pop(document_id, None)
+        if not hashes:
+            return False
+        for slot, geohash in enumerate(hashes):
+            index = bisect_left(self.keys, (geohash, document_id, slot))
+            if index < len(self.keys) and self.keys[index] == (geohash, document_id, slot):
+                del self.keys[index]
+            self.entries.pop((document_id, slot), None)
+        return True
+
+    def scan(self, prefix: str) -> Iterable[Tuple[str, Dict]]:
+        start = bisect_left(self.keys, (prefix,))
+        for index in range(start, len(self.keys)):
+            geohash, document_id, slot = self.keys[index]
+            if not geohash.startswith(prefix):
+                break
+            yield document_id, self.entries[(document_id, slot)]
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+
+class GeoIndex:
+    """依使用者分片的地點索引（geohash）
+
+    每個具經緯度的地點一筆（all_location_details 中的每個地點各一筆），
+    啟動時背景從向量資料庫載入，之後隨寫入與刪除增量更新。
+    """
+
+    def __init__(self, card_fields: List[str] = None):
+        self.card_fields = card_fields or ["title", "content_type", "source_type", "original_path"]
+        self.shards: Dict[Optional[str], _UserGeoShard] = {}
+        self.ready = False
+        self._lock = threading.RLock()
+        self._removed_while_loading = set()
+        self._thread = None
+
+    def start(self, store):
+        """背景載入所有文檔的地點"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._run, args=(store,), name="geo-index", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, store):
+        try:
+            if not store.connect():
+                raise Exception("無法連接到向量資料庫")
+            self.hydrate(store)
+        except Exception as e:
+            print(f"⚠️ 地理索引載入失敗: {e}")
+
+    def hydrate(self, store):
+        started = time.monotonic()
+        count = 0
+        for document in store.iter_documents({}, fields=GEO_SOURCE_FIELDS):
+            self.add_documents([document])
+            count += 1
+        with self._lock:
+            self.ready = True
+            self._removed_while_loading.clear()
+        print(
+            f"🗺️ 地理索引載入完成: {count} 筆文檔、{self.size()} 個地點，"
+            f"耗時 {time.monotonic() - started:.1f}s"
+        )
+
+    def add_documents(self, documents: Iterable[Dict]):
+        with self._lock:
+            for document in documents:
+                if not self.ready and document["_id"] in self._removed_while_loading:
+                    continue
+                metadata = document.get("metadata") or {}
+                places = extract_places(metadata)
+                if not places:
+                    # 更新後已沒有地點：移除先前的地點，避免仍出現在附近搜尋中
+                    shard = self.shards.get(metadata.get("user_id"))
+                    if shard is not None:
+                        shard.remove(document["_id"])
+                    continue
+                card = {field: metadata.get(field) for field in self.card_fields}
+                shard = self.shards.setdefault(metadata.get("user_id"), _UserGeoShard())
+                shard.add(document["_id"], card, places)
+
+    def remove_document(self, document_id: str, user_id: Optional[str] = None):
+        with self._lock:
+            if not self.ready:
+                self._removed_while_loading.add(document_id)
+            shards = [self.shards[user_id]] if user_id in self.shards else self.shards.values()
+            for shard in shards:
+                if shard.remove(document_id):
+                    break
+
+    def on_documents_added(self, documents: List[Dict]):
+        self.add_documents(documents)
+
+    def on_document_removed(self, document_id: str, user_id: Optional[str] = None):
+        self.remove_document(document_id, user_id)
+
+    def search(
+        self,
+        user_id: Optional[str],
+        bbox: Tuple[float, float, float, float],
+        origin: Tuple[float, float],
+        radius_m: Optional[float] = None,
+        limit: int = 20,
+    ) -> List[Dict]:
+        """回傳範圍內的地點，依與 origin 的距離排序
+
+        Args:
+            bbox: (min_lat, min_lng, max_lat, max_lng)
+            origin: 計算距離的基準點 (lat, lng)
+            radius_m: 有值時只保留距離 origin 不超過此半徑的地點
+        """
+        hits = []
+        with self._lock:
+            shard = self.shards.get(user_id)
+            if shard is None:
+                return []
+            for cell in covering_cells(*bbox):
+                for document_id, entry in shard.scan(cell):
+                    place = entry["place"]
+                    if not _in_bbox(place["latitude"], place["longitude"], bbox):
+                        continue
+                    distance = haversine_m(
+                        origin[0], origin[1], place["latitude"], place["longitude"]
+                    )
+                    if radius_m is not None and distance > radius_m:
+                        continue
+                    hits.append((distance, document_id, entry))
+
+        return [
+            {
+                "document_id": document_id,
+                **entry["card"],
+                "place": entry["place"],
+                "distance_m": round(distance, 1),
+            }
+            for distance, document_id, entry in heapq.nsmallest(
+                limit, hits, key=lambda hit: hit[0]
+            )
+        ]
+
+    def size(self) -> int:
+        with self._lock:
+            return sum(len(shard) for shard in self.shards.values())
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "users": len(self.shards),
+                "places": self.size(),
+            }
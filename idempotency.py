@@ -0,0 +1,112 @@
+import asyncio
+import functools
+import hashlib
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import orjson
+
+from ttl_cache import TTLCache
+
+
+class IdempotencyConflict(Exception):
+    """同一個 Idempotency-Key 搭配了不同的請求內容"""
+
+
+def request_fingerprint(
+    url: Optional[str],
+    image_bytes: Optional[bytes],
+    store_in_db: bool,
+    verbose: bool = False,
+    timings: bool = False,
+) -> str:
+    """決定處理結果（含回應內容）的請求內容摘要，用來偵測重複使用的 key"""
+    payload = {
+        "url": (url or "").strip(),
+        "image": hashlib.sha256(image_bytes).hexdigest() if image_bytes is not None else None,
+        "store_in_db": store_in_db,
+        "verbose": verbose,
+        "timings": timings,
+    }
+    return hashlib.sha256(orjson.dumps(payload)).hexdigest()
+
+
+def _cacheable(response: Dict) -> bool:
+    """資料庫寫入失敗的回應不保留，讓重試有機會重新寫入"""
+    db_storage = response.get("db_storage") if isinstance(response, dict) else None
+    return not (isinstance(db_storage, dict) and db_storage.get("success") is False)
+
+
+class IdempotencyStore:
+    """以 Idempotency-Key 避免重試時重複處理與重複寫入
+
+    執行中的 key 讓後到的請求等待同一個 task；成功的回應保留在有容量上限（LRU）
+    與存活時間的快取中，重試時直接回傳。失敗（含逾時、取消）與資料庫寫入失敗
+    （db_storage.success 為 false）的回應不保留，重試時重新處理。
+    所有等待同一個 key 的請求都取消（用戶端斷線）時，才取消共用的 task。
+    只在單一行程的記憶體中，重啟或多個實例之間不共用。
+    """
+
+    def __init__(self, max_keys: int = 10000, ttl: float = 86400):
+        self.results = TTLCache(maxsize=max_keys, ttl=ttl)
+        self._in_flight: Dict[str, Tuple[str, asyncio.Task]] = {}
+        self._waiters: Dict[str, int] = {}
+        self.replayed = 0
+        self.conflicts = 0
+
+    def _check(self, stored_fingerprint: str, fingerprint: str):
+        if stored_fingerprint != fingerprint:
+            self.conflicts += 1
+            raise IdempotencyConflict("Idempotency-Key 已用於內容不同的請求")
+
+    async def run(
+        self, key: str, fingerprint: str, factory: Callable[[], Awaitable[Dict]]
+    ) -> Tuple[Dict, bool]:
+        """執行或重用 key 對應的處理，回傳 (回應, 是否為重用的結果)"""
+        cached = self.results.get(key)
+        if cached is not None:
+            self._check(cached[0], fingerprint)
+            self.replayed += 1
+            return cached[1], True
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self._check(in_flight[0], fingerprint)
+            self.replayed += 1
+            return await self._wait(key, in_flight[1]), True
+
+        task = asyncio.ensure_future(factory())
+        self._in_flight[key] = (fingerprint, task)
+        task.add_done_callback(functools.partial(self._finish, key, fingerprint))
+        return await self._wait(key, task), False
+
+    async def _wait(self, key: str, task: asyncio.Task) -> Dict:
+        """等待共用的 task；shield 讓單一請求被取消時不影響其他仍在等待的請求"""
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters.get(key) == 1 and not task.done():
+                print("🔌 Idempotency-Key 的所有請求都已斷線，取消處理")
+                task.cancel()
+            raise
+        finally:
+            left = self._waiters.get(key, 1) - 1
+            if left > 0:
+                self._waiters[key] = left
+            else:
+                self._waiters.pop(key, None)
+
+    def _finish(self, key: str, fingerprint: str, task: asyncio.Task):
+        self._in_flight.pop(key, None)
+        if not task.cancelled() and task.exception() is None and _cacheable(task.result()):
+            self.results.set(key, (fingerprint, task.result()))
+
+    def stats(self) -> Dict:
+        return {
+            "keys": len(self.results),
+            "in_flight": len(self._in_flight),
+            "max_keys": self.results.maxsize,
+            "ttl_seconds": self.results.ttl,
+            "replayed": self.replayed,
+            "conflicts": self.conflicts,
+        }
@@ -9,7 +9,13 @@ from openai import OpenAI
 import cloudinary
 import cloudinary.uploader
 
+from metrics import instrument, record_bytes, stage
+from upstream_governor import governor
+import deadline
+import progress
 
+
+@instrument("upload", upstream="cloudinary")
 def upload_image_to_cloudinary(image: Image.Image, filename: str = None) -> str:
     """上傳圖片到Cloudinary並返回URL"""
     try:
@@ -31,7 +37,10 @@ def upload_image_to_cloudinary(image: Image.Image, filename: str = None) -> str:
         print(f"正在上傳圖片到Cloudinary: {public_id}")
 
         # 上傳到Cloudinary
-        upload_result = cloudinary.uploader.upload(
+        record_bytes("upload", "cloudinary", img_buffer.getbuffer().nbytes)
+        upload_result = governor.call(
+            "cloudinary",
+            cloudinary.uploader.upload,
             img_buffer.getvalue(),
             public_id=public_id,
             folder="uploaded_images",
@@ -39,6 +48,7 @@ def upload_image_to_cloudinary(image: Image.Image, filename: str = None) -> str:
             format="jpg",
             quality="auto:good",
             fetch_format="auto",
+            timeout=deadline.timeout(60, "upload"),
         )
 
         cloudinary_url = upload_result.get("secure_url")
@@ -51,6 +61,7 @@ def upload_image_to_cloudinary(image: Image.Image, filename: str = None) -> str:
         raise
 
 
+@instrument("extract")
 def process_image_upload(
     image: Image.Image, filename: str = None, original_path: str = ""
 ) -> Dict:
@@ -72,9 +83,10 @@ def process_image_upload(
         # 2. 上傳圖片到Cloudinary獲取URL
         cloudinary_url = upload_image_to_cloudinary(image, filename)
         print(f"圖片已上傳到Cloudinary: {cloudinary_url}")
+        progress.emit("metadata", {"filename": filename, "image_url": cloudinary_url})
 
         # 3. 使用OpenAI進行圖片分析
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
 
         # 編碼圖像
         img_buffer = io.BytesIO()
@@ -83,15 +95,19 @@ def process_image_upload(
         base64_image = base64.b64encode(img_buffer.read()).decode("utf-8")
 
         print("正在調用 OpenAI GPT-4o 進行圖片分析...")
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": """請對這張圖片進行五項分析，並以 JSON 格式回傳：
+        record_bytes("upload", "openai", len(base64_image))
+        with stage("vision", upstream="openai"):
+            response = governor.call(
+                "openai_chat",
+                client.chat.completions.create,
+                model="gpt-4o",
+                messages=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "text",
+                                "text": """請對這張圖片進行五項分析，並以 JSON 格式回傳：
 
 1. OCR 文字辨識：提取圖片中所有可見的文字內容。
 2. 圖片描述：用繁體中文簡潔地描述圖片的主要物件和場景。
@@ -109,21 +125,22 @@ def process_image_upload(
 }
 
 如果圖片中沒有文字，ocr_text 請回傳空字串。""",
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}",
-                                "detail": "high",
                             },
-                        },
-                    ],
-                }
-            ],
-            max_tokens=4096,
-            temperature=0.3,
-            response_format={"type": "json_object"},
-        )
+                            {
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": f"data:image/jpeg;base64,{base64_image}",
+                                    "detail": "high",
+                                },
+                            },
+                        ],
+                    }
+                ],
+                max_tokens=4096,
+                temperature=0.3,
+                response_format={"type": "json_object"},
+                timeout=deadline.timeout(60, "vision"),
+            )
 
         content = response.choices[0].message.content
 
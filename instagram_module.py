@@ -8,6 +8,12 @@ from dotenv import load_dotenv
 import asyncio
 from urllib.parse import quote
 
+from metrics import instrument, record_bytes, record_error, stage
+from upstream_governor import governor
+import deadline
+import progress
+from workspace import workspace
+
 # 載入環境變數
 load_dotenv()
 
@@ -17,59 +23,83 @@ def audio_to_text(video_path: str) -> str:
     base = os.path.splitext(video_path)[0]
     mp3_path = base + "_whisper.mp3"
 
-    # 轉換為mp3
-    subprocess.run(
-        [
-            "ffmpeg",
-            "-y",
-            "-i",
-            video_path,
-            "-vn",
-            "-ac",
-            "1",
-            "-ar",
-            "16000",
-            "-b:a",
-            "192k",
-            mp3_path,
-        ],
-        check=True,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-    )
-
-    # 呼叫Whisper-1
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    with open(mp3_path, "rb") as f:
-        resp = client.audio.transcriptions.create(
-            model="whisper-1",
-            file=f,
-            response_format="text",  # 純文字格式
-            temperature=0.0,  # 最穩定的輸出
-        )
-
-    # 清理臨時檔案
-    os.remove(mp3_path)
+    try:
+        # 轉換為mp3；請求取消或逾時時終止 ffmpeg 行程
+        with stage("ffmpeg", upstream="ffmpeg"):
+            deadline.run_subprocess(
+                [
+                    "ffmpeg",
+                    "-y",
+                    "-i",
+                    video_path,
+                    "-vn",
+                    "-ac",
+                    "1",
+                    "-ar",
+                    "16000",
+                    "-b:a",
+                    "192k",
+                    mp3_path,
+                ],
+                "ffmpeg",
+                120,
+                check_returncode=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+
+        # 呼叫Whisper-1
+        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+        def transcribe():
+            # 重試時重新開檔，從頭上傳
+            with open(mp3_path, "rb") as f:
+                return client.audio.transcriptions.create(
+                    model="whisper-1",
+                    file=f,
+                    response_format="text",  # 純文字格式
+                    temperature=0.0,  # 最穩定的輸出
+                    timeout=deadline.timeout(300, "whisper"),
+                )
+
+        record_bytes("upload", "openai", os.path.getsize(mp3_path))
+        with stage("whisper", upstream="openai"):
+            resp = governor.call("openai_audio", transcribe)
+    finally:
+        # 清理臨時檔案（轉換或轉錄失敗、請求取消時也要清理）
+        if os.path.exists(mp3_path):
+            os.remove(mp3_path)
 
     return resp.strip()  # response_format="text"時返回字符串，不是對象
 
 
+@instrument("download", upstream="instagram_cdn")
 def download_video(url: str, output_path: str) -> bool:
     """下載影片到指定路徑"""
     try:
-        response = requests.get(url, stream=True)
+        response = requests.get(
+            url, stream=True, timeout=deadline.timeout(60, "download")
+        )
         response.raise_for_status()
 
         with open(output_path, "wb") as f:
             for chunk in response.iter_content(chunk_size=8192):
+                # 請求取消或超過期限時中止下載
+                deadline.check("download")
                 f.write(chunk)
+                record_bytes("download", "instagram_cdn", len(chunk))
         return True
     except Exception as e:
+        record_error("instagram_cdn")
         print(f"下載影片失敗: {e}")
+        # 移除下載到一半的檔案
+        if os.path.exists(output_path):
+            os.remove(output_path)
         return False
 
 
-async def process_instagram_reel(url: str, workdir: str = "./shorts_cache") -> Dict:
+@instrument("extract")
+async def process_instagram_reel(url: str) -> Dict:
     """處理Instagram Reels影片"""
     # 驗證URL
     if not url or not url.strip() or not url.startswith(("http://", "https://")):
@@ -82,9 +112,6 @@ async def process_instagram_reel(url: str, workdir: str = "./shorts_cache") -> D
             },
         }
 
-    # 確保工作目錄存在
-    os.makedirs(workdir, exist_ok=True)
-
     # 準備API請求
     api_url = "https://api.scrapecreators.com/v1/instagram/post"
     api_key = os.getenv("X_API_KEY")
@@ -109,9 +136,19 @@ async def process_instagram_reel(url: str, workdir: str = "./shorts_cache") -> D
         encoded_url = quote(normalized_url, safe="")
         full_url = f"{api_url}?url={encoded_url}"
         print(f"完整請求 URL: {full_url}")
-        response = requests.get(full_url, headers={"x-api-key": api_key})
-        print(f"API回應狀態碼: {response.status_code}")
-        response.raise_for_status()
+        with stage("metadata", upstream="scrapecreators"):
+            # 同步的 HTTP 呼叫、下載與轉錄移到執行緒，不阻塞事件迴圈
+            response = await asyncio.to_thread(
+                governor.request,
+                "scrapecreators",
+                "GET",
+                full_url,
+                headers={"x-api-key": api_key},
+                timeout=deadline.timeout(30, "metadata"),
+            )
+            print(f"API回應狀態碼: {response.status_code}")
+            response.raise_for_status()
+        record_bytes("download", "scrapecreators", len(response.content))
         data = response.json()
         print(f"API回應內容: {json.dumps(data, ensure_ascii=False)[:500]}...")
 
@@ -184,19 +221,26 @@ async def process_instagram_reel(url: str, workdir: str = "./shorts_cache") -> D
             if not video_url and "videoUrl" in data:
                 video_url = data["videoUrl"]
 
+        progress.emit(
+            "metadata",
+            {"description": description, "username": username, "video_url": video_url},
+        )
+
         # 如果有影片URL，下載並轉錄
+        # 已有貼文文字時 Whisper 為選用階段，剩餘時間不足就改用貼文文字
         transcription = ""
-        if video_url:
-            video_filename = f"{username}_{url.split('/')[-1]}.mp4"
-            video_path = os.path.join(workdir, video_filename)
-
-            # 下載影片
-            if download_video(video_url, video_path):
-                # 轉錄影片
-                try:
-                    transcription = audio_to_text(video_path)
-                except Exception as e:
-                    print(f"轉錄失敗: {e}")
+        if video_url and (not caption or deadline.allows("whisper")):
+            # 每個工作使用獨立的暫存目錄，結束時（含下載或轉錄失敗、請求取消）整個刪除
+            with workspace.job("instagram") as workdir:
+                video_path = os.path.join(workdir, "video.mp4")
+
+                # 下載影片
+                if await asyncio.to_thread(download_video, video_url, video_path):
+                    # 轉錄影片
+                    try:
+                        transcription = await asyncio.to_thread(audio_to_text, video_path)
+                    except Exception as e:
+                        print(f"轉錄失敗: {e}")
 
         # 如果有轉錄結果，使用它；否則使用caption
         final_caption = transcription if transcription else caption
@@ -0,0 +1,265 @@
+import heapq
+import math
+import re
+import threading
+import time
+import unicodedata
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# 中日韓文字以二元組（bigram）切詞，其餘文字以連續的字母數字為一個詞
+_CJK = "\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3040-\u30ff\uac00-\ud7af"
+_TOKEN_PATTERN = re.compile(rf"[{_CJK}]+|[^\W_{_CJK}]+")
+_CJK_RUN = re.compile(rf"[{_CJK}]")
+
+# 各欄位的詞頻權重（BM25F）：店名、標題命中比內文命中更重要
+FIELD_WEIGHTS = {
+    "title": 3.0,
+    "important_location": 3.0,
+    "summary": 1.5,
+    "ocr_text": 1.0,
+}
+
+_K1 = 1.2
+_B = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    """CJK 感知的切詞：全形轉半形並轉小寫，中日韓文字切成 bigram，其餘以單字為詞"""
+    if not text:
+        return []
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for run in _TOKEN_PATTERN.findall(text):
+        if _CJK_RUN.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i : i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+def _field_text(value) -> str:
+    if isinstance(value, list):
+        return " ".join(str(item) for item in value if item)
+    return str(value or "")
+
+
+def _normalize_phrase(text: str) -> str:
+    """去除空白與標點並轉小寫，用於完整詞組比對"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return "".join(_TOKEN_PATTERN.findall(text))
+
+
+def reciprocal_rank_fusion(rankings: Iterable[List[str]], k: int = 60) -> Dict[str, float]:
+    """RRF：score = Σ 1 / (k + rank)，rank 從 1 起算"""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, document_id in enumerate(ranking, start=1):
+            scores[document_id] = scores.get(document_id, 0.0) + 1.0 / (k + rank)
+    return scores
+
+
+def fuse_and_rerank(
+    query: str,
+    vector_ids: List[str],
+    lexical_ids: List[str],
+    cards: Dict[str, Dict],
+    rrf_k: int = 60,
+    phrase_boost: float = 0.02,
+) -> List[Tuple[str, float]]:
+    """以 RRF 合併向量與關鍵字排名，再依完整詞組命中重新排序
+
+    查詢字串完整出現在標題或地點名稱時加分（約等於多一個第 1 名），
+    讓精確的店名、菜名排在語意相近但名稱不同的結果前面。
+
+    Returns:
+        [(document_id, 分數)]，依分數排序
+    """
+    scores = reciprocal_rank_fusion([vector_ids, lexical_ids], rrf_k)
+    phrase = _normalize_phrase(query)
+    if phrase:
+        for document_id in scores:
+            card = cards.get(document_id) or {}
+            for field in ("title", "important_location"):
+                if phrase in _normalize_phrase(_field_text(card.get(field))):
+                    scores[document_id] += phrase_boost
+                    break
+    return sorted(scores.items(), key=lambda item: -item[1])
+
+
+class _UserLexicalShard:
+    """單一使用者的倒排索引（BM25F）"""
+
+    def __init__(self):
+        self.postings: Dict[str, Dict[str, float]] = {}
+        self.doc_terms: Dict[str, Dict[str, float]] = {}
+        self.doc_lengths: Dict[str, float] = {}
+        self.cards: Dict[str, Dict] = {}
+        self.total_length = 0.0
+
+    def add(self, document_id: str, fields: Dict[str, str], card: Dict):
+        self.remove(document_id)
+        terms: Dict[str, float] = {}
+        length = 0.0
+        for field, weight in FIELD_WEIGHTS.items():
+            tokens = tokenize(fields.get(field, ""))
+            length += weight * len(tokens)
+            for token in tokens:
+                terms[token] = terms.get(token, 0.0) + weight
+        for token, frequency in terms.items():
+            self.postings.setdefault(token, {})[document_id] = frequency
+        self.doc_terms[document_id] = terms
+        self.doc_lengths[document_id] = length
+        self.cards[document_id] = card
+        self.total_length += length
+
+    def remove(self, document_id: str) -> bool:
+        terms = self.doc_terms.pop(document_id, None)
+        if terms is None:
+            return False
+        for token in terms:
+            posting = self.postings.get(token)
+            if posting is not None:
+                posting.pop(document_id, None)
+                if not posting:
+                    del self.postings[token]
+        self.total_length -= self.doc_lengths.pop(document_id)
+        self.cards.pop(document_id, None)
+        return True
+
+    def search(
+        self,
+        query_tokens: List[str],
+        k: int,
+        predicate: Optional[Callable[[Dict], bool]] = None,
+    ) -> List[Tuple[str, float, Dict]]:
+        count = len(self.doc_terms)
+        if not count:
+            return []
+        average_length = self.total_length / count or 1.0
+        scores: Dict[str, float] = {}
+        for token in set(query_tokens):
+            posting = self.postings.get(token)
+            if not posting:
+                continue
+            idf = math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for document_id, frequency in posting.items():
+                norm = _K1 * (1 - _B + _B * self.doc_lengths[document_id] / average_length)
+                scores[document_id] = scores.get(document_id, 0.0) + idf * frequency * (
+                    _K1 + 1
+                ) / (frequency + norm)
+
+        if predicate is not None:
+            scores = {
+                document_id: score
+                for document_id, score in scores.items()
+                if predicate(self.cards[document_id])
+            }
+        top = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(document_id, score, self.cards[document_id]) for document_id, score in top]
+
+    def __len__(self) -> int:
+        return len(self.doc_terms)
+
+
+class LexicalIndex:
+    """依使用者分片的記憶體內關鍵字索引
+
+    索引 title、summary、important_location、ocr_text，啟動時背景從向量資料庫載入，
+    之後隨寫入與刪除增量更新。
+    """
+
+    def __init__(self, card_fields: List[str]):
+        self.card_fields = card_fields
+        self.source_fields = list(
+            dict.fromkeys(card_fields + list(FIELD_WEIGHTS))
+        )
+        self.shards: Dict[Optional[str], _UserLexicalShard] = {}
+        self.ready = False
+        self._lock = threading.RLock()
+        self._removed_while_loading = set()
+        self._thread = None
+
+    def start(self, store):
+        """背景載入所有文檔"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(
+            target=self._run, args=(store,), name="lexical-index", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, store):
+        try:
+            if not store.connect():
+                raise Exception("無法連接到向量資料庫")
+            self.hydrate(store)
+        except Exception as e:
+            print(f"⚠️ 關鍵字索引載入失敗: {e}")
+
+    def hydrate(self, store):
+        started = time.monotonic()
+        count = 0
+        for document in store.iter_documents({}, fields=self.source_fields):
+            self.add_documents([document])
+            count += 1
+        with self._lock:
+            self.ready = True
+            self._removed_while_loading.clear()
+        print(
+            f"🔤 關鍵字索引載入完成: {count} 筆文檔，耗時 {time.monotonic() - started:.1f}s"
+        )
+
+    def add_documents(self, documents: Iterable[Dict]):
+        for document in documents:
+            metadata = document.get("metadata") or {}
+            fields = {field: _field_text(metadata.get(field)) for field in FIELD_WEIGHTS}
+            card = {field: metadata.get(field) for field in self.card_fields}
+            with self._lock:
+                if not self.ready and document["_id"] in self._removed_while_loading:
+                    continue
+                shard = self.shards.setdefault(metadata.get("user_id"), _UserLexicalShard())
+                shard.add(document["_id"], fields, card)
+
+    def remove_document(self, document_id: str, user_id: Optional[str] = None):
+        with self._lock:
+            if not self.ready:
+                self._removed_while_loading.add(document_id)
+            shards = [self.shards[user_id]] if user_id in self.shards else self.shards.values()
+            for shard in shards:
+                if shard.remove(document_id):
+                    break
+
+    def on_documents_added(self, documents: List[Dict]):
+        self.add_documents(documents)
+
+    def on_document_removed(self, document_id: str, user_id: Optional[str] = None):
+        self.remove_document(document_id, user_id)
+
+    def search(
+        self,
+        user_id: Optional[str],
+        query: str,
+        k: int,
+        predicate: Optional[Callable[[Dict], bool]] = None,
+    ) -> List[Tuple[str, float, Dict]]:
+        """回傳 [(document_id, BM25 分數, card)]，依分數排序"""
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        with self._lock:
+            shard = self.shards.get(user_id)
+            if shard is None:
+                return []
+            return shard.search(tokens, k, predicate)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "users": len(self.shards),
+                "documents": sum(len(shard) for shard in self.shards.values()),
+                "terms": sum(len(shard.postings) for shard in self.shards.values()),
+            }
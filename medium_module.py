@@ -1,48 +1,187 @@
 import os
-from typing import Dict
-from tavily import TavilyClient
+import asyncio
+import contextvars
+from typing import Dict, List, Set
+from tavily import AsyncTavilyClient
+from ttl_cache import TTLCache
+from metrics import current_platform, instrument, record_bytes, record_error, stage
+from upstream_governor import governor
+import deadline
 
 
+class TavilyExtractBatcher:
+    """將短時間內多個請求的 Medium URL 合併成一次 Tavily Extract 呼叫
+
+    每個 URL 的結果或失敗原因會分別回傳給對應的呼叫者；
+    成功提取的文章內容依 URL 快取，過期後重新提取；內容為空（付費牆、封鎖）視為失敗，不快取。
+    """
+
+    def __init__(
+        self,
+        window_ms: float = None,
+        max_batch: int = None,
+        cache_ttl: float = None,
+        cache_size: int = None,
+    ):
+        self.window = (
+            window_ms
+            if window_ms is not None
+            else float(os.getenv("MEDIUM_EXTRACT_BATCH_WINDOW_MS", "50"))
+        ) / 1000
+        # Tavily Extract 單次最多接受 20 個 URL
+        self.max_batch = max_batch or int(os.getenv("MEDIUM_EXTRACT_MAX_BATCH", "20"))
+        self.cache = TTLCache(
+            maxsize=cache_size or int(os.getenv("MEDIUM_EXTRACT_CACHE_SIZE", "512")),
+            ttl=cache_ttl or float(os.getenv("MEDIUM_EXTRACT_CACHE_TTL", "3600")),
+        )
+        self._client = None
+        self._pending: Dict[str, List[asyncio.Future]] = {}
+        self._window_task = None
+        # 事件迴圈只保留任務的弱參考，執行中的批次須自行持有，避免被垃圾回收
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _get_client(self) -> AsyncTavilyClient:
+        if self._client is None:
+            api_key = os.getenv("TAVILY_API_KEY")
+            if not api_key:
+                raise ValueError("未設置 TAVILY_API_KEY 環境變數")
+            self._client = AsyncTavilyClient(api_key=api_key)
+        return self._client
+
+    async def extract(self, url: str) -> str:
+        """提取單一文章內容；同一時間窗內的請求會合併送出"""
+        cached = self.cache.get(url)
+        if cached is not None:
+            print(f"✅ 使用快取的 Medium 文章內容: {url}")
+            return cached
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # 同一個 URL 的並行請求共用同一次提取
+        self._pending.setdefault(url, []).append(future)
+
+        if len(self._pending) >= self.max_batch:
+            if self._window_task:
+                self._window_task.cancel()
+                self._window_task = None
+            self._dispatch()
+        elif self._window_task is None:
+            self._window_task = _detached_task(self._dispatch_after_window())
+
+        # 依請求剩餘時間等待；shield 讓逾時的呼叫者不會取消其他人共用的提取
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), deadline.remaining())
+        except asyncio.TimeoutError:
+            raise deadline.DeadlineExceeded("等候 Medium 文章提取時超過請求期限")
+        finally:
+            if not future.done():
+                # 呼叫者已放棄（逾時或取消）：移出等待清單，批次結果不再送給它
+                future.cancel()
+                self._forget(url, future)
+
+    def _forget(self, url: str, future: asyncio.Future):
+        """尚未送出的 URL 沒有其他呼叫者時一併移除，不替已離開的請求提取"""
+        futures = self._pending.get(url)
+        if futures and future in futures:
+            futures.remove(future)
+            if not futures:
+                del self._pending[url]
+
+    async def _dispatch_after_window(self):
+        await asyncio.sleep(self.window)
+        self._window_task = None
+        self._dispatch()
+
+    def _dispatch(self):
+        """取出目前累積的 URL，以背景任務送出一次批次提取"""
+        batch, self._pending = self._pending, {}
+        if batch:
+            task = _detached_task(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch: Dict[str, List[asyncio.Future]]):
+        # 在空白的 context 中執行：批次由多個請求共用，不受觸發它的請求的期限與取消影響
+        current_platform.set("medium")
+        urls = list(batch)
+        print(f"📰 Tavily 批次提取 {len(urls)} 篇文章")
+        try:
+            with stage("tavily_extract", upstream="tavily"):
+                response = await governor.call_async(
+                    "tavily",
+                    self._get_client().extract,
+                    urls=urls,
+                    extract_depth="advanced",
+                    include_images=False,
+                    format="text",
+                )
+        except Exception as e:
+            for futures in batch.values():
+                self._reject(futures, Exception(f"提取失敗: {str(e)}"))
+            return
+
+        # Tavily 回傳的 URL 可能與請求略有差異（例如結尾斜線），以正規化後的 URL 對應
+        results = {
+            _normalize_url(item.get("url", "")): item
+            for item in response.get("results") or []
+        }
+        failed = {
+            _normalize_url(item.get("url", "")): item.get("error", "未知錯誤")
+            for item in response.get("failed_results") or []
+        }
+
+        for url, futures in batch.items():
+            key = _normalize_url(url)
+            content = (results[key].get("raw_content") or "").strip() if key in results else ""
+            if content:
+                record_bytes("download", "tavily", len(content.encode("utf-8")))
+                self.cache.set(url, content)
+                for future in futures:
+                    if not future.done():
+                        future.set_result(content)
+            elif key in failed:
+                record_error("tavily")
+                self._reject(futures, Exception(f"提取失敗: {failed[key]}"))
+            else:
+                self._reject(futures, Exception("未能提取到任何內容"))
+
+    @staticmethod
+    def _reject(futures: List[asyncio.Future], error: Exception):
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+
+def _detached_task(coro) -> asyncio.Task:
+    """在空白的 context 中建立任務，不繼承目前請求的期限、取消旗標與追蹤"""
+    return contextvars.Context().run(asyncio.get_running_loop().create_task, coro)
+
+
+def _normalize_url(url: str) -> str:
+    return url.strip().rstrip("/")
+
+
+# 所有請求共用的提取服務
+extract_batcher = TavilyExtractBatcher()
+
+
+@instrument("scrape")
 async def scrape_medium_article(url: str) -> Dict:
     """使用 Tavily Extract API 爬取 Medium 文章"""
     try:
-        # 從環境變數獲取 API key
-        api_key = os.getenv("TAVILY_API_KEY")
-        if not api_key:
-            raise ValueError("未設置 TAVILY_API_KEY 環境變數")
-        
-        # 初始化 Tavily 客戶端
-        client = TavilyClient(api_key=api_key)
-        
-        # 使用 Tavily Extract API
-        response = client.extract(
-            urls=[url],
-            extract_depth="advanced",
-            include_images=False,
-            format="text"
-        )
-        
-        # 檢查是否有結果
-        if not response.get("results"):
-            if response.get("failed_results"):
-                error_msg = response["failed_results"][0].get("error", "未知錯誤")
-                raise Exception(f"提取失敗: {error_msg}")
-            raise Exception("未能提取到任何內容")
-        
-        # 獲取第一個結果
-        result = response["results"][0]
-        raw_content = result.get("raw_content", "")
-        
+        raw_content = await extract_batcher.extract(url)
+
         # 直接使用 raw_content 作為文章內容（已經是純文字格式）
         return {
-            "content": raw_content.strip(),
+            "content": raw_content,
             "url": url,
         }
-        
+
     except Exception as e:
         raise Exception(f"爬取 Medium 文章失敗: {str(e)}")
 
 
+@instrument("extract")
 async def process_medium_article(url: str) -> Dict:
     """處理 Medium 文章，輸出與其他模組一致的格式
     
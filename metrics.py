@@ -0,0 +1,142 @@
+import asyncio
+import functools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+
+from deadline import RequestCancelled
+from tracing import record_span
+
+# 目前請求所屬的平台（youtube/tiktok/instagram/threads/medium/image），
+# 由 API 入口設定，同一請求內的各階段量測都會帶上這個標籤
+current_platform: ContextVar[str] = ContextVar("current_platform", default="unknown")
+
+# 影片下載、Whisper、LLM 都可能超過數十秒，桶界線涵蓋到 5 分鐘
+_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+STAGE_DURATION = Histogram(
+    "pipeline_stage_duration_seconds",
+    "各處理階段的耗時",
+    ["stage", "platform"],
+    buckets=_LATENCY_BUCKETS,
+)
+STAGE_INFLIGHT = Gauge(
+    "pipeline_stage_inflight",
+    "正在執行中的處理階段數",
+    ["stage"],
+)
+UPSTREAM_ERRORS = Counter(
+    "upstream_errors_total",
+    "外部服務呼叫失敗次數",
+    ["upstream", "platform"],
+)
+UPSTREAM_RETRIES = Counter(
+    "upstream_retries_total",
+    "外部服務呼叫的重試次數",
+    ["upstream"],
+)
+UPSTREAM_CIRCUIT_OPEN = Gauge(
+    "upstream_circuit_open",
+    "外部服務的斷路器是否開啟（1 為開啟，暫停呼叫）",
+    ["upstream"],
+)
+UPSTREAM_CONCURRENCY_LIMIT = Gauge(
+    "upstream_concurrency_limit",
+    "外部服務目前的自適應並行上限",
+    ["upstream"],
+)
+SCHEDULER_QUEUE_WAIT = Histogram(
+    "scheduler_queue_wait_seconds",
+    "處理請求在排程器通道中排隊等待的時間",
+    ["lane"],
+    buckets=_LATENCY_BUCKETS,
+)
+SCHEDULER_QUEUE_DEPTH = Gauge(
+    "scheduler_queue_depth",
+    "排程器通道中排隊等待的請求數",
+    ["lane"],
+)
+SCHEDULER_RUNNING = Gauge(
+    "scheduler_running",
+    "排程器通道中正在處理的請求數",
+    ["lane"],
+)
+BYTES_TRANSFERRED = Counter(
+    "transfer_bytes_total",
+    "與外部服務之間下載 / 上傳的位元組數",
+    ["direction", "upstream", "platform"],
+)
+
+
+def record_error(upstream: str):
+    """記錄一次外部服務失敗（用於吞掉例外、以回傳值表示失敗的函式）"""
+    UPSTREAM_ERRORS.labels(upstream, current_platform.get()).inc()
+
+
+def record_bytes(direction: str, upstream: str, size: int):
+    """記錄下載（download）或上傳（upload）的位元組數"""
+    if size:
+        BYTES_TRANSFERRED.labels(direction, upstream, current_platform.get()).inc(size)
+
+
+@contextmanager
+def stage(name: str, upstream: Optional[str] = None):
+    """量測一段程式碼的耗時並記錄到目前請求的追蹤；
+    指定 upstream 時，例外會計入該服務的失敗次數"""
+    inflight = STAGE_INFLIGHT.labels(name)
+    inflight.inc()
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException as e:
+        # 請求被取消不算外部服務失敗
+        if isinstance(e, (asyncio.CancelledError, RequestCancelled)):
+            outcome = "cancelled"
+        else:
+            outcome = "error"
+            if upstream:
+                record_error(upstream)
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        STAGE_DURATION.labels(name, current_platform.get()).observe(duration)
+        record_span(name, started, duration, outcome)
+        inflight.dec()
+
+
+def instrument(name: str, upstream: Optional[str] = None):
+    """以 stage() 包裝整個函式，同步與 async 函式皆適用"""
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name, upstream):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name, upstream):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def metrics_payload() -> tuple[bytes, str]:
+    """回傳 Prometheus 文字格式的內容與 Content-Type"""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,328 @@
+"""重新向量化並遷移到新集合
+
+更換嵌入模型、向量維度或 build_combined_text 的文字模板後，既有集合無法直接沿用。
+此工具逐頁讀出來源集合的所有文檔，以目前的模板重組文字、批次重新向量化（限制並行數），
+再以 insert_many 寫入新集合。已完成的文檔 ID 記錄在 SQLite 檢查點，中斷後重跑會從上次進度繼續。
+
+    python migrate_embeddings.py --target image_vectors_v2 --model text-embedding-3-small --dimensions 512
+    python migrate_embeddings.py --target image_vectors_v3 --dimensions 256 --keep-full-vector
+    python migrate_embeddings.py --backend local --source data/vector_store --target data/vector_store_v2
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterator, List, Tuple
+
+from dotenv import load_dotenv
+from langchain_openai import OpenAIEmbeddings
+
+from astra_db_handler import build_combined_text
+from vector_store import VectorStore, create_vector_store, encode_vector, truncate_embedding
+
+load_dotenv()
+
+
+class MigrationCheckpoint:
+    """記錄已遷移與失敗的文檔 ID；同一個檢查點只能用於同一組遷移設定"""
+
+    def __init__(self, path: str, config: Dict[str, str]):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS config (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS migrated (
+                document_id TEXT PRIMARY KEY,
+                migrated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS failed (
+                document_id TEXT PRIMARY KEY,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 1
+            );
+            """
+        )
+        saved = dict(self._conn.execute("SELECT key, value FROM config").fetchall())
+        if saved and saved != config:
+            raise ValueError(
+                f"檢查點 {path} 屬於另一組遷移設定 {saved}，請改用其他 --checkpoint 路徑"
+            )
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO config (key, value) VALUES (?, ?)", config.items()
+        )
+        self._conn.commit()
+
+    def is_migrated(self, document_id: str) -> bool:
+        return (
+            self._conn.execute(
+                "SELECT 1 FROM migrated WHERE document_id = ?", (document_id,)
+            ).fetchone()
+            is not None
+        )
+
+    def mark_migrated(self, document_ids: List[str]):
+        now = time.time()
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO migrated (document_id, migrated_at) VALUES (?, ?)",
+            [(document_id, now) for document_id in document_ids],
+        )
+        self._conn.executemany(
+            "DELETE FROM failed WHERE document_id = ?",
+            [(document_id,) for document_id in document_ids],
+        )
+        self._conn.commit()
+
+    def mark_failed(self, failures: Dict[str, str]):
+        self._conn.executemany(
+            "INSERT INTO failed (document_id, error) VALUES (?, ?) "
+            "ON CONFLICT(document_id) DO UPDATE SET error = excluded.error, attempts = attempts + 1",
+            list(failures.items()),
+        )
+        self._conn.commit()
+
+    def counts(self) -> Tuple[int, int]:
+        migrated = self._conn.execute("SELECT COUNT(*) FROM migrated").fetchone()[0]
+        failed = self._conn.execute("SELECT COUNT(*) FROM failed").fetchone()[0]
+        return migrated, failed
+
+
+def source_type_of(metadata: Dict) -> str:
+    """從 metadata 還原 store_video_data 使用的 source_type"""
+    if metadata.get("content_type") == "image":
+        return "image"
+    return metadata.get("source_type") or "article"
+
+
+def rebuild_document(document: Dict) -> Dict:
+    """以目前的文字模板重組文檔（不含 $vector）"""
+    metadata = document.get("metadata") or {}
+    rebuilt = {key: value for key, value in document.items() if key != "$vector"}
+    rebuilt["metadata"] = {
+        key: value for key, value in metadata.items() if key != "full_vector"
+    }
+    rebuilt["text"] = build_combined_text(metadata, source_type_of(metadata))
+    return rebuilt
+
+
+def migrate_batch(
+    documents: List[Dict],
+    embeddings,
+    target: VectorStore,
+    dimension: int = None,
+    keep_full_vector: bool = False,
+    max_retries: int = 3,
+) -> Tuple[List[str], Dict[str, str]]:
+    """向量化並寫入一批文檔，回傳 (成功的 ID, 失敗的 {ID: 錯誤訊息})
+
+    keep_full_vector 時 embeddings 回傳完整維度，索引向量截斷為 dimension 維，
+    完整向量存入 metadata.full_vector（與 AstraDBHandler 的精簡模式相同）。
+    """
+    # 上次中斷前可能已寫入但尚未記錄到檢查點，這些不需重新向量化
+    existing = target.existing_ids(doc["_id"] for doc in documents)
+    pending = [doc for doc in documents if doc["_id"] not in existing]
+    if not pending:
+        return list(existing), {}
+
+    for attempt in range(max_retries):
+        try:
+            vectors = embeddings.embed_documents([doc["text"] for doc in pending])
+            break
+        except Exception as e:
+            if attempt == max_retries - 1:
+                return list(existing), {doc["_id"]: f"向量化失敗: {e}" for doc in pending}
+            time.sleep(2**attempt)
+
+    for doc, vector in zip(pending, vectors):
+        if keep_full_vector:
+            doc["metadata"]["full_vector"] = encode_vector(vector)
+            vector = truncate_embedding(vector, dimension)
+        doc["$vector"] = vector
+    failures = target.insert_many(pending)
+    succeeded = list(existing) + [doc["_id"] for doc in pending if doc["_id"] not in failures]
+    return succeeded, failures
+
+
+def _batches(documents: Iterator[Dict], size: int) -> Iterator[List[Dict]]:
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run_migration(
+    source: VectorStore,
+    target: VectorStore,
+    embeddings,
+    checkpoint: MigrationCheckpoint,
+    batch_size: int = 256,
+    concurrency: int = 4,
+    report_interval: float = 10.0,
+    dimension: int = None,
+    keep_full_vector: bool = False,
+) -> Dict:
+    """執行遷移：主執行緒串流讀取與寫入檢查點，向量化與寫入在執行緒池中並行"""
+    started = time.monotonic()
+    last_report = started
+    stats = {"migrated": 0, "skipped": 0, "failed": 0}
+
+    def remaining_documents() -> Iterator[Dict]:
+        for document in source.iter_documents({}):
+            if checkpoint.is_migrated(document["_id"]):
+                stats["skipped"] += 1
+                continue
+            yield rebuild_document(document)
+
+    def collect(futures):
+        for future in futures:
+            succeeded, failures = future.result()
+            checkpoint.mark_migrated(succeeded)
+            if failures:
+                checkpoint.mark_failed(failures)
+            stats["migrated"] += len(succeeded)
+            stats["failed"] += len(failures)
+
+    def report(final: bool = False):
+        elapsed = time.monotonic() - started
+        rate = stats["migrated"] / elapsed if elapsed else 0.0
+        print(
+            f"{'✅ 遷移完成' if final else '⏳ 遷移中'}: 已遷移 {stats['migrated']}、"
+            f"略過 {stats['skipped']}、失敗 {stats['failed']}，"
+            f"{rate:.1f} docs/s，耗時 {elapsed:.0f}s"
+        )
+
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for batch in _batches(remaining_documents(), batch_size):
+            # 限制進行中的批次數，讀取速度不會超前向量化太多，記憶體用量固定
+            while len(in_flight) >= concurrency:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight.add(
+                executor.submit(
+                    migrate_batch, batch, embeddings, target, dimension, keep_full_vector
+                )
+            )
+
+            if time.monotonic() - last_report >= report_interval:
+                report()
+                last_report = time.monotonic()
+
+        done, _ = wait(in_flight)
+        collect(done)
+
+    report(final=True)
+    elapsed = time.monotonic() - started
+    return {
+        **stats,
+        "elapsed_seconds": round(elapsed, 1),
+        "docs_per_second": round(stats["migrated"] / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="重新向量化並遷移到新集合（可中斷續跑）")
+    parser.add_argument(
+        "--backend",
+        default=os.getenv("VECTOR_STORE_BACKEND", "astra"),
+        help="astra 或 local",
+    )
+    parser.add_argument(
+        "--source",
+        default=None,
+        help="來源集合名稱（astra）或資料目錄（local），預設為目前設定",
+    )
+    parser.add_argument("--target", required=True, help="目標集合名稱（astra）或資料目錄（local）")
+    parser.add_argument("--source-dimensions", type=int, default=1536)
+    parser.add_argument("--model", default="text-embedding-3-small")
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument(
+        "--keep-full-vector",
+        action="store_true",
+        help="取得 --full-dimensions 維的完整向量存入 metadata.full_vector，索引向量截斷為 --dimensions 維",
+    )
+    parser.add_argument("--full-dimensions", type=int, default=1536)
+    parser.add_argument("--batch-size", type=int, default=256, help="每次向量化與 insert_many 的文檔數")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時進行的批次數")
+    parser.add_argument("--checkpoint", default=None, help="檢查點路徑，預設 data/migrations/<target>.db")
+    parser.add_argument("--report-interval", type=float, default=10.0)
+    args = parser.parse_args()
+
+    backend = args.backend.lower()
+    if backend == "local":
+        source_name = args.source or os.getenv("LOCAL_VECTOR_STORE_DIR", "data/vector_store")
+    else:
+        source_name = args.source or os.getenv("ASTRA_DB_COLLECTION_NAME", "image_vectors")
+    if os.path.abspath(source_name) == os.path.abspath(args.target):
+        parser.error("--target 不可與來源相同")
+
+    api_endpoint = os.getenv("ASTRA_DB_API_ENDPOINT")
+    token = os.getenv("ASTRA_DB_TOKEN") or os.getenv("ASTRA_DB_APPLICATION_TOKEN")
+    source = create_vector_store(
+        backend,
+        api_endpoint,
+        token,
+        collection_name=source_name,
+        dimension=args.source_dimensions,
+        directory=source_name,
+    )
+    target = create_vector_store(
+        backend,
+        api_endpoint,
+        token,
+        collection_name=args.target,
+        dimension=args.dimensions,
+        directory=args.target,
+    )
+    if not source.connect() or not target.connect():
+        raise SystemExit("無法連接到向量資料庫")
+
+    checkpoint = MigrationCheckpoint(
+        args.checkpoint
+        or os.path.join("data", "migrations", f"{os.path.basename(args.target.rstrip('/'))}.db"),
+        {
+            "backend": backend,
+            "source": source_name,
+            "target": args.target,
+            "model": args.model,
+            "dimensions": str(args.dimensions),
+            "keep_full_vector": str(args.keep_full_vector),
+        },
+    )
+    migrated, failed = checkpoint.counts()
+    if migrated:
+        print(f"📌 從檢查點繼續：已遷移 {migrated} 筆，待重試 {failed} 筆")
+
+    embeddings = OpenAIEmbeddings(
+        openai_api_key=os.getenv("OPENAI_API_KEY"),
+        model=args.model,
+        dimensions=args.full_dimensions if args.keep_full_vector else args.dimensions,
+        chunk_size=args.batch_size,
+    )
+    run_migration(
+        source,
+        target,
+        embeddings,
+        checkpoint,
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        report_interval=args.report_interval,
+        dimension=args.dimensions,
+        keep_full_vector=args.keep_full_vector,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import asyncio
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable, Dict, Optional
+
+import orjson
+
+# 目前請求的進度監聽者；只有串流端點（/api/process/stream）會設定
+current_listener: ContextVar[Optional[Callable[[str, Dict], None]]] = ContextVar(
+    "progress_listener", default=None
+)
+
+
+def emit(event: str, data: Optional[Dict] = None):
+    """通知目前請求的進度（例如 metadata、transcript）；沒有監聽者時不做事"""
+    listener = current_listener.get()
+    if listener is None:
+        return
+    try:
+        listener(event, data or {})
+    except Exception as e:
+        print(f"⚠️ 送出進度事件 {event} 失敗: {e}")
+
+
+def format_sse(event: str, data: Dict) -> bytes:
+    """組成一則 Server-Sent Event"""
+    payload = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return b"event: " + event.encode() + b"\ndata: " + payload + b"\n\n"
+
+
+class ProgressStream:
+    """將處理進度轉為 SSE 串流
+
+    事件可從事件迴圈或 asyncio.to_thread 的工作執行緒送出，
+    一律透過 call_soon_threadsafe 排入佇列，由 events() 依序輸出。
+    """
+
+    def __init__(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self, coroutine):
+        """在背景 task 執行處理流程（保留參照，避免 task 在串流結束前被回收）"""
+        self.task = asyncio.create_task(coroutine)
+
+    def listen(self):
+        """在目前 context 註冊為進度監聽者（之後建立的執行緒與 task 會繼承）"""
+        current_listener.set(self.emit)
+
+    def emit(self, event: str, data: Dict):
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, (event, data))
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, None)
+
+    async def events(self) -> AsyncIterator[bytes]:
+        try:
+            while True:
+                item = await self._queue.get()
+                if item is None:
+                    return
+                yield format_sse(*item)
+        finally:
+            # 用戶端在處理完成前斷線：串流被中止，一併取消處理
+            if self.task is not None and not self.task.done():
+                self.task.cancel()
@@ -0,0 +1,202 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Optional
+
+import deadline
+from metrics import SCHEDULER_QUEUE_DEPTH, SCHEDULER_QUEUE_WAIT, SCHEDULER_RUNNING
+
+# 各平台所屬的處理通道：文字與圖片是快速通道，可能需要下載與 Whisper 轉錄的影片是慢速通道
+PLATFORM_LANES = {
+    "threads": "text",
+    "medium": "text",
+    "image": "image",
+    "youtube": "video",
+    "tiktok": "video",
+    "instagram": "video",
+}
+
+# 各通道的預設設定：(權重, 最大並行數)
+DEFAULT_LANES = {
+    "text": (4.0, 4),
+    "image": (4.0, 4),
+    "video": (1.0, 2),
+}
+
+
+def lane_for(platform: str) -> str:
+    return PLATFORM_LANES.get(platform, "video")
+
+
+class Lane:
+    """單一處理通道：依 user_id 分開排隊，使用者之間輪流取件"""
+
+    def __init__(self, name: str, weight: float, max_concurrency: int):
+        self.name = name
+        self.weight = max(weight, 0.01)
+        self.max_concurrency = max(max_concurrency, 1)
+        self.running = 0
+        # 虛擬時間：每派發一件加 1 / weight，權重高的通道前進得慢、較常被選中
+        self.virtual_time = 0.0
+        self._queues: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self.queued = 0
+        self.dispatched = 0
+        self.last_wait_ms: Optional[int] = None
+        self.avg_wait_ms: Optional[int] = None
+        self.max_wait_ms = 0
+
+    def eligible(self) -> bool:
+        return self.queued > 0 and self.running < self.max_concurrency
+
+    def push(self, user: str, waiter: asyncio.Future):
+        self._queues.setdefault(user, deque()).append(waiter)
+        self.queued += 1
+
+    def pop(self) -> asyncio.Future:
+        """取出輪到的使用者最早排隊的請求，該使用者移到隊尾"""
+        user, queue = next(iter(self._queues.items()))
+        waiter = queue.popleft()
+        if queue:
+            self._queues.move_to_end(user)
+        else:
+            del self._queues[user]
+        self.queued -= 1
+        return waiter
+
+    def remove(self, user: str, waiter: asyncio.Future):
+        queue = self._queues.get(user)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        if not queue:
+            del self._queues[user]
+        self.queued -= 1
+
+    def record_wait(self, seconds: float):
+        wait_ms = round(seconds * 1000)
+        self.last_wait_ms = wait_ms
+        self.avg_wait_ms = (
+            wait_ms if self.avg_wait_ms is None else round(self.avg_wait_ms * 0.8 + wait_ms * 0.2)
+        )
+        self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+        SCHEDULER_QUEUE_WAIT.labels(self.name).observe(seconds)
+
+    def stats(self) -> Dict:
+        return {
+            "weight": self.weight,
+            "max_concurrency": self.max_concurrency,
+            "running": self.running,
+            "queued": self.queued,
+            "queued_users": len(self._queues),
+            "dispatched": self.dispatched,
+            "last_wait_ms": self.last_wait_ms,
+            "avg_wait_ms": self.avg_wait_ms,
+            "max_wait_ms": self.max_wait_ms,
+        }
+
+
+class Scheduler:
+    """處理流程前的排程器：分通道排隊，以加權公平排程分配共用的處理名額
+
+    總並行數上限為 max_concurrency，每個通道另有自己的並行上限；有空位時派發給
+    虛擬時間最小（依權重分得最少）的通道，通道內依 user_id 輪流，
+    單一使用者的大量影片不會拖慢其他使用者與其他通道。
+    只在事件迴圈中使用（不是執行緒安全）。
+    """
+
+    def __init__(self, lanes: Dict[str, Lane], max_concurrency: int):
+        self.lanes = lanes
+        self.max_concurrency = max(max_concurrency, 1)
+        self.running = 0
+        self._virtual_time = 0.0
+
+    @classmethod
+    def from_env(cls) -> "Scheduler":
+        """依 SCHEDULER_<LANE>_WEIGHT / _MAX_CONCURRENCY 與 SCHEDULER_MAX_CONCURRENCY 建立"""
+        lanes = {}
+        for name, (weight, concurrency) in DEFAULT_LANES.items():
+            prefix = f"SCHEDULER_{name.upper()}_"
+            lanes[name] = Lane(
+                name,
+                weight=float(os.getenv(prefix + "WEIGHT", str(weight))),
+                max_concurrency=int(os.getenv(prefix + "MAX_CONCURRENCY", str(concurrency))),
+            )
+        return cls(lanes, int(os.getenv("SCHEDULER_MAX_CONCURRENCY", "8")))
+
+    def _dispatch(self):
+        while self.running < self.max_concurrency:
+            candidates = [lane for lane in self.lanes.values() if lane.eligible()]
+            if not candidates:
+                return
+            lane = min(candidates, key=lambda candidate: candidate.virtual_time)
+            waiter = lane.pop()
+            if waiter.done():
+                # 已取消（或逾時）但尚未移出佇列的請求：直接丟棄，不占用名額
+                self._update_gauges(lane)
+                continue
+            waiter.set_result(None)
+            lane.virtual_time += 1 / lane.weight
+            self._virtual_time = lane.virtual_time
+            lane.running += 1
+            lane.dispatched += 1
+            self.running += 1
+            self._update_gauges(lane)
+
+    def _release(self, lane: Lane):
+        lane.running -= 1
+        self.running -= 1
+        self._update_gauges(lane)
+        self._dispatch()
+
+    def _abandon(self, lane: Lane, user: str, waiter: asyncio.Future):
+        """放棄排隊：已派發（與取消同時發生）則歸還名額，仍在排隊則移出佇列"""
+        if waiter.done() and not waiter.cancelled():
+            self._release(lane)
+        else:
+            waiter.cancel()
+            lane.remove(user, waiter)
+            self._update_gauges(lane)
+
+    def _update_gauges(self, lane: Lane):
+        SCHEDULER_QUEUE_DEPTH.labels(lane.name).set(lane.queued)
+        SCHEDULER_RUNNING.labels(lane.name).set(lane.running)
+
+    @asynccontextmanager
+    async def slot(self, lane_name: str, user_id: Optional[str] = None):
+        """排隊取得處理名額，離開時釋放；等待時間計入請求期限，超過時拋出 DeadlineExceeded"""
+        lane = self.lanes[lane_name]
+        user = user_id or ""
+        if lane.queued == 0 and lane.running == 0:
+            # 閒置後再回來的通道不累積先前的額度
+            lane.virtual_time = max(lane.virtual_time, self._virtual_time)
+        waiter = asyncio.get_running_loop().create_future()
+        lane.push(user, waiter)
+        self._update_gauges(lane)
+        queued_at = time.monotonic()
+        self._dispatch()
+        # 用 asyncio.wait 而非 wait_for：wait_for 在名額剛派發時會吞掉取消
+        try:
+            await asyncio.wait({waiter}, timeout=deadline.remaining())
+        except asyncio.CancelledError:
+            self._abandon(lane, user, waiter)
+            raise
+        if not waiter.done():
+            self._abandon(lane, user, waiter)
+            raise deadline.DeadlineExceeded(f"在 {lane_name} 通道排隊時已超過請求期限")
+        waited = time.monotonic() - queued_at
+        lane.record_wait(waited)
+        if waited >= 1:
+            print(f"⏳ {lane_name} 通道排隊 {waited:.1f}s（user_id='{user}'）")
+        try:
+            yield
+        finally:
+            self._release(lane)
+
+    def stats(self) -> Dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "running": self.running,
+            "lanes": {name: lane.stats() for name, lane in self.lanes.items()},
+        }
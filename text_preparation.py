@@ -0,0 +1,241 @@
+import re
+from typing import Dict, List
+
+# 預先編譯的正規表達式，避免每次呼叫重新編譯
+# 移除可能導致 JSON 錯誤的特殊字符與控制字符（保留時間、地址常用的 : / - # 等符號）
+_CLEAN_PATTERN = re.compile(
+    r"[^\w\s\u4e00-\u9fff\u3400-\u4dbf\u3040-\u309f\u30a0-\u30ff.,!?()【】「」：；。，！？（）:/\-#@&%+]"
+)
+_SPACE_PATTERN = re.compile(r"\s+")
+# 句子切分：中英文句末標點與換行
+_SENTENCE_SPLIT = re.compile(r"(?<=[。！？!?；;])|\n+|(?<=\.)\s+")
+# 過長句子再以逗號、頓號切成子句
+_CLAUSE_SPLIT = re.compile(r"(?<=[，,、])")
+
+# 資訊密度評分用的樣式
+_TIME_PATTERN = re.compile(
+    r"\d{1,2}\s*[:：]\s*\d{2}"
+    r"|\d{1,4}\s*[年月日號]"
+    r"|[週周][一二三四五六日末]|星期[一二三四五六日天]|禮拜[一二三四五六日天]"
+    r"|\b\d{1,2}\s*(?:am|pm)\b"
+    r"|\b(?:mon|tue|wed|thu|fri|sat|sun)(?:day)?\b"
+    r"|營業|開放時間|截止|限定|期間",
+    re.IGNORECASE,
+)
+_ADDRESS_PATTERN = re.compile(
+    r"[\u4e00-\u9fff]{1,6}(?:市|縣|區|鄉|鎮|路|街|大道|巷|弄|號|樓)"
+    r"|\d+\s*(?:號|巷|弄|樓|F)\b"
+    r"|\b(?:road|rd|street|st|avenue|ave|blvd|district)\b"
+    r"|地址|捷運|車站|出口",
+    re.IGNORECASE,
+)
+_ENTITY_PATTERN = re.compile(
+    r"「[^」]{1,30}」|【[^】]{1,30}】|#\w+|@\w+"
+    r"|\b[A-Z][A-Za-z0-9&']+(?:\s+[A-Z][A-Za-z0-9&']+)*\b"
+    r"|餐廳|咖啡|酒吧|飯店|酒店|旅館|民宿|公園|博物館|美術館|夜市|商場|百貨|景點|老街|寺|廟|步道|海灘|機場"
+)
+
+# 單一句子超過此 token 數時再切成子句，避免整段被捨棄
+_MAX_SENTENCE_TOKENS = 120
+
+_encoder = None
+
+
+def _get_encoder():
+    """延遲載入 tiktoken 編碼器；無法載入時回傳 False"""
+    global _encoder
+    if _encoder is None:
+        try:
+            import tiktoken
+
+            _encoder = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            print(f"⚠️ 無法載入 tiktoken，改用字元數估算 token: {e}")
+            _encoder = False
+    return _encoder
+
+
+def count_tokens(text: str) -> int:
+    """以 tiktoken 計算 token 數；無法載入編碼器時以字元數估算"""
+    if not text:
+        return 0
+    encoder = _get_encoder()
+    if encoder:
+        return len(encoder.encode(text, disallowed_special=()))
+    # 中文約 1 字 1 token，英文約 4 字元 1 token，取保守估計
+    return len(text)
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """將文字截斷到指定 token 數"""
+    if max_tokens <= 0 or not text:
+        return ""
+    encoder = _get_encoder()
+    if encoder:
+        tokens = encoder.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return encoder.decode(tokens[:max_tokens]).strip()
+    return text[:max_tokens].strip()
+
+
+def clean_text(text: str) -> str:
+    """移除特殊字符並合併多餘空白"""
+    if not text:
+        return ""
+    text = _CLEAN_PATTERN.sub(" ", text)
+    return _SPACE_PATTERN.sub(" ", text).strip()
+
+
+def split_sentences(text: str) -> List[str]:
+    """將原始文字切成句子（已清理），過長的句子再切成子句"""
+    if not text:
+        return []
+
+    sentences = []
+    for raw in _SENTENCE_SPLIT.split(_CLEAN_PATTERN.sub(" ", text)):
+        sentence = _SPACE_PATTERN.sub(" ", raw).strip()
+        if not sentence:
+            continue
+        if count_tokens(sentence) > _MAX_SENTENCE_TOKENS:
+            sentences.extend(
+                clause.strip()
+                for clause in _CLAUSE_SPLIT.split(sentence)
+                if clause.strip()
+            )
+        else:
+            sentences.append(sentence)
+    return sentences
+
+
+def score_sentence(sentence: str) -> int:
+    """依時間、地址、專有名詞出現次數評估句子的資訊密度"""
+    return (
+        3 * len(_TIME_PATTERN.findall(sentence))
+        + 3 * len(_ADDRESS_PATTERN.findall(sentence))
+        + 2 * len(_ENTITY_PATTERN.findall(sentence))
+    )
+
+
+def fit_to_budget(text: str, max_tokens: int) -> str:
+    """將文字壓縮到 token 預算內
+
+    未超出預算時只做清理；超出時優先保留含時間、地址、專有名詞的句子，
+    並維持原文順序。
+    """
+    cleaned = clean_text(text)
+    if count_tokens(cleaned) <= max_tokens:
+        return cleaned
+
+    sentences = split_sentences(text)
+    scored = []
+    for index, sentence in enumerate(sentences):
+        # 開頭的句子通常是主題，給予少量加分
+        bonus = 1 if index < 2 else 0
+        scored.append(
+            (score_sentence(sentence) + bonus, index, sentence, count_tokens(sentence))
+        )
+
+    selected = []
+    remaining = max_tokens
+    for score, index, sentence, tokens in sorted(scored, key=lambda s: (-s[0], s[1])):
+        # 句子之間以一個空白連接，約佔一個 token
+        if tokens + 1 <= remaining:
+            selected.append((index, sentence))
+            remaining -= tokens + 1
+
+    if not selected:
+        return truncate_tokens(cleaned, max_tokens)
+
+    return " ".join(sentence for _, sentence in sorted(selected))
+
+
+def chunk_text(text: str, chunk_tokens: int) -> List[str]:
+    """依句子邊界將文字切成每段不超過 chunk_tokens 的區塊"""
+    chunks = []
+    current = []
+    current_tokens = 0
+    for sentence in split_sentences(text):
+        tokens = count_tokens(sentence)
+        if tokens > chunk_tokens:
+            sentence = truncate_tokens(sentence, chunk_tokens)
+            tokens = chunk_tokens
+        if current and current_tokens + tokens + 1 > chunk_tokens:
+            chunks.append(" ".join(current))
+            current, current_tokens = [], 0
+        current.append(sentence)
+        current_tokens += tokens + 1
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+
+def prepare_ai_text(
+    ocr_text: str,
+    caption: str,
+    original_path: str,
+    token_budget: int,
+    ocr_share: float = 0.6,
+    metadata_max_tokens: int = 100,
+) -> Dict:
+    """在 token 預算內準備送給 LLM 的文字內容
+
+    先扣除 metadata（原始連結）所需的 token，剩餘預算依 ocr_share 分配給
+    文字內容與字幕；其中一方用不完的預算會讓給另一方。
+    文字內容與字幕相同時（例如 Threads、Medium）只保留一份。
+
+    Returns:
+        {
+            "ocr_text": str,
+            "caption": str,
+            "original_path": str,
+            "caption_same_as_ocr": bool,
+            "tokens": {"ocr_text": int, "caption": int, "original_path": int},
+            "truncated": bool,
+        }
+    """
+    original_path = truncate_tokens(original_path or "", metadata_max_tokens)
+    available = max(token_budget - count_tokens(original_path), 0)
+
+    cleaned_ocr = clean_text(ocr_text)
+    cleaned_caption = clean_text(caption)
+    ocr_tokens = count_tokens(cleaned_ocr)
+    caption_tokens = count_tokens(cleaned_caption)
+
+    caption_same_as_ocr = bool(cleaned_ocr) and cleaned_ocr == cleaned_caption
+    if caption_same_as_ocr:
+        ocr_budget, caption_budget = available, 0
+    else:
+        ocr_budget = int(available * ocr_share)
+        caption_budget = available - ocr_budget
+        # 將用不完的預算讓給另一方
+        if ocr_tokens < ocr_budget:
+            caption_budget += ocr_budget - ocr_tokens
+            ocr_budget = ocr_tokens
+        elif caption_tokens < caption_budget:
+            ocr_budget += caption_budget - caption_tokens
+            caption_budget = caption_tokens
+
+    prepared_ocr = (
+        cleaned_ocr if ocr_tokens <= ocr_budget else fit_to_budget(ocr_text, ocr_budget)
+    )
+    if caption_same_as_ocr:
+        prepared_caption = prepared_ocr
+    elif caption_tokens <= caption_budget:
+        prepared_caption = cleaned_caption
+    else:
+        prepared_caption = fit_to_budget(caption, caption_budget)
+
+    return {
+        "ocr_text": prepared_ocr,
+        "caption": prepared_caption,
+        "original_path": original_path,
+        "caption_same_as_ocr": caption_same_as_ocr,
+        "tokens": {
+            "ocr_text": count_tokens(prepared_ocr),
+            "caption": 0 if caption_same_as_ocr else count_tokens(prepared_caption),
+            "original_path": count_tokens(original_path),
+        },
+        "truncated": ocr_tokens > ocr_budget
+        or (not caption_same_as_ocr and caption_tokens > caption_budget),
+    }
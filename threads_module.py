@@ -3,7 +3,12 @@ from typing import Dict
 
 from playwright.async_api import async_playwright
 
+from metrics import instrument
+import deadline
+import progress
 
+
+@instrument("scrape", upstream="threads")
 async def scrape_thread(url: str) -> Dict:
     """以 Playwright 爬取 Threads 貼文，從 og:description 提取內容"""
     # 從 URL 中提取 username 和 code
@@ -14,51 +19,48 @@ async def scrape_thread(url: str) -> Dict:
     
     async with async_playwright() as pw:
         browser = await pw.chromium.launch()
-        context = await browser.new_context(viewport={"width": 1920, "height": 1080})
-        page = await context.new_page()
-
-        await page.goto(url)
-        await page.wait_for_load_state('domcontentloaded')
-        
-        # 🎯 從 og:description 提取內容
+        # 請求取消（用戶端斷線）或發生錯誤時也要關閉瀏覽器
         try:
-            og_desc = await page.get_attribute('meta[property="og:description"]', 'content')
-            og_title = await page.get_attribute('meta[property="og:title"]', 'content')
-            og_image = await page.get_attribute('meta[property="og:image"]', 'content')
-            
-            if og_desc:
-                print(f"✅ 從 og:description 提取到內容: {og_desc[:100]}...")
-                
-                # 提取圖片
-                images = []
-                if og_image:
-                    images.append(og_image)
-                
-                await context.close()
-                await browser.close()
-                
-                return {
-                    "thread": {
-                        "text": og_desc,
-                        "username": target_username or "unknown",
-                        "code": target_code or "",
-                        "url": url,
-                        "images": images,
-                        "videos": [],
-                    },
-                    "replies": [],
-                }
-            else:
-                await context.close()
-                await browser.close()
-                raise ValueError("無法找到 og:description")
-                
-        except Exception as error:
-            await context.close()
+            context = await browser.new_context(viewport={"width": 1920, "height": 1080})
+            page = await context.new_page()
+
+            await page.goto(url, timeout=deadline.timeout(30, "scrape") * 1000)
+            await page.wait_for_load_state('domcontentloaded')
+
+            # 🎯 從 og:description 提取內容
+            try:
+                og_desc = await page.get_attribute('meta[property="og:description"]', 'content')
+                og_title = await page.get_attribute('meta[property="og:title"]', 'content')
+                og_image = await page.get_attribute('meta[property="og:image"]', 'content')
+            except Exception as error:
+                raise ValueError(f"提取 og:description 失敗: {error}")
+
+            if not og_desc:
+                raise ValueError("提取 og:description 失敗: 無法找到 og:description")
+
+            print(f"✅ 從 og:description 提取到內容: {og_desc[:100]}...")
+
+            # 提取圖片
+            images = []
+            if og_image:
+                images.append(og_image)
+
+            return {
+                "thread": {
+                    "text": og_desc,
+                    "username": target_username or "unknown",
+                    "code": target_code or "",
+                    "url": url,
+                    "images": images,
+                    "videos": [],
+                },
+                "replies": [],
+            }
+        finally:
             await browser.close()
-            raise ValueError(f"提取 og:description 失敗: {error}")
 
 
+@instrument("extract")
 async def process_threads_article(url: str) -> Dict:
     """處理 Threads 文章，輸出與其他模組一致的格式
 
@@ -77,6 +79,9 @@ async def process_threads_article(url: str) -> Dict:
         username = main.get("username") or ""
         images = main.get("images") or []
         videos = main.get("videos") or []
+        progress.emit(
+            "metadata", {"username": username, "images": images, "videos": videos}
+        )
 
         raw_output = {
             "text": text,
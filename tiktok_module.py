@@ -1,10 +1,17 @@
 import os
+import asyncio
 import requests
 import subprocess
 from typing import Dict
 from openai import OpenAI
 from urllib.parse import urlsplit, urlunsplit
 
+from metrics import instrument, record_bytes, record_error, stage
+from upstream_governor import governor
+import deadline
+import progress
+from workspace import workspace
+
 DOUYIN_WTF_BASE = "https://douyin.wtf"
 
 
@@ -22,6 +29,7 @@ def normalize_tiktok_url(input_url: str) -> str:
         return input_url
 
 
+@instrument("metadata", upstream="douyin_wtf")
 def fetch_video_data(url: str) -> dict:
     """
     使用 douyin.wtf Hybrid API 取得 TikTok 影片資料。
@@ -30,11 +38,19 @@ def fetch_video_data(url: str) -> dict:
     文件: https://douyin.wtf/docs
     """
     endpoint = f"{DOUYIN_WTF_BASE}/api/hybrid/video_data"
-    response = requests.get(endpoint, params={"url": url}, timeout=30)
+    response = governor.request(
+        "douyin_wtf",
+        "GET",
+        endpoint,
+        params={"url": url},
+        timeout=deadline.timeout(30, "metadata"),
+    )
     response.raise_for_status()
+    record_bytes("download", "douyin_wtf", len(response.content))
     return response.json()
 
 
+@instrument("download", upstream="tiktok_cdn")
 def download_video(video_url: str, output_path: str) -> bool:
     """下載影片到指定路徑"""
     try:
@@ -45,64 +61,89 @@ def download_video(video_url: str, output_path: str) -> bool:
                 "Chrome/120.0.0.0 Safari/537.36"
             )
         }
-        resp = requests.get(video_url, headers=headers, stream=True, timeout=60)
+        resp = requests.get(
+            video_url,
+            headers=headers,
+            stream=True,
+            timeout=deadline.timeout(60, "download"),
+        )
         resp.raise_for_status()
         with open(output_path, "wb") as f:
             for chunk in resp.iter_content(chunk_size=8192):
+                # 請求取消或超過期限時中止下載
+                deadline.check("download")
                 f.write(chunk)
+                record_bytes("download", "tiktok_cdn", len(chunk))
         return True
     except Exception as e:
+        record_error("tiktok_cdn")
         print(f"下載影片失敗: {e}")
+        # 移除下載到一半的檔案
+        if os.path.exists(output_path):
+            os.remove(output_path)
         return False
 
 
 def whisper_transcribe(mp4_path: str) -> str:
     """使用 OpenAI Whisper-1 將影片音頻轉為文字"""
+    m4a_path = None
     try:
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
 
         # 將 mp4 轉為 m4a 音頻（降採樣以節省費用）
         m4a_path = mp4_path.replace(".mp4", "_whisper.m4a")
-        subprocess.run(
-            [
+        with stage("ffmpeg", upstream="ffmpeg"):
+            # 請求取消或逾時時終止 ffmpeg 行程
+            deadline.run_subprocess(
+                [
+                    "ffmpeg",
+                    "-y",
+                    "-i",
+                    mp4_path,
+                    "-vn",
+                    "-ac",
+                    "1",
+                    "-ar",
+                    "16000",
+                    "-b:a",
+                    "32k",
+                    m4a_path,
+                ],
                 "ffmpeg",
-                "-y",
-                "-i",
-                mp4_path,
-                "-vn",
-                "-ac",
-                "1",
-                "-ar",
-                "16000",
-                "-b:a",
-                "32k",
-                m4a_path,
-            ],
-            check=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-
-        with open(m4a_path, "rb") as f:
-            result = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=f,
-                response_format="text",
-                temperature=0.0,
+                120,
+                check_returncode=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
             )
 
-        # 清理暫存音頻
-        if os.path.exists(m4a_path):
-            os.remove(m4a_path)
+        def transcribe():
+            # 重試時重新開檔，從頭上傳
+            with open(m4a_path, "rb") as f:
+                return client.audio.transcriptions.create(
+                    model="whisper-1",
+                    file=f,
+                    response_format="text",
+                    temperature=0.0,
+                    timeout=deadline.timeout(300, "whisper"),
+                )
+
+        record_bytes("upload", "openai", os.path.getsize(m4a_path))
+        with stage("whisper", upstream="openai"):
+            result = governor.call("openai_audio", transcribe)
 
         return result.strip()
 
     except Exception as e:
         print(f"Whisper 轉錄失敗: {e}")
         return ""
+    finally:
+        # 清理暫存音頻（轉換或轉錄失敗、請求取消時也要清理）
+        if m4a_path and os.path.exists(m4a_path):
+            os.remove(m4a_path)
 
 
-async def process_tiktok_video(url: str, save_dir: str = "./shorts_cache") -> Dict:
+@instrument("extract")
+async def process_tiktok_video(url: str) -> Dict:
     """
     處理 TikTok 影片：
     1. 透過 douyin.wtf Hybrid API 取得影片資料
@@ -127,12 +168,11 @@ async def process_tiktok_video(url: str, save_dir: str = "./shorts_cache") -> Di
     if cleaned_url != url:
         print(f"標準化後的 URL: '{cleaned_url}'")
 
-    os.makedirs(save_dir, exist_ok=True)
-
     # Step 1: 呼叫 douyin.wtf Hybrid API 取得影片資料
     try:
         print(f"正在呼叫 douyin.wtf API: {cleaned_url}")
-        data = fetch_video_data(cleaned_url)
+        # 同步的 HTTP 呼叫、下載與轉錄移到執行緒，不阻塞事件迴圈
+        data = await asyncio.to_thread(fetch_video_data, cleaned_url)
         print(f"API 回應 code: {data.get('code')}")
     except Exception as e:
         print(f"douyin.wtf API 請求失敗: {e}")
@@ -170,6 +210,9 @@ async def process_tiktok_video(url: str, save_dir: str = "./shorts_cache") -> Di
 
     print(f"影片描述: {description[:100]}")
     print(f"作者: {author}")
+    progress.emit(
+        "metadata", {"description": description, "author": author, "aweme_id": aweme_id}
+    )
 
     # 優先使用 TikTok 原生語音字幕
     voice_to_text = video_info.get("voice_to_text", "") or ""
@@ -189,6 +232,22 @@ async def process_tiktok_video(url: str, save_dir: str = "./shorts_cache") -> Di
             },
         }
 
+    # 有影片文案時 Whisper 為選用階段，剩餘時間不足就只以文案分析
+    if description and not deadline.allows("whisper"):
+        return {
+            "raw_output": {
+                "description": description,
+                "caption": description,
+                "author": author,
+                "aweme_id": aweme_id,
+            },
+            "ai_input": {
+                "original_path": cleaned_url,
+                "ocr_text": description,
+                "caption": description,
+            },
+        }
+
     print("⚠️ 無 TikTok 原生字幕，改為下載影片並使用 Whisper 轉錄...")
 
     # 取得無水印影片 URL
@@ -226,27 +285,20 @@ async def process_tiktok_video(url: str, save_dir: str = "./shorts_cache") -> Di
     # Step 3: 下載影片並進行 Whisper 轉錄
     caption = ""
     if video_url:
-        video_filename = f"{author}_{aweme_id}.mp4"
-        video_path = os.path.join(save_dir, video_filename)
-
-        print("正在下載影片...")
-        if download_video(video_url, video_path):
-            print(f"影片已下載至: {video_path}")
-            print("使用 Whisper-1 轉錄中...")
-            caption = whisper_transcribe(video_path)
-
-            # 清理影片檔案
-            try:
-                if os.path.exists(video_path):
-                    os.remove(video_path)
-                    print(f"已清理影片檔案: {video_path}")
-            except Exception as e:
-                print(f"清理影片失敗: {e}")
-
-            if not caption:
-                caption = "(轉錄失敗)"
-        else:
-            caption = "(影片下載失敗)"
+        # 每個工作使用獨立的暫存目錄，結束時（含下載或轉錄失敗、請求取消）整個刪除
+        with workspace.job("tiktok") as workdir:
+            video_path = os.path.join(workdir, "video.mp4")
+
+            print("正在下載影片...")
+            if await asyncio.to_thread(download_video, video_url, video_path):
+                print(f"影片已下載至: {video_path}")
+                print("使用 Whisper-1 轉錄中...")
+                caption = await asyncio.to_thread(whisper_transcribe, video_path)
+
+                if not caption:
+                    caption = "(轉錄失敗)"
+            else:
+                caption = "(影片下載失敗)"
     else:
         caption = "(無法取得影片下載連結)"
 
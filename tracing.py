@@ -0,0 +1,222 @@
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+import orjson
+
+
+class Trace:
+    """單一請求的追蹤紀錄：request id 與各階段的開始時間、耗時、結果"""
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.spans: List[Dict] = []
+        self._lock = threading.Lock()
+
+    def add_span(self, stage: str, started: float, duration: float, outcome: str):
+        # 長篇內容模式的各段在執行緒池中並行記錄
+        with self._lock:
+            self.spans.append(
+                {
+                    "stage": stage,
+                    "start_ms": round((started - self.started) * 1000, 1),
+                    "duration_ms": round(duration * 1000, 1),
+                    "outcome": outcome,
+                }
+            )
+
+    def elapsed_ms(self) -> float:
+        return round((time.perf_counter() - self.started) * 1000, 1)
+
+    def timings(self) -> Dict:
+        with self._lock:
+            # 同時開始的巢狀階段，外層（耗時較長）排在前面
+            spans = sorted(
+                self.spans, key=lambda span: (span["start_ms"], -span["duration_ms"])
+            )
+        return {
+            "request_id": self.request_id,
+            "total_ms": self.elapsed_ms(),
+            "stages": spans,
+        }
+
+    def server_timing(self) -> str:
+        """Server-Timing 標頭：同名階段的耗時加總，最後附上總耗時"""
+        totals: Dict[str, float] = {}
+        with self._lock:
+            for span in self.spans:
+                totals[span["stage"]] = totals.get(span["stage"], 0.0) + span["duration_ms"]
+        entries = [f"{stage};dur={duration:.1f}" for stage, duration in totals.items()]
+        entries.append(f"total;dur={self.elapsed_ms():.1f}")
+        return ", ".join(entries)
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+
+def start_trace(request_id: Optional[str] = None) -> Trace:
+    """建立並設定目前 context 的追蹤；未提供 request id 時產生新的"""
+    trace = Trace(request_id or uuid.uuid4().hex)
+    current_trace.set(trace)
+    return trace
+
+
+def current_request_id() -> Optional[str]:
+    trace = current_trace.get()
+    return trace.request_id if trace else None
+
+
+def record_span(stage: str, started: float, duration: float, outcome: str):
+    """將階段耗時記錄到目前請求的追蹤（不在請求中時忽略）"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_span(stage, started, duration, outcome)
+
+
+def _collapse(frame) -> str:
+    """將堆疊轉為 collapsed stack 格式（由外而內以分號分隔）"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """取樣式 wall-clock profiler
+
+    有請求進行中時，背景執行緒以固定間隔取樣所有執行緒的堆疊（sys._current_frames），
+    保留最近的樣本；請求結束時若耗時超過門檻，將該請求期間的樣本彙整為
+    collapsed stack 檔（可用 flamegraph.pl 或 speedscope 開啟），並附上該請求的階段耗時。
+    樣本涵蓋整個行程，並行的其他請求也會出現在同一份 profile 中。
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        threshold_ms: float,
+        interval_ms: float = 10.0,
+        max_seconds: float = 300.0,
+        max_files: int = 100,
+    ):
+        self.directory = directory
+        self.threshold_ms = threshold_ms
+        self.interval = interval_ms / 1000
+        self.max_files = max_files
+        self._samples = deque(maxlen=max(int(max_seconds / self.interval), 1))
+        self._active = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self.profiles_written = 0
+
+    def begin(self):
+        with self._condition:
+            self._active += 1
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="sampling-profiler", daemon=True
+                )
+                self._thread.start()
+            self._condition.notify()
+
+    def end(self, trace: Trace):
+        with self._condition:
+            self._active -= 1
+        if trace.elapsed_ms() >= self.threshold_ms:
+            try:
+                self._write_profile(trace)
+            except Exception as e:
+                print(f"⚠️ 寫入 profile 失敗: {e}")
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            with self._condition:
+                # 沒有進行中的請求時暫停取樣
+                while self._active <= 0:
+                    self._condition.wait()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            now = time.perf_counter()
+            stacks = tuple(
+                f"{names.get(thread_id, thread_id)};{_collapse(frame)}"
+                for thread_id, frame in sys._current_frames().items()
+                if thread_id != own_id
+            )
+            self._samples.append((now, stacks))
+            time.sleep(self.interval)
+
+    def _write_profile(self, trace: Trace):
+        ended = time.perf_counter()
+        counts: Dict[str, int] = {}
+        for sampled_at, stacks in list(self._samples):
+            if trace.started <= sampled_at <= ended:
+                for stack in stacks:
+                    counts[stack] = counts.get(stack, 0) + 1
+        if not counts:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(
+            self.directory,
+            f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(trace.started_at))}_{trace.request_id}",
+        )
+        with open(base + ".collapsed", "w", encoding="utf-8") as f:
+            for stack, count in sorted(counts.items(), key=lambda item: -item[1]):
+                f.write(f"{stack} {count}\n")
+        with open(base + ".json", "wb") as f:
+            f.write(
+                orjson.dumps(
+                    {**trace.timings(), "sample_interval_ms": self.interval * 1000},
+                    option=orjson.OPT_INDENT_2,
+                )
+            )
+        self.profiles_written += 1
+        print(f"🐢 慢請求 {trace.request_id}（{trace.elapsed_ms():.0f}ms），profile 已寫入 {base}.collapsed")
+        self._prune()
+
+    def _prune(self):
+        """只保留最新的 max_files 份 profile"""
+        files = sorted(
+            (
+                os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith(".collapsed")
+            ),
+            key=os.path.getmtime,
+        )
+        for path in files[: max(len(files) - self.max_files, 0)]:
+            for extension in (".collapsed", ".json"):
+                try:
+                    os.remove(os.path.splitext(path)[0] + extension)
+                except FileNotFoundError:
+                    pass
+
+    def stats(self) -> Dict:
+        return {
+            "threshold_ms": self.threshold_ms,
+            "interval_ms": self.interval * 1000,
+            "active_requests": self._active,
+            "profiles_written": self.profiles_written,
+            "directory": self.directory,
+        }
+
+
+def create_profiler() -> Optional[SamplingProfiler]:
+    """TRACE_PROFILE_THRESHOLD_MS 大於 0 時啟用慢請求 profiler"""
+    threshold_ms = float(os.getenv("TRACE_PROFILE_THRESHOLD_MS", "0"))
+    if threshold_ms <= 0:
+        return None
+    return SamplingProfiler(
+        directory=os.getenv("TRACE_PROFILE_DIR", os.path.join("data", "profiles")),
+        threshold_ms=threshold_ms,
+        interval_ms=float(os.getenv("TRACE_PROFILE_INTERVAL_MS", "10")),
+        max_files=int(os.getenv("TRACE_PROFILE_MAX_FILES", "100")),
+    )
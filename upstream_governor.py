@@ -0,0 +1,429 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional
+
+import requests
+
+import deadline
+from metrics import UPSTREAM_CIRCUIT_OPEN, UPSTREAM_CONCURRENCY_LIMIT, UPSTREAM_RETRIES
+
+# 可重試的 HTTP 狀態碼：逾時、限流與伺服器暫時性錯誤
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+# 代表上游過載的狀態碼，出現時調降並行上限
+OVERLOAD_STATUS = {429, 503}
+
+# 各外部服務的預設限制：(每秒請求數, 突發容量, 最大並行數)；每秒請求數 0 表示不限速
+DEFAULT_LIMITS = {
+    "openai_chat": (8.0, 16, 32),
+    "openai_audio": (2.0, 8, 8),
+    "openai_embeddings": (20.0, 40, 32),
+    "google_maps": (10.0, 20, 16),
+    "scrapecreators": (2.0, 5, 4),
+    "douyin_wtf": (2.0, 5, 4),
+    "tavily": (2.0, 5, 4),
+    "cloudinary": (5.0, 10, 8),
+}
+
+
+class UpstreamUnavailable(Exception):
+    """斷路器開啟或等候名額逾時，未實際呼叫外部服務"""
+
+
+def _status_of(error: Exception) -> Optional[int]:
+    """從 requests / openai 等套件的例外取出 HTTP 狀態碼"""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """解析 Retry-After 標頭（秒數或 HTTP 日期）"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_timeout(error: Exception) -> bool:
+    return isinstance(error, (TimeoutError, ConnectionError)) or any(
+        marker in type(error).__name__ for marker in ("Timeout", "Connection")
+    )
+
+
+def raise_for_retryable_status(response: requests.Response) -> requests.Response:
+    """只對可重試的狀態碼拋出例外，其餘狀態碼照常回傳給呼叫端判斷"""
+    if response.status_code in RETRYABLE_STATUS:
+        response.raise_for_status()
+    return response
+
+
+class TokenBucket:
+    """令牌桶限速：平均每秒 rate 次，最多累積 burst 次的突發"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> float:
+        """取得一個令牌回傳 0，否則回傳需要等待的秒數"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+
+class AdaptiveLimit:
+    """AIMD 自適應並行上限：成功時緩慢調升，過載（429/503/逾時）時減半"""
+
+    def __init__(self, max_limit: int, min_limit: int = 1, decrease_cooldown: float = 1.0):
+        self.max_limit = max(max_limit, 1)
+        self.min_limit = max(min(min_limit, self.max_limit), 1)
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self.decrease_cooldown = decrease_cooldown
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def release(self, overloaded: bool = False, succeeded: bool = False):
+        with self._lock:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if overloaded:
+                # 同一波並行失敗只減半一次
+                if now - self._last_decrease >= self.decrease_cooldown:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self._last_decrease = now
+            elif succeeded:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+
+class CircuitBreaker:
+    """連續失敗達門檻時開啟，暫停呼叫 reset_timeout 秒後放行一個探測請求（half-open）"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = max(failure_threshold, 1)
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        """是否可能放行請求（不佔用 half-open 的探測名額）"""
+        with self._lock:
+            return self.state != "open" or (
+                time.monotonic() - self.opened_at >= self.reset_timeout
+            )
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open":
+                if self._probing:
+                    return False
+                self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def release_probe(self):
+        """探測請求沒有結果（被取消或中斷）時歸還探測名額，讓下一個請求重新探測"""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self) -> bool:
+        """記錄一次失敗，回傳斷路器是否因此開啟"""
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                opened = self.state != "open"
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                return opened
+            return False
+
+
+class Upstream:
+    """單一外部服務的呼叫管控：限速、自適應並行上限、重試與斷路器"""
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        burst: int,
+        max_concurrency: int,
+        max_retries: int = 3,
+        breaker_failures: int = 5,
+        breaker_reset: float = 30.0,
+        acquire_timeout: float = 30.0,
+        base_backoff: float = 0.5,
+        max_backoff: float = 20.0,
+    ):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.limit = AdaptiveLimit(max_concurrency)
+        self.breaker = CircuitBreaker(breaker_failures, breaker_reset)
+        self.max_retries = max_retries
+        self.acquire_timeout = acquire_timeout
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.calls = 0
+        self.retries = 0
+        self.rejected = 0
+        UPSTREAM_CONCURRENCY_LIMIT.labels(name).set(self.limit.limit)
+
+    def available(self) -> bool:
+        return self.breaker.available()
+
+    def _try_acquire(self) -> float:
+        """取得並行名額與令牌回傳 0，否則回傳建議等待秒數；斷路器開啟時拋出例外"""
+        if not self.breaker.available():
+            self.rejected += 1
+            raise UpstreamUnavailable(f"{self.name} 暫時停用（斷路器開啟）")
+        if not self.limit.try_acquire():
+            return 0.05
+        wait = self.bucket.try_acquire()
+        if wait:
+            self.limit.release()
+            return wait
+        if not self.breaker.allow():
+            # half-open 時已有探測請求進行中
+            self.limit.release()
+            self.rejected += 1
+            raise UpstreamUnavailable(f"{self.name} 暫時停用（斷路器探測中）")
+        return 0.0
+
+    def _timed_out(self) -> UpstreamUnavailable:
+        self.rejected += 1
+        return UpstreamUnavailable(
+            f"{self.name} 等候呼叫名額逾時（{self.acquire_timeout:.0f}s）"
+        )
+
+    def _on_success(self):
+        self.breaker.record_success()
+        self.limit.release(succeeded=True)
+        self._update_gauges()
+
+    def _on_abandon(self):
+        """呼叫沒有結果（被取消或中斷）：歸還名額，不影響斷路器的判斷"""
+        self.breaker.release_probe()
+        self.limit.release()
+        self._update_gauges()
+
+    def _on_failure(self, error: Exception, attempt: int) -> Optional[float]:
+        """記錄失敗並回傳重試前的等待秒數；不重試時回傳 None"""
+        status = _status_of(error)
+        timed_out = status is None and _is_timeout(error)
+        if status is not None and status not in RETRYABLE_STATUS:
+            # 請求本身有誤（4xx），外部服務是健康的
+            self.breaker.record_success()
+            self.limit.release()
+            self._update_gauges()
+            return None
+        if status is None and not timed_out:
+            # 本地錯誤（參數錯誤、回應解析失敗等）不代表外部服務異常，不計入斷路器
+            self._on_abandon()
+            return None
+
+        # 逾時、連線錯誤與可重試的狀態碼：計入斷路器並重試
+        self.limit.release(overloaded=timed_out or status in OVERLOAD_STATUS)
+        if self.breaker.record_failure():
+            print(f"🔌 {self.name} 連續失敗，斷路器開啟 {self.breaker.reset_timeout:.0f}s")
+        self._update_gauges()
+        if attempt >= self.max_retries or not self.breaker.available():
+            return None
+        left = deadline.remaining()
+
+        # full jitter 指數退避；有 Retry-After 時至少等到指定時間
+        delay = random.uniform(0, min(self.max_backoff, self.base_backoff * 2**attempt))
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            if retry_after > self.max_backoff:
+                return None
+            delay = max(delay, retry_after)
+        # 等待後已沒有時間完成請求就不再重試
+        if left is not None and delay >= left:
+            return None
+        self.retries += 1
+        UPSTREAM_RETRIES.labels(self.name).inc()
+        print(f"🔁 {self.name} 呼叫失敗（{status or type(error).__name__}），{delay:.1f}s 後重試")
+        return delay
+
+    def _update_gauges(self):
+        UPSTREAM_CIRCUIT_OPEN.labels(self.name).set(1 if self.breaker.state == "open" else 0)
+        UPSTREAM_CONCURRENCY_LIMIT.labels(self.name).set(self.limit.limit)
+
+    def call(self, func: Callable, *args, **kwargs):
+        """以限速、並行上限與重試呼叫同步函式"""
+        self.calls += 1
+        attempt = 0
+        while True:
+            # 請求已取消或超過期限時不再發出（付費的）呼叫
+            deadline.check(self.name)
+            started = time.monotonic()
+            while True:
+                wait = self._try_acquire()
+                if not wait:
+                    break
+                if time.monotonic() - started + wait > self.acquire_timeout:
+                    raise self._timed_out()
+                left = deadline.remaining()
+                if left is not None and wait >= left:
+                    raise deadline.DeadlineExceeded(f"等候 {self.name} 呼叫名額時超過請求期限")
+                deadline.sleep(wait, self.name)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                delay = self._on_failure(e, attempt)
+                if delay is None:
+                    raise
+                deadline.sleep(delay, self.name)
+                attempt += 1
+                continue
+            except BaseException:
+                self._on_abandon()
+                raise
+            self._on_success()
+            return result
+
+    async def call_async(self, func: Callable, *args, **kwargs):
+        """call() 的 async 版本，等待時不阻塞事件迴圈"""
+        self.calls += 1
+        attempt = 0
+        while True:
+            deadline.check(self.name)
+            started = time.monotonic()
+            while True:
+                wait = self._try_acquire()
+                if not wait:
+                    break
+                if time.monotonic() - started + wait > self.acquire_timeout:
+                    raise self._timed_out()
+                left = deadline.remaining()
+                if left is not None and wait >= left:
+                    raise deadline.DeadlineExceeded(f"等候 {self.name} 呼叫名額時超過請求期限")
+                await asyncio.sleep(wait)
+            try:
+                result = await func(*args, **kwargs)
+            except asyncio.CancelledError:
+                self._on_abandon()
+                raise
+            except Exception as e:
+                delay = self._on_failure(e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._on_success()
+            return result
+
+    def stats(self) -> Dict:
+        return {
+            "state": self.breaker.state,
+            "concurrency_limit": round(self.limit.limit, 1),
+            "in_flight": self.limit.in_flight,
+            "calls": self.calls,
+            "retries": self.retries,
+            "rejected": self.rejected,
+        }
+
+
+class UpstreamGovernor:
+    """所有請求共用的外部服務管控，依名稱建立各服務的 Upstream
+
+    每個服務的設定可用 UPSTREAM_<NAME>_RATE / _BURST / _MAX_CONCURRENCY 覆寫。
+    """
+
+    def __init__(self):
+        self._upstreams: Dict[str, Upstream] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> Upstream:
+        upstream = self._upstreams.get(name)
+        if upstream is not None:
+            return upstream
+        with self._lock:
+            if name not in self._upstreams:
+                rate, burst, concurrency = DEFAULT_LIMITS.get(name, (0.0, 1, 16))
+                prefix = f"UPSTREAM_{name.upper()}_"
+                self._upstreams[name] = Upstream(
+                    name,
+                    rate=float(os.getenv(prefix + "RATE", str(rate))),
+                    burst=int(os.getenv(prefix + "BURST", str(burst))),
+                    max_concurrency=int(
+                        os.getenv(prefix + "MAX_CONCURRENCY", str(concurrency))
+                    ),
+                    max_retries=int(os.getenv("UPSTREAM_MAX_RETRIES", "3")),
+                    breaker_failures=int(os.getenv("UPSTREAM_BREAKER_FAILURES", "5")),
+                    breaker_reset=float(
+                        os.getenv("UPSTREAM_BREAKER_RESET_SECONDS", "30")
+                    ),
+                    acquire_timeout=float(os.getenv("UPSTREAM_ACQUIRE_TIMEOUT", "30")),
+                    max_backoff=float(os.getenv("UPSTREAM_MAX_BACKOFF", "20")),
+                )
+            return self._upstreams[name]
+
+    def call(self, name: str, func: Callable, *args, **kwargs):
+        return self.get(name).call(func, *args, **kwargs)
+
+    async def call_async(self, name: str, func: Callable, *args, **kwargs):
+        return await self.get(name).call_async(func, *args, **kwargs)
+
+    def request(self, name: str, method: str, url: str, **kwargs) -> requests.Response:
+        """以 requests 發送 HTTP 請求；可重試的狀態碼會觸發重試，其餘回應照常回傳"""
+        return self.call(
+            name,
+            lambda: raise_for_retryable_status(requests.request(method, url, **kwargs)),
+        )
+
+    def available(self, name: str) -> bool:
+        """外部服務是否可呼叫；選用階段在斷路器開啟時應直接略過"""
+        return self.get(name).available()
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {name: upstream.stats() for name, upstream in self._upstreams.items()}
+
+
+# 所有請求共用的外部服務管控
+governor = UpstreamGovernor()
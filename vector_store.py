@@ -0,0 +1,617 @@
+import base64
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+
+import numpy as np
+
+# 可用於過濾的 metadata 欄位；AstraDB 新建集合時只索引這些欄位（_id 一律會被索引）
+INDEXED_FIELDS = [
+    "metadata.document_id",
+    "metadata.user_id",
+    "metadata.content_type",
+    "metadata.source_type",
+    "metadata.upload_timestamp",
+]
+
+
+def truncate_embedding(vector, dimension: int) -> List[float]:
+    """截斷到前 dimension 維並重新正規化
+
+    text-embedding-3 系列以 Matryoshka 方式訓練，前段維度即為較短維度的嵌入，
+    與 API 的 dimensions 參數結果相同。
+    """
+    truncated = np.asarray(vector, dtype=np.float32)[:dimension]
+    norm = np.linalg.norm(truncated)
+    if norm:
+        truncated = truncated / norm
+    return truncated.tolist()
+
+
+def encode_vector(vector) -> str:
+    """將向量編碼為 base64 的 float32 位元組（不建索引的完整向量用）"""
+    return base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode("ascii")
+
+
+def decode_vector(data: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(data), dtype=np.float32)
+
+
+class VectorStore:
+    """向量資料庫後端介面
+
+    文檔格式與 AstraDBHandler.store_video_data 產生的相同：
+    {"_id", "$vector", "text", "metadata": {...}}。
+    過濾條件使用 Data API 的子集：欄位相等、$in、$gt/$gte/$lt/$lte。
+    投影以 metadata 欄位名稱列表表示，None 代表回傳完整 metadata。
+    """
+
+    name = "base"
+
+    def connect(self) -> bool:
+        raise NotImplementedError
+
+    def insert_one(self, document: Dict) -> None:
+        raise NotImplementedError
+
+    def insert_many(self, documents: List[Dict]) -> Dict[str, str]:
+        """批次寫入，回傳寫入失敗的 {document_id: 錯誤訊息}"""
+        raise NotImplementedError
+
+    def existing_ids(self, ids: Iterable[str]) -> Set[str]:
+        """回傳已存在於資料庫中的文檔 ID"""
+        raise NotImplementedError
+
+    def search(
+        self,
+        vector: List[float],
+        filter: Dict,
+        limit: int,
+        fields: Optional[List[str]] = None,
+    ) -> List[Dict]:
+        """向量搜尋，回傳依相似度排序的文檔（含 $similarity，不含 $vector）"""
+        raise NotImplementedError
+
+    def find_one(
+        self, document_id: str, fields: Optional[List[str]] = None
+    ) -> Optional[Dict]:
+        raise NotImplementedError
+
+    def update_one(self, document_id: str, fields: Dict) -> int:
+        """部分更新文檔的 metadata 欄位（不變更向量），回傳符合的筆數"""
+        raise NotImplementedError
+
+    def delete_one(self, document_id: str) -> int:
+        """刪除文檔，回傳刪除筆數"""
+        raise NotImplementedError
+
+    def delete_many(self, filter: Dict) -> int:
+        """刪除所有符合條件的文檔，回傳刪除筆數"""
+        raise NotImplementedError
+
+    def find_by_ids(
+        self, ids: List[str], fields: Optional[List[str]] = None
+    ) -> List[Dict]:
+        """依 ID 批次取得文檔（不保證順序）"""
+        raise NotImplementedError
+
+    def iter_documents(
+        self,
+        filter: Dict,
+        fields: Optional[List[str]] = None,
+        include_vector: bool = False,
+        page_size: int = 500,
+    ) -> Iterator[Dict]:
+        """逐頁串流符合條件的文檔，記憶體用量與集合大小無關"""
+        raise NotImplementedError
+
+
+class AstraVectorStore(VectorStore):
+    """AstraDB（Data API）後端"""
+
+    name = "astra"
+
+    def __init__(self, api_endpoint: str, token: str, collection_name: str, dimension: int):
+        self.api_endpoint = api_endpoint
+        self.token = token
+        self.collection_name = collection_name
+        self.dimension = dimension
+
+        self.client = None
+        self.database = None
+        self.collection = None
+
+    def connect(self) -> bool:
+        """初始化與AstraDB的連接"""
+        if self.collection is not None:
+            return True
+        try:
+            # 連線前的必要參數檢查
+            if not self.api_endpoint:
+                print("初始化AstraDB連接失敗: 缺少 ASTRA_DB_API_ENDPOINT")
+                return False
+            if not self.token:
+                print(
+                    "初始化AstraDB連接失敗: 缺少 ASTRA_DB_APPLICATION_TOKEN 或 ASTRA_DB_TOKEN"
+                )
+                return False
+            print("正在初始化AstraDB連接...")
+
+            from astrapy import DataAPIClient
+
+            # 創建客戶端
+            self.client = DataAPIClient(self.token)
+            self.database = self.client.get_database(self.api_endpoint)
+
+            # 檢查集合是否存在
+            collections = self.database.list_collections()
+            collection_names = [col.name for col in collections]
+
+            # 如果集合不存在，則創建
+            if self.collection_name not in collection_names:
+                print(f"創建新集合: {self.collection_name}")
+                self.collection = self.database.create_collection(
+                    name=self.collection_name,
+                    definition={
+                        "vector": {"dimension": self.dimension, "metric": "cosine"},
+                        # 只索引可過濾的 metadata 欄位，大型文字欄位不建索引以降低寫入成本
+                        "indexing": {"allow": INDEXED_FIELDS},
+                    },
+                )
+            else:
+                print(f"使用現有集合: {self.collection_name}")
+                self.collection = self.database.get_collection(self.collection_name)
+
+            print("AstraDB連接初始化完成")
+            return True
+
+        except Exception as e:
+            print(f"初始化AstraDB連接失敗: {str(e)}")
+            self.collection = None
+            return False
+
+    @staticmethod
+    def _projection(fields: Optional[List[str]], include_vector: bool = False) -> Dict:
+        if fields is None:
+            return {"$vector": include_vector}
+        projection = {f"metadata.{field}": True for field in fields}
+        if include_vector:
+            projection["$vector"] = True
+        return projection
+
+    def insert_one(self, document: Dict) -> None:
+        self.collection.insert_one(document)
+
+    def insert_many(self, documents: List[Dict]) -> Dict[str, str]:
+        try:
+            self.collection.insert_many(documents, ordered=False)
+            return {}
+        except Exception as e:
+            # insert_many 失敗時會附帶已成功寫入的 ID，其餘視為失敗
+            inserted = set(getattr(e, "inserted_ids", None) or [])
+            return {
+                doc["_id"]: str(e) for doc in documents if doc["_id"] not in inserted
+            }
+
+    def existing_ids(self, ids: Iterable[str]) -> Set[str]:
+        ids = list(ids)
+        existing = set()
+        # Data API 的 $in 最多接受 100 個值
+        for start in range(0, len(ids), 100):
+            existing.update(
+                doc["_id"]
+                for doc in self.collection.find(
+                    {"_id": {"$in": ids[start : start + 100]}}, projection={"_id": True}
+                )
+            )
+        return existing
+
+    def search(
+        self,
+        vector: List[float],
+        filter: Dict,
+        limit: int,
+        fields: Optional[List[str]] = None,
+    ) -> List[Dict]:
+        return list(
+            self.collection.find(
+                filter,
+                sort={"$vector": vector},
+                limit=limit,
+                projection=self._projection(fields),
+                include_similarity=True,
+            )
+        )
+
+    def find_one(
+        self, document_id: str, fields: Optional[List[str]] = None
+    ) -> Optional[Dict]:
+        return self.collection.find_one(
+            {"_id": document_id}, projection=self._projection(fields)
+        )
+
+    def update_one(self, document_id: str, fields: Dict) -> int:
+        result = self.collection.update_one(
+            {"_id": document_id},
+            {"$set": {f"metadata.{field}": value for field, value in fields.items()}},
+        )
+        return result.update_info.get("n", 0)
+
+    def delete_one(self, document_id: str) -> int:
+        return self.collection.delete_one({"_id": document_id}).deleted_count
+
+    def delete_many(self, filter: Dict) -> int:
+        return self.collection.delete_many(filter).deleted_count
+
+    def find_by_ids(
+        self, ids: List[str], fields: Optional[List[str]] = None
+    ) -> List[Dict]:
+        documents = []
+        # Data API 的 $in 最多接受 100 個值
+        for start in range(0, len(ids), 100):
+            documents += list(
+                self.collection.find(
+                    {"_id": {"$in": ids[start : start + 100]}},
+                    projection=self._projection(fields),
+                )
+            )
+        return documents
+
+    def iter_documents(
+        self,
+        filter: Dict,
+        fields: Optional[List[str]] = None,
+        include_vector: bool = False,
+        page_size: int = 500,
+    ) -> Iterator[Dict]:
+        # cursor 會依需要逐頁向 Data API 取資料
+        yield from self.collection.find(
+            filter, projection=self._projection(fields, include_vector)
+        )
+
+
+class LocalVectorStore(VectorStore):
+    """本機後端：metadata 存在 SQLite，向量存在記憶體映射的 float32 陣列
+
+    向量寫入前先正規化，搜尋時以 NumPy 矩陣乘法計算 cosine 相似度。
+    可過濾欄位（INDEXED_FIELDS）存成獨立欄位並建立索引，其他欄位以 json_extract 過濾。
+    刪除的文檔只移除 SQLite 列，向量列不回收。
+    """
+
+    name = "local"
+
+    # 過濾欄位 -> SQLite 欄位
+    _COLUMNS = {
+        "_id": "document_id",
+        "metadata.document_id": "document_id",
+        "metadata.user_id": "user_id",
+        "metadata.content_type": "content_type",
+        "metadata.source_type": "source_type",
+        "metadata.upload_timestamp": "upload_timestamp",
+    }
+    _OPERATORS = {"$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+    def __init__(self, directory: str, dimension: int, initial_capacity: int = 1024):
+        self.directory = directory
+        self.dimension = dimension
+        self.initial_capacity = initial_capacity
+
+        self._lock = threading.RLock()
+        self._conn = None
+        self._vectors = None
+        self._capacity = 0
+        self._next_row = 0
+
+    @property
+    def _vector_path(self) -> str:
+        return os.path.join(self.directory, "vectors.f32")
+
+    def connect(self) -> bool:
+        with self._lock:
+            if self._conn is not None:
+                return True
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                self._conn = sqlite3.connect(
+                    os.path.join(self.directory, "metadata.db"), check_same_thread=False
+                )
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.executescript(
+                    """
+                    CREATE TABLE IF NOT EXISTS documents (
+                        document_id TEXT PRIMARY KEY,
+                        row INTEGER NOT NULL,
+                        user_id TEXT,
+                        content_type TEXT,
+                        source_type TEXT,
+                        upload_timestamp INTEGER,
+                        document TEXT NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS idx_documents_user ON documents (user_id, upload_timestamp);
+                    CREATE INDEX IF NOT EXISTS idx_documents_type ON documents (content_type, source_type);
+                    """
+                )
+                self._conn.commit()
+
+                max_row = self._conn.execute("SELECT MAX(row) FROM documents").fetchone()[0]
+                self._next_row = 0 if max_row is None else max_row + 1
+
+                row_bytes = self.dimension * 4
+                existing_rows = (
+                    os.path.getsize(self._vector_path) // row_bytes
+                    if os.path.exists(self._vector_path)
+                    else 0
+                )
+                self._open_vectors(max(existing_rows, self.initial_capacity, self._next_row))
+                print(f"本機向量資料庫已載入: {self.directory}（{self._next_row} 列）")
+                return True
+            except Exception as e:
+                print(f"初始化本機向量資料庫失敗: {str(e)}")
+                self._conn = None
+                return False
+
+    def _open_vectors(self, capacity: int):
+        """以指定容量開啟（必要時擴充）向量檔"""
+        if self._vectors is not None:
+            self._vectors.flush()
+            del self._vectors
+        with open(self._vector_path, "ab") as f:
+            f.truncate(capacity * self.dimension * 4)
+        self._vectors = np.memmap(
+            self._vector_path, dtype=np.float32, mode="r+", shape=(capacity, self.dimension)
+        )
+        self._capacity = capacity
+
+    def _ensure_capacity(self, rows: int):
+        if rows > self._capacity:
+            new_capacity = self._capacity
+            while new_capacity < rows:
+                new_capacity *= 2
+            self._open_vectors(new_capacity)
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm else array
+
+    def _where(self, filter: Dict):
+        """將過濾條件轉為 SQL WHERE 子句與參數"""
+        clauses = []
+        params = []
+        for key, condition in (filter or {}).items():
+            column = self._COLUMNS.get(key)
+            if column is None:
+                column = "json_extract(document, ?)"
+                path_params = ["$." + key]
+            else:
+                path_params = []
+
+            if isinstance(condition, dict):
+                for operator, value in condition.items():
+                    if operator == "$in":
+                        values = list(value)
+                        if not values:
+                            clauses.append("0")
+                            continue
+                        placeholders = ", ".join("?" for _ in values)
+                        clauses.append(f"{column} IN ({placeholders})")
+                        params += path_params + values
+                    elif operator in self._OPERATORS:
+                        clauses.append(f"{column} {self._OPERATORS[operator]} ?")
+                        params += path_params + [value]
+                    else:
+                        raise ValueError(f"不支援的過濾運算子: {operator}")
+            elif condition is None:
+                clauses.append(f"{column} IS NULL")
+                params += path_params
+            else:
+                clauses.append(f"{column} = ?")
+                params += path_params + [condition]
+
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    @staticmethod
+    def _project(document: Dict, fields: Optional[List[str]]) -> Dict:
+        if fields is None:
+            return document
+        metadata = document.get("metadata") or {}
+        return {
+            "_id": document["_id"],
+            "metadata": {field: metadata[field] for field in fields if field in metadata},
+        }
+
+    def _insert(self, document: Dict):
+        row = self._next_row
+        self._ensure_capacity(row + 1)
+        self._vectors[row] = self._normalize(document["$vector"])
+        metadata = document.get("metadata") or {}
+        stored = {key: value for key, value in document.items() if key != "$vector"}
+        self._conn.execute(
+            "INSERT INTO documents (document_id, row, user_id, content_type, source_type, upload_timestamp, document) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                document["_id"],
+                row,
+                metadata.get("user_id"),
+                metadata.get("content_type"),
+                metadata.get("source_type"),
+                metadata.get("upload_timestamp"),
+                json.dumps(stored, ensure_ascii=False),
+            ),
+        )
+        self._next_row += 1
+
+    def insert_one(self, document: Dict) -> None:
+        with self._lock:
+            self._insert(document)
+            self._vectors.flush()
+            self._conn.commit()
+
+    def insert_many(self, documents: List[Dict]) -> Dict[str, str]:
+        failures = {}
+        with self._lock:
+            for document in documents:
+                try:
+                    self._insert(document)
+                except Exception as e:
+                    failures[document["_id"]] = str(e)
+            self._vectors.flush()
+            self._conn.commit()
+        return failures
+
+    def existing_ids(self, ids: Iterable[str]) -> Set[str]:
+        where, params = self._where({"_id": {"$in": list(ids)}})
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT document_id FROM documents{where}", params
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def search(
+        self,
+        vector: List[float],
+        filter: Dict,
+        limit: int,
+        fields: Optional[List[str]] = None,
+    ) -> List[Dict]:
+        where, params = self._where(filter)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT row, document FROM documents{where}", params
+            ).fetchall()
+            if not rows:
+                return []
+            row_indexes = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+            scores = self._vectors[row_indexes] @ self._normalize(vector)
+
+        k = min(limit, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        results = []
+        for index in top:
+            document = self._project(json.loads(rows[index][1]), fields)
+            # 與 Data API 一致：cosine 相似度映射到 0~1
+            document["$similarity"] = float((scores[index] + 1) / 2)
+            results.append(document)
+        return results
+
+    def find_one(
+        self, document_id: str, fields: Optional[List[str]] = None
+    ) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT document FROM documents WHERE document_id = ?", (document_id,)
+            ).fetchone()
+        return self._project(json.loads(row[0]), fields) if row else None
+
+    def update_one(self, document_id: str, fields: Dict) -> int:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT document FROM documents WHERE document_id = ?", (document_id,)
+            ).fetchone()
+            if not row:
+                return 0
+            document = json.loads(row[0])
+            metadata = document.setdefault("metadata", {})
+            metadata.update(fields)
+            # 可過濾欄位存在獨立欄位，與 document JSON 一併更新
+            self._conn.execute(
+                "UPDATE documents SET user_id = ?, content_type = ?, source_type = ?, "
+                "upload_timestamp = ?, document = ? WHERE document_id = ?",
+                (
+                    metadata.get("user_id"),
+                    metadata.get("content_type"),
+                    metadata.get("source_type"),
+                    metadata.get("upload_timestamp"),
+                    json.dumps(document, ensure_ascii=False),
+                    document_id,
+                ),
+            )
+            self._conn.commit()
+        return 1
+
+    def delete_one(self, document_id: str) -> int:
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM documents WHERE document_id = ?", (document_id,)
+            )
+            self._conn.commit()
+        return cursor.rowcount
+
+    def delete_many(self, filter: Dict) -> int:
+        where, params = self._where(filter)
+        with self._lock:
+            cursor = self._conn.execute(f"DELETE FROM documents{where}", params)
+            self._conn.commit()
+        return cursor.rowcount
+
+    def find_by_ids(
+        self, ids: List[str], fields: Optional[List[str]] = None
+    ) -> List[Dict]:
+        where, params = self._where({"_id": {"$in": list(ids)}})
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT document FROM documents{where}", params
+            ).fetchall()
+        return [self._project(json.loads(row[0]), fields) for row in rows]
+
+    def iter_documents(
+        self,
+        filter: Dict,
+        fields: Optional[List[str]] = None,
+        include_vector: bool = False,
+        page_size: int = 500,
+    ) -> Iterator[Dict]:
+        where, params = self._where(filter)
+        # 以 document_id 作為 keyset 分頁，避免 OFFSET 越翻越慢
+        last_id = ""
+        while True:
+            clause = f"{where} AND document_id > ?" if where else " WHERE document_id > ?"
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT document_id, row, document FROM documents{clause} "
+                    "ORDER BY document_id LIMIT ?",
+                    params + [last_id, page_size],
+                ).fetchall()
+                vectors = (
+                    self._vectors[[row[1] for row in rows]].tolist()
+                    if include_vector and rows
+                    else None
+                )
+            if not rows:
+                return
+            for index, row in enumerate(rows):
+                document = self._project(json.loads(row[2]), fields)
+                if include_vector:
+                    document["$vector"] = vectors[index]
+                yield document
+            last_id = rows[-1][0]
+
+
+def create_vector_store(
+    backend: str = None,
+    api_endpoint: str = None,
+    token: str = None,
+    collection_name: str = None,
+    dimension: int = 1536,
+    directory: str = None,
+) -> VectorStore:
+    """依設定建立向量資料庫後端（VECTOR_STORE_BACKEND=astra|local）
+
+    Args:
+        directory: local 後端的資料目錄，預設為 LOCAL_VECTOR_STORE_DIR
+    """
+    backend = (backend or os.getenv("VECTOR_STORE_BACKEND", "astra")).lower()
+    if backend == "local":
+        return LocalVectorStore(
+            directory=directory
+            or os.getenv("LOCAL_VECTOR_STORE_DIR", "data/vector_store"),
+            dimension=dimension,
+        )
+    if backend == "astra":
+        return AstraVectorStore(api_endpoint, token, collection_name, dimension)
+    raise ValueError(f"不支援的向量資料庫後端: {backend}")
@@ -0,0 +1,198 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# 記憶體型檔案系統（tmpfs）；可用空間足夠時暫存檔放在這裡，省去磁碟 I/O
+TMPFS_DIR = "/dev/shm"
+
+
+def _tree_usage(path: str) -> Tuple[int, int, float]:
+    """回傳 (位元組數, 檔案數, 最新修改時間)；檔案在掃描途中被刪除時略過"""
+    try:
+        if not os.path.isdir(path):
+            stat = os.stat(path)
+            return stat.st_size, 1, stat.st_mtime
+        size, files, newest = 0, 0, os.stat(path).st_mtime
+        for directory, _, names in os.walk(path):
+            for name in names:
+                try:
+                    stat = os.stat(os.path.join(directory, name))
+                except OSError:
+                    continue
+                size += stat.st_size
+                files += 1
+                newest = max(newest, stat.st_mtime)
+        return size, files, newest
+    except OSError:
+        return 0, 0, 0.0
+
+
+def _remove(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class Workspace:
+    """下載影片、擷取音訊等暫存檔的工作目錄
+
+    每個工作以 job() 取得獨立的子目錄，離開時（含失敗與請求取消）整個刪除；
+    背景 janitor 定期刪除超過 max_age 未更新的項目，總量超過 max_bytes 時
+    從最舊的開始刪除（先刪已結束工作留下的，必要時也會刪除執行中的工作）。
+    """
+
+    def __init__(
+        self,
+        root: str,
+        max_bytes: int,
+        max_age: float,
+        janitor_interval: float = 60.0,
+        tmpfs: bool = False,
+    ):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.janitor_interval = janitor_interval
+        self.tmpfs = tmpfs
+        self._active: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.expired = 0
+        self.evicted = 0
+        self.last_sweep: Optional[float] = None
+
+    @classmethod
+    def from_env(cls) -> "Workspace":
+        """依 WORKSPACE_* 設定建立；/dev/shm 的可用空間不少於 WORKSPACE_TMPFS_MIN_FREE_MB 時優先使用"""
+        max_bytes = int(float(os.getenv("WORKSPACE_MAX_MB", "1024")) * 1024 * 1024)
+        min_free = int(float(os.getenv("WORKSPACE_TMPFS_MIN_FREE_MB", "512")) * 1024 * 1024)
+        root = os.getenv("WORKSPACE_DIR", "shorts_cache")
+        tmpfs = False
+        if os.getenv("WORKSPACE_USE_TMPFS", "true").lower() == "true":
+            try:
+                if (
+                    os.access(TMPFS_DIR, os.W_OK)
+                    and shutil.disk_usage(TMPFS_DIR).free >= min_free
+                ):
+                    root = os.path.join(TMPFS_DIR, "shorts-analysis")
+                    tmpfs = True
+            except OSError:
+                pass
+        return cls(
+            root,
+            max_bytes=max_bytes,
+            max_age=float(os.getenv("WORKSPACE_MAX_AGE_SECONDS", "1800")),
+            janitor_interval=float(os.getenv("WORKSPACE_JANITOR_INTERVAL_SECONDS", "60")),
+            tmpfs=tmpfs,
+        )
+
+    @contextmanager
+    def job(self, name: str = "job") -> Iterator[str]:
+        """建立工作專用的暫存目錄，離開時刪除"""
+        os.makedirs(self.root, exist_ok=True)
+        path = tempfile.mkdtemp(prefix=f"{name}-", dir=self.root)
+        with self._lock:
+            self._active[path] = time.time()
+        try:
+            yield path
+        finally:
+            with self._lock:
+                self._active.pop(path, None)
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _entries(self) -> List[Tuple[str, int, int, float]]:
+        """根目錄下的各個項目：(路徑, 位元組數, 檔案數, 最新修改時間)"""
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return []
+        return [
+            (path, *_tree_usage(path))
+            for path in (os.path.join(self.root, name) for name in names)
+        ]
+
+    def sweep(self):
+        """刪除過期項目並將總量壓回上限"""
+        now = time.time()
+        entries = []
+        for path, size, files, modified in self._entries():
+            if now - modified > self.max_age:
+                print(f"🧹 刪除過期的暫存項目: {path}")
+                _remove(path)
+                self.expired += 1
+            else:
+                entries.append((path, size, modified))
+
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            with self._lock:
+                active = set(self._active)
+            # 已結束工作留下的檔案先刪，其次才是執行中的工作；同類中由舊到新
+            entries.sort(key=lambda entry: (entry[0] in active, entry[2]))
+            for path, size, _ in entries:
+                if total <= self.max_bytes:
+                    break
+                print(f"🧹 暫存空間超過上限，刪除: {path} ({size / 1024 / 1024:.1f}MB)")
+                _remove(path)
+                total -= size
+                self.evicted += 1
+        self.last_sweep = now
+
+    def _run(self):
+        while not self._stopped.wait(self.janitor_interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"⚠️ 暫存空間清理失敗: {e}")
+
+    def start(self):
+        """啟動背景 janitor；啟動時先清理一次"""
+        if self._thread and self._thread.is_alive():
+            return
+        os.makedirs(self.root, exist_ok=True)
+        self.sweep()
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="workspace-janitor", daemon=True
+        )
+        self._thread.start()
+        print(f"📂 暫存工作目錄: {self.root}（{'tmpfs' if self.tmpfs else '磁碟'}）")
+
+    def stop(self, timeout: float = 5.0):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def stats(self) -> Dict:
+        entries = self._entries()
+        with self._lock:
+            active_jobs = len(self._active)
+        stats = {
+            "root": self.root,
+            "tmpfs": self.tmpfs,
+            "bytes_used": sum(entry[1] for entry in entries),
+            "files": sum(entry[2] for entry in entries),
+            "active_jobs": active_jobs,
+            "max_bytes": self.max_bytes,
+            "max_age_seconds": self.max_age,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+        try:
+            stats["free_bytes"] = shutil.disk_usage(self.root).free
+        except OSError:
+            pass
+        return stats
+
+
+# 所有平台模組共用的暫存工作目錄
+workspace = Workspace.from_env()
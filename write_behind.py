@@ -0,0 +1,261 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+
+class WriteBehindLog:
+    """以 SQLite 作為持久化日誌的 write-behind 寫入器
+
+    文檔先寫入本機日誌即可回應，背景執行緒再批次交給 flush_fn 寫入資料庫。
+    flush_fn 回傳寫入失敗的 {document_id: 錯誤訊息}，拋出例外則視為整批失敗；
+    失敗的文檔以指數退避重試，超過重試次數後移到 dead_letter 表保留。
+    日誌存在磁碟上，服務重啟後會繼續寫入尚未完成的文檔。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        flush_fn: Callable[[List[Dict]], Dict[str, str]],
+        batch_size: int = 20,
+        flush_interval: float = 1.0,
+        max_retries: int = 10,
+        retry_backoff: float = 2.0,
+        max_backoff: float = 300.0,
+    ):
+        self.path = path
+        self.flush_fn = flush_fn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS pending (
+                document_id TEXT PRIMARY KEY,
+                document TEXT NOT NULL,
+                enqueued_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                last_error TEXT
+            );
+            CREATE TABLE IF NOT EXISTS dead_letter (
+                document_id TEXT PRIMARY KEY,
+                document TEXT NOT NULL,
+                enqueued_at REAL NOT NULL,
+                attempts INTEGER NOT NULL,
+                last_error TEXT
+            );
+            """
+        )
+        self._conn.commit()
+
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self._flushed_count = 0
+        self._last_flush_latency_ms = None
+        self._avg_flush_latency_ms = None
+        self._last_error = None
+
+    def start(self):
+        """啟動背景 flusher；重啟後會先處理日誌中殘留的文檔"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="astra-write-behind", daemon=True
+        )
+        self._thread.start()
+        backlog = self.backlog_size()
+        if backlog:
+            print(f"📦 write-behind 日誌中有 {backlog} 筆待寫入文檔，繼續寫入")
+
+    def stop(self, timeout: float = 10.0):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def enqueue(self, document: Dict):
+        """將文檔寫入本機日誌（同步落盤後才返回）"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pending (document_id, document, enqueued_at) VALUES (?, ?, ?)",
+                (document["_id"], json.dumps(document, ensure_ascii=False), time.time()),
+            )
+            self._conn.commit()
+        if self.backlog_size() >= self.batch_size:
+            self._wakeup.set()
+
+    def get(self, document_id: str) -> Optional[Dict]:
+        """取得仍在日誌中、尚未寫入資料庫的文檔"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT document FROM pending WHERE document_id = ?", (document_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update_pending(self, document_id: str, fields: Dict) -> bool:
+        """更新仍在日誌中、尚未寫入資料庫的文檔 metadata 欄位，回傳是否有更新"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT document FROM pending WHERE document_id = ?", (document_id,)
+            ).fetchone()
+            if not row:
+                return False
+            document = json.loads(row[0])
+            document.setdefault("metadata", {}).update(fields)
+            self._conn.execute(
+                "UPDATE pending SET document = ? WHERE document_id = ?",
+                (json.dumps(document, ensure_ascii=False), document_id),
+            )
+            self._conn.commit()
+        return True
+
+    def remove(self, document_id: str) -> bool:
+        """從日誌移除尚未寫入的文檔，回傳是否有移除"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM pending WHERE document_id = ?", (document_id,)
+            )
+            self._conn.commit()
+        return cursor.rowcount > 0
+
+    def pending_for_user(self, user_id: str) -> List[Dict]:
+        """取得該使用者仍在日誌中、尚未寫入資料庫的文檔"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT document FROM pending "
+                "WHERE json_extract(document, '$.metadata.user_id') = ? ORDER BY enqueued_at",
+                (user_id,),
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def remove_for_user(self, user_id: str) -> List[str]:
+        """移除該使用者所有尚未寫入（含 dead_letter）的文檔，回傳移除的 ID"""
+        removed = []
+        with self._lock:
+            for table in ("pending", "dead_letter"):
+                where = f"FROM {table} WHERE json_extract(document, '$.metadata.user_id') = ?"
+                removed += [
+                    row[0]
+                    for row in self._conn.execute(f"SELECT document_id {where}", (user_id,))
+                ]
+                self._conn.execute(f"DELETE {where}", (user_id,))
+            self._conn.commit()
+        return removed
+
+    def backlog_size(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM pending").fetchone()[0]
+
+    def flush_once(self) -> int:
+        """寫入一批到期的文檔，回傳成功寫入的數量"""
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT document_id, document, attempts FROM pending "
+                "WHERE next_attempt_at <= ? ORDER BY enqueued_at LIMIT ?",
+                (now, self.batch_size),
+            ).fetchall()
+        if not rows:
+            return 0
+
+        documents = [json.loads(row[1]) for row in rows]
+        started = time.monotonic()
+        try:
+            failures = self.flush_fn(documents) or {}
+        except Exception as e:
+            failures = {row[0]: str(e) for row in rows}
+        latency_ms = round((time.monotonic() - started) * 1000)
+
+        flushed = [row[0] for row in rows if row[0] not in failures]
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM pending WHERE document_id = ?",
+                [(document_id,) for document_id in flushed],
+            )
+            for document_id, document, attempts in rows:
+                if document_id not in failures:
+                    continue
+                attempts += 1
+                error = failures[document_id]
+                if attempts >= self.max_retries:
+                    print(f"❌ 文檔 {document_id} 重試 {attempts} 次仍失敗，移至 dead_letter: {error}")
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO dead_letter "
+                        "SELECT document_id, document, enqueued_at, ?, ? FROM pending WHERE document_id = ?",
+                        (attempts, error, document_id),
+                    )
+                    self._conn.execute(
+                        "DELETE FROM pending WHERE document_id = ?", (document_id,)
+                    )
+                else:
+                    delay = min(self.retry_backoff * 2 ** (attempts - 1), self.max_backoff)
+                    self._conn.execute(
+                        "UPDATE pending SET attempts = ?, next_attempt_at = ?, last_error = ? "
+                        "WHERE document_id = ?",
+                        (attempts, time.time() + delay, error, document_id),
+                    )
+            self._conn.commit()
+
+            self._flushed_count += len(flushed)
+            if flushed:
+                self._last_flush_latency_ms = latency_ms
+                self._avg_flush_latency_ms = (
+                    latency_ms
+                    if self._avg_flush_latency_ms is None
+                    else round(self._avg_flush_latency_ms * 0.8 + latency_ms * 0.2)
+                )
+            if failures:
+                self._last_error = next(iter(failures.values()))
+
+        if flushed:
+            print(f"✅ write-behind 寫入 {len(flushed)} 筆文檔，耗時 {latency_ms}ms")
+        if failures:
+            print(f"⚠️ write-behind 有 {len(failures)} 筆文檔寫入失敗，稍後重試")
+        return len(flushed)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                # 整批寫入成功且仍有積壓時立即繼續，否則等待下一個週期
+                if self.flush_once() >= self.batch_size:
+                    continue
+            except Exception as e:
+                print(f"⚠️ write-behind flusher 發生錯誤: {e}")
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+
+    def stats(self) -> Dict:
+        """回傳積壓數量、最舊文檔等待時間與寫入延遲"""
+        with self._lock:
+            backlog, oldest = self._conn.execute(
+                "SELECT COUNT(*), MIN(enqueued_at) FROM pending"
+            ).fetchone()
+            dead_letters = self._conn.execute(
+                "SELECT COUNT(*) FROM dead_letter"
+            ).fetchone()[0]
+            return {
+                "backlog": backlog,
+                "oldest_pending_seconds": round(time.time() - oldest, 1) if oldest else 0,
+                "dead_letters": dead_letters,
+                "flushed": self._flushed_count,
+                "last_flush_latency_ms": self._last_flush_latency_ms,
+                "avg_flush_latency_ms": self._avg_flush_latency_ms,
+                "last_error": self._last_error,
+            }
@@ -5,6 +5,12 @@ import yt_dlp
 from openai import OpenAI
 from typing import Dict, Optional
 
+from metrics import instrument, record_bytes, record_error, stage
+from upstream_governor import governor
+import deadline
+import progress
+from workspace import workspace
+
 
 def audio_to_text(video_path: str) -> str:
     """使用Whisper將音頻轉為文字 - 如果是mp4則先提取音頻"""
@@ -27,27 +33,34 @@ def audio_to_text(video_path: str) -> str:
             audio_file_for_whisper = base + "_audio.m4a"
 
             try:
-                result = subprocess.run(
-                    [
+                with stage("ffmpeg", upstream="ffmpeg"):
+                    # 請求取消或逾時時終止 ffmpeg 行程
+                    result = deadline.run_subprocess(
+                        [
+                            "ffmpeg",
+                            "-y",
+                            "-i",
+                            video_path,
+                            "-vn",
+                            "-acodec",
+                            "copy",
+                            audio_file_for_whisper,
+                        ],
                         "ffmpeg",
-                        "-y",
-                        "-i",
-                        video_path,
-                        "-vn",
-                        "-acodec",
-                        "copy",
-                        audio_file_for_whisper,
-                    ],
-                    capture_output=True,
-                    text=True,
-                    timeout=30,
-                )
+                        30,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE,
+                        text=True,
+                    )
 
                 if result.returncode != 0:
+                    record_error("ffmpeg")
                     print(f"⚠️ ffmpeg提取音頻失敗，直接使用原檔案: {result.stderr}")
                     audio_file_for_whisper = video_path
                 else:
                     print("✅ 音頻提取成功")
+            except deadline.DeadlineExceeded:
+                raise
             except Exception as e:
                 print(f"⚠️ ffmpeg提取音頻失敗，直接使用原檔案: {e}")
                 audio_file_for_whisper = video_path
@@ -55,25 +68,33 @@ def audio_to_text(video_path: str) -> str:
         print("🤖 使用Whisper-1進行語音轉文字...")
 
         # 呼叫Whisper-1
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-        with open(audio_file_for_whisper, "rb") as f:
-            resp = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=f,
-                response_format="text",  # 純文字格式
-                temperature=0.0,  # 最穩定的輸出
-            )
+        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+        def transcribe():
+            # 重試時重新開檔，從頭上傳
+            with open(audio_file_for_whisper, "rb") as f:
+                return client.audio.transcriptions.create(
+                    model="whisper-1",
+                    file=f,
+                    response_format="text",  # 純文字格式
+                    temperature=0.0,  # 最穩定的輸出
+                    timeout=deadline.timeout(300, "whisper"),
+                )
 
-        # 清理提取的音頻檔案（如果有的話）
-        if audio_file_for_whisper != video_path and os.path.exists(
-            audio_file_for_whisper
-        ):
-            try:
-                os.remove(audio_file_for_whisper)
-                print("🗑️ 已清理提取的音頻暫存檔")
-            except:
-                pass
+        record_bytes("upload", "openai", os.path.getsize(audio_file_for_whisper))
+        try:
+            with stage("whisper", upstream="openai"):
+                resp = governor.call("openai_audio", transcribe)
+        finally:
+            # 清理提取的音頻檔案（如果有的話），轉錄失敗或請求取消時也要清理
+            if audio_file_for_whisper != video_path and os.path.exists(
+                audio_file_for_whisper
+            ):
+                try:
+                    os.remove(audio_file_for_whisper)
+                    print("🗑️ 已清理提取的音頻暫存檔")
+                except:
+                    pass
 
         transcription = resp.strip()
         if transcription:
@@ -110,6 +131,7 @@ def extract_video_id(url: str) -> str:
     return None
 
 
+@instrument("download", upstream="youtube")
 def download_youtube_audio_with_ytdlp(
     url: str, workdir: str = "shorts_cache"
 ) -> tuple[str, Dict]:
@@ -119,6 +141,7 @@ def download_youtube_audio_with_ytdlp(
     Returns:
         tuple: (audio_file_path, video_info_dict)
     """
+    video_id = None
     try:
         # 確保工作目錄存在
         os.makedirs(workdir, exist_ok=True)
@@ -143,6 +166,9 @@ def download_youtube_audio_with_ytdlp(
             "outtmpl": os.path.join(workdir, f"%(title)s_%(id)s.%(ext)s"),
             "quiet": False,
             "no_warnings": False,
+            "socket_timeout": deadline.timeout(30, "download"),
+            # 下載進度回呼中檢查請求期限，超過時中止下載
+            "progress_hooks": [lambda status: deadline.check("download")],
         }
 
         # 套用代理（若有）
@@ -165,6 +191,16 @@ def download_youtube_audio_with_ytdlp(
             print(f"👤 作者: {author}")
             print(f"⏱️ 長度: {duration}秒")
             print(f"👁️ 觀看次數: {view_count}")
+            progress.emit(
+                "metadata",
+                {
+                    "title": title,
+                    "author": author,
+                    "description": description,
+                    "duration": duration,
+                    "view_count": view_count,
+                },
+            )
 
             # 下載音頻
             print("⬇️ 開始下載音頻...")
@@ -187,6 +223,7 @@ def download_youtube_audio_with_ytdlp(
                 raise Exception("音頻下載失敗，找不到下載的文件")
 
             file_size = os.path.getsize(audio_file_path)
+            record_bytes("download", "youtube", file_size)
             print(
                 f"✅ 音頻下載完成: {audio_file_path} ({file_size / 1024 / 1024:.1f}MB)"
             )
@@ -204,11 +241,21 @@ def download_youtube_audio_with_ytdlp(
             return audio_file_path, video_data
 
     except Exception as e:
+        record_error("youtube")
         error_msg = f"yt-dlp YouTube下載失敗: {str(e)}"
         print(f"❌ {error_msg}")
+        # 中止或失敗的下載會留下 .part 等暫存檔
+        if video_id and os.path.isdir(workdir):
+            for file_path in os.listdir(workdir):
+                if video_id in file_path:
+                    try:
+                        os.remove(os.path.join(workdir, file_path))
+                    except OSError:
+                        pass
         return None, {"error": error_msg}
 
 
+@instrument("extract")
 def process_youtube_video(url: str) -> Dict:
     """
     處理YouTube影片：下載、轉錄、分析
@@ -217,67 +264,61 @@ def process_youtube_video(url: str) -> Dict:
         Dict: 包含raw_output和ai_input的結果
     """
     try:
-        # 下載音頻
-        audio_path, video_info = download_youtube_audio_with_ytdlp(url)
-
-        if audio_path is None:
-            # 下載失敗，返回完整格式的基本資訊
-            return {
+        # 每個工作使用獨立的暫存目錄，結束時（含失敗與請求取消）整個刪除
+        with workspace.job("youtube") as workdir:
+            # 下載音頻
+            audio_path, video_info = download_youtube_audio_with_ytdlp(url, workdir)
+
+            if audio_path is None:
+                # 下載失敗，返回完整格式的基本資訊
+                return {
+                    "raw_output": {
+                        "description": video_info.get("error", "下載失敗"),
+                        "caption": "(影片下載失敗)",
+                        "title": "未知標題",
+                        "author": "未知作者",
+                        "view_count": 0,
+                        "duration": 0,
+                    },
+                    "ai_input": {
+                        "original_path": url,
+                        "ocr_text": "",
+                        "caption": "(影片下載失敗)",
+                    },
+                }
+
+            # 語音轉文字
+            print("🎙️ 開始語音轉文字...")
+            caption = audio_to_text(audio_path)
+
+            if not caption:
+                caption = "(無法轉錄音頻)"
+                print("⚠️ 語音轉文字失敗")
+
+            # 使用影片標題作為 ocr_text（作者濃縮的核心文案，資訊密度高）
+            # 不使用 description，因通常包含非重點資訊
+            video_title = video_info.get("title", "")
+            ocr_text = video_title
+
+            # 組合結果
+            result = {
                 "raw_output": {
-                    "description": video_info.get("error", "下載失敗"),
-                    "caption": "(影片下載失敗)",
-                    "title": "未知標題",
-                    "author": "未知作者",
-                    "view_count": 0,
-                    "duration": 0,
+                    "description": video_info.get("description", ""),
+                    "caption": caption,
+                    "title": video_title,
+                    "author": video_info.get("author", ""),
+                    "view_count": video_info.get("view_count", 0),
+                    "duration": video_info.get("duration", 0),
                 },
                 "ai_input": {
                     "original_path": url,
-                    "ocr_text": "",
-                    "caption": "(影片下載失敗)",
+                    "ocr_text": ocr_text,  # 影片標題（作者核心文案）
+                    "caption": caption,  # Whisper 語音轉文字
                 },
             }
 
-        # 語音轉文字
-        print("🎙️ 開始語音轉文字...")
-        caption = audio_to_text(audio_path)
-
-        if not caption:
-            caption = "(無法轉錄音頻)"
-            print("⚠️ 語音轉文字失敗")
-
-        # 使用影片標題作為 ocr_text（作者濃縮的核心文案，資訊密度高）
-        # 不使用 description，因通常包含非重點資訊
-        video_title = video_info.get("title", "")
-        ocr_text = video_title
-
-        # 清理下載的音頻檔案
-        try:
-            if os.path.exists(audio_path):
-                os.remove(audio_path)
-                print(f"🗑️ 已清理音頻檔案: {audio_path}")
-        except Exception as e:
-            print(f"⚠️ 清理檔案失敗: {e}")
-
-        # 組合結果
-        result = {
-            "raw_output": {
-                "description": video_info.get("description", ""),
-                "caption": caption,
-                "title": video_title,
-                "author": video_info.get("author", ""),
-                "view_count": video_info.get("view_count", 0),
-                "duration": video_info.get("duration", 0),
-            },
-            "ai_input": {
-                "original_path": url,
-                "ocr_text": ocr_text,  # 影片標題（作者核心文案）
-                "caption": caption,  # Whisper 語音轉文字
-            },
-        }
-
-        print("✅ YouTube影片處理完成")
-        return result
+            print("✅ YouTube影片處理完成")
+            return result
 
     except Exception as e:
         error_msg = f"處理YouTube影片時發生錯誤: {str(e)}"